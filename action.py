@@ -1,19 +1,109 @@
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 import mwparserfromhell
 from mwparserfromhell.nodes.wikilink import Wikilink
+from mwparserfromhell.wikicode import Wikicode
 import re
-from typing import ClassVar, Optional
+from typing import ClassVar, Optional, Self
 
 from siteinfo import CategoryInfo
 
 
+# a category link that mwparserfromhell parses the same way on its own as at the end of a page:
+# no nested links, templates, tags or line breaks
+_simple_wikilink_re = re.compile(r'\[\[([^\[\]{}<>|\n]+)(?:\|([^\[\]{}<>\n]*))?\]\]')
+
+
+@dataclass
+class CategoryTail:
+    """The wikitext of a page, split into the category links at the end and everything before them.
+
+    Category links are almost always at the end of a page;
+    when there are no other category links before them,
+    actions can be applied to the links at the end (see Action.apply_to_category_tail)
+    without parsing the rest of the page, which is much cheaper for large pages."""
+
+    head: str
+    nodes: list[str | Wikilink]  # category links and the whitespace between them
+
+    @classmethod
+    def split(cls, wikitext: str, category_info: CategoryInfo) -> Optional['CategoryTail']:
+        """Split the given wikitext, if that can be done without changing the meaning of any actions.
+
+        This is the case if the head contains no category links
+        (or anything that looks like one, e.g. in a comment)
+        and ends in a line break, so that mwparserfromhell would not
+        parse the category links at the end as part of anything in the head.
+        (It parses any unclosed templates, tags, comments etc. in the head as plain text.)"""
+        link_prefixes = category_info.link_prefixes
+        if any(mwparserfromhell.definitions.is_scheme(category_namespace_name.lower(), slashes=False)
+               for category_namespace_name in category_info.names):
+            return None  # such links would be parsed as external links
+
+        nodes: list[str | Wikilink] = []
+        end = len(wikitext)
+        while True:
+            whitespace_end = end
+            while end > 0 and wikitext[end - 1].isspace():
+                end -= 1
+            if end < whitespace_end:
+                nodes.append(wikitext[end:whitespace_end])
+            if not wikitext.endswith(']]', 0, end):
+                break
+            start = wikitext.rfind('[[', 0, end)
+            match = _simple_wikilink_re.fullmatch(wikitext, start, end) if start != -1 else None
+            if not match or not wikitext.startswith(link_prefixes, start):
+                break
+            nodes.append(Wikilink(match[1], match[2]))
+            end = start
+        if nodes and isinstance(nodes[-1], str):
+            end += len(nodes.pop())  # whitespace before the first category link belongs to the head
+
+        head = wikitext[:end]
+        if nodes and head.rstrip(' \t') and not head.rstrip(' \t').endswith('\n'):
+            return None
+        if any(link_prefix in head for link_prefix in link_prefixes):
+            return None
+        nodes.reverse()
+        return cls(head, nodes)
+
+    def __str__(self) -> str:
+        return self.head + ''.join(str(node) for node in self.nodes)
+
+
 class Action(ABC):
-    """A transformation to a piece of wikitext."""
+    """A transformation to a piece of wikitext.
+
+    Actions are immutable, so that identical actions
+    can be shared between commands (see parse_tpsv.parse_actions)."""
+
+    __slots__ = ()
 
-    @abstractmethod
     def apply(self, wikitext: str, category_info: CategoryInfo) -> str:
         """Apply the action to the given wikitext, returning the resulting wikitext."""
+        category_tail = CategoryTail.split(wikitext, category_info)
+        if category_tail is not None:
+            changed = self.apply_to_category_tail(category_tail, category_info)
+            return str(category_tail) if changed else wikitext
+        wikicode = mwparserfromhell.parse(wikitext)
+        self.apply_to_wikicode(wikicode, category_info)
+        return str(wikicode)
+
+    @abstractmethod
+    def apply_to_wikicode(self, wikicode: Wikicode, category_info: CategoryInfo) -> bool:
+        """Apply the action to the given parsed wikitext, modifying it in place.
+
+        Returns whether the wikitext was changed,
+        so that several actions can be applied to the same parsed wikitext
+        (see Command.apply) without serializing it after each one."""
+
+    @abstractmethod
+    def apply_to_category_tail(self, category_tail: CategoryTail, category_info: CategoryInfo) -> bool:
+        """Apply the action to the given split wikitext, modifying it in place.
+
+        This must have the same effect as apply_to_wikicode
+        on the parsed wikitext of the whole page.
+        Returns whether the wikitext was changed."""
 
     @abstractmethod
     def summary(self, category_info: CategoryInfo) -> str:
@@ -23,19 +113,23 @@ class Action(ABC):
     def is_minor(self) -> bool:
         """Whether this action, on its own, can be considered a minor edit."""
 
-    def cleanup(self) -> None:
+    def cleanup(self) -> Self:
         """Partially normalize the action, as a convenience for users.
 
+        Returns the normalized action (possibly self, if nothing changed).
+
         This should not be used as a replacement for full
         normalization via the MediaWiki API.
         """
-        pass
+        return self
 
 
-@dataclass
+@dataclass(frozen=True)
 class CategoryAction(Action):
     """An action to modify a category in the wikitext of a page."""
 
+    __slots__ = ('category',)
+
     symbol: ClassVar[str] = ''
 
     category: str
@@ -47,56 +141,39 @@ class CategoryAction(Action):
         assert ']' not in self.category, 'category should not be a wikilink'
 
     def _is_category(self, wikilink: Wikilink, category_info: CategoryInfo) -> bool:
-        for category_namespace_name in category_info[1]:
-            if wikilink.startswith('[[' + category_namespace_name + ':'):
-                return True
-        return False
+        return category_info.is_category_link(str(wikilink))
 
     def _same_category(self, category1: str, category2: str, category_info: CategoryInfo) -> bool:
-        if category_info[2] == 'first-letter':
-            category1 = category1[:1].upper() + category1[1:]
-            category2 = category2[:1].upper() + category2[1:]
-        elif category_info[2] == 'case-sensitive':
-            pass
-        else:
-            raise ValueError('Unknown case handling %s' % category_info[2])
-
-        return self._clean_up_whitespace(category1) == self._clean_up_whitespace(category2)
-
-    def _clean_up_whitespace(self, title: str) -> str:
-        """Clean up whitespace in a title string (and convert it to dbkey form, i.e. underscores).
-
-        For the MediaWiki implementation of this, see MediaWikiTitleCodec::splitTitleString()."""
-        return re.sub(
-            r'[ _\u00A0\u1680\u180E\u2000-\u200A\u2028\u2029\u202F\u205F\u3000]+',
-            '_',
-            title,
-        ).strip('_')
+        return category_info.category_key(category1) == category_info.category_key(category2)
 
     def summary(self, category_info: CategoryInfo) -> str:
-        return type(self).symbol + '[[' + category_info[0] + ':' + self.category + ']]'
+        return type(self).symbol + '[[' + category_info.name + ':' + self.category + ']]'
 
-    def cleanup(self) -> None:
-        self.category = self.category.replace('_', ' ')
+    def cleanup(self) -> Self:
+        if '_' not in self.category:
+            return self
+        return replace(self, category=self.category.replace('_', ' '))
 
     def __str__(self) -> str:
         return type(self).symbol + 'Category:' + self.category
 
 
-@dataclass
+@dataclass(frozen=True)
 class AddCategoryAction(CategoryAction):
     """An action to add a category to the wikitext of a page."""
 
+    __slots__ = ()
+
     symbol = '+'
 
-    def apply(self, wikitext: str, category_info: CategoryInfo) -> str:
-        wikicode = mwparserfromhell.parse(wikitext)
+    def apply_to_wikicode(self, wikicode: Wikicode, category_info: CategoryInfo) -> bool:
         last_category = None
         for wikilink in wikicode.ifilter_wikilinks():
             if not self._is_category(wikilink, category_info):
                 continue
+            original_wikilink = str(wikilink)
             if self._accept_category_link(wikilink, category_info):
-                return str(wikicode)
+                return str(wikilink) != original_wikilink  # the sort key may have been changed
             last_category = wikilink
         wikilink = self._make_category_link(category_info)
         if last_category:
@@ -106,22 +183,42 @@ class AddCategoryAction(CategoryAction):
             if wikicode:
                 wikicode.append('\n')
             wikicode.append(wikilink)
-        return str(wikicode)
+        return True
+
+    def apply_to_category_tail(self, category_tail: CategoryTail, category_info: CategoryInfo) -> bool:
+        last_category_index = None
+        for index, wikilink in enumerate(category_tail.nodes):
+            if not isinstance(wikilink, Wikilink) or not self._is_category(wikilink, category_info):
+                continue
+            original_wikilink = str(wikilink)
+            if self._accept_category_link(wikilink, category_info):
+                return str(wikilink) != original_wikilink
+            last_category_index = index
+        wikilink = self._make_category_link(category_info)
+        if last_category_index is not None:
+            category_tail.nodes[last_category_index + 1:last_category_index + 1] = ['\n', wikilink]
+        else:
+            if category_tail.head or any(category_tail.nodes):  # i.e. if str(category_tail), like `if wikicode` above
+                category_tail.nodes.append('\n')
+            category_tail.nodes.append(wikilink)
+        return True
 
     def _accept_category_link(self, wikilink: Wikilink, category_info: CategoryInfo) -> bool:
         return self._same_category(wikilink.title.split(':', 1)[1], self.category, category_info)
 
     def _make_category_link(self, category_info: CategoryInfo) -> Wikilink:
-        return Wikilink(category_info[0] + ':' + self.category)
+        return Wikilink(category_info.name + ':' + self.category)
 
     def is_minor(self) -> bool:
         return True
 
 
-@dataclass
+@dataclass(frozen=True)
 class AddCategoryAndSortKeyAction(AddCategoryAction):
     """An action to add a category to the wikitext of a page, including a sort key."""
 
+    __slots__ = ('sort_key',)
+
     sort_key_symbol: ClassVar[str] = ''
 
     sort_key: Optional[str]
@@ -131,30 +228,32 @@ class AddCategoryAndSortKeyAction(AddCategoryAction):
         assert self.sort_key != '', 'sort key cannot be the empty string'
 
     def summary(self, category_info: CategoryInfo) -> str:
-        return '+[[' + category_info[0] + ':' + self.category + '|' + \
-            category_info[0] + ':' + self.category + '|' + (self.sort_key or '') + ']]'
+        return '+[[' + category_info.name + ':' + self.category + '|' + \
+            category_info.name + ':' + self.category + '|' + (self.sort_key or '') + ']]'
 
     def __str__(self) -> str:
         return super().__str__() + type(self).sort_key_symbol + (self.sort_key or '')
 
 
-@dataclass
+@dataclass(frozen=True)
 class AddCategoryWithSortKeyAction(AddCategoryAndSortKeyAction):
     """An action to add a category with a certain sort key to the wikitext of a page.
 
     If no category link for that category exists yet, it is added with that sort key.
     If such a category link exists, with or without any sort key, no change is made."""
 
+    __slots__ = ()
+
     sort_key_symbol = '#'
 
     def _make_category_link(self, category_info: CategoryInfo) -> Wikilink:
         if not self.sort_key:
             return super()._make_category_link(category_info)
-        return Wikilink(category_info[0] + ':' + self.category,
+        return Wikilink(category_info.name + ':' + self.category,
                         self.sort_key)
 
 
-@dataclass
+@dataclass(frozen=True)
 class AddCategoryProvideSortKeyAction(AddCategoryAndSortKeyAction):
     """An action to provide a category with a certain sort key in the wikitext of a page.
 
@@ -162,6 +261,8 @@ class AddCategoryProvideSortKeyAction(AddCategoryAndSortKeyAction):
     If such a category link exists, but without a sort key, the sort key is added.
     If the existing category specifies a different sort key, no change is made."""
 
+    __slots__ = ()
+
     sort_key_symbol = '##'
 
     def _accept_category_link(self, wikilink: Wikilink, category_info: CategoryInfo) -> bool:
@@ -175,17 +276,19 @@ class AddCategoryProvideSortKeyAction(AddCategoryAndSortKeyAction):
     def _make_category_link(self, category_info: CategoryInfo) -> Wikilink:
         if not self.sort_key:
             return super()._make_category_link(category_info)
-        return Wikilink(category_info[0] + ':' + self.category,
+        return Wikilink(category_info.name + ':' + self.category,
                         self.sort_key)
 
 
-@dataclass
+@dataclass(frozen=True)
 class AddCategoryReplaceSortKeyAction(AddCategoryAndSortKeyAction):
     """An action to replace a category’s sort key in the wikitext of a page.
 
     If no category link for that category exists yet, it is added with that sort key.
     If such a category link exists, with or without any sort key, its sort key is replaced with the given one."""
 
+    __slots__ = ()
+
     sort_key_symbol = '###'
 
     def _accept_category_link(self, wikilink: Wikilink, category_info: CategoryInfo) -> bool:
@@ -196,18 +299,19 @@ class AddCategoryReplaceSortKeyAction(AddCategoryAndSortKeyAction):
             return False
 
     def _make_category_link(self, category_info: CategoryInfo) -> Wikilink:
-        return Wikilink(category_info[0] + ':' + self.category,
+        return Wikilink(category_info.name + ':' + self.category,
                         self.sort_key)
 
 
-@dataclass
+@dataclass(frozen=True)
 class RemoveCategoryAction(CategoryAction):
     """An action to remove a category from the wikitext of a page."""
 
+    __slots__ = ()
+
     symbol = '-'
 
-    def apply(self, wikitext: str, category_info: CategoryInfo) -> str:
-        wikicode = mwparserfromhell.parse(wikitext)
+    def apply_to_wikicode(self, wikicode: Wikicode, category_info: CategoryInfo) -> bool:
         for index, wikilink in enumerate(wikicode.nodes):
             if not isinstance(wikilink, Wikilink):
                 continue
@@ -225,8 +329,36 @@ class RemoveCategoryAction(CategoryAction):
                       node.value.startswith('\n')):
                     node.value = node.value[1:]
                 del wikicode.nodes[index]  # this should happen *after* the above blocks, otherwise the indices get confusing
-                break
-        return str(wikicode)
+                # drop text nodes that are now empty, so that later actions see the same nodes as after parsing the wikitext again
+                wikicode.nodes[:] = [node for node in wikicode.nodes
+                                     if not isinstance(node, mwparserfromhell.nodes.text.Text) or node.value]
+                return True
+        return False
+
+    def apply_to_category_tail(self, category_tail: CategoryTail, category_info: CategoryInfo) -> bool:
+        nodes = category_tail.nodes
+        for index, wikilink in enumerate(nodes):
+            if not isinstance(wikilink, Wikilink):
+                continue
+            if not self._is_category(wikilink, category_info):
+                continue
+            if self._reject_category_link(wikilink, category_info):
+                # same as in apply_to_wikicode; the node before the first one is the end of the head
+                if index-1 >= 0 and \
+                   isinstance(node := nodes[index-1], str) and \
+                   node.endswith('\n'):
+                    nodes[index-1] = node[:-1]
+                elif index == 0 and category_tail.head.endswith('\n'):
+                    category_tail.head = category_tail.head[:-1]
+                elif (index+1 < len(nodes) and
+                      isinstance(node := nodes[index+1], str) and
+                      node.startswith('\n')):
+                    nodes[index+1] = node[1:]
+                del nodes[index]
+                # same as in apply_to_wikicode
+                nodes[:] = [node for node in nodes if isinstance(node, Wikilink) or node]
+                return True
+        return False
 
     def _reject_category_link(self, wikilink: Wikilink, category_info: CategoryInfo) -> bool:
         return self._same_category(wikilink.title.split(':', 1)[1], self.category, category_info)
@@ -235,10 +367,12 @@ class RemoveCategoryAction(CategoryAction):
         return False
 
 
-@dataclass
+@dataclass(frozen=True)
 class RemoveCategoryWithSortKeyAction(RemoveCategoryAction):
     """An action to remove a category from the wikitext of a page if it matches a certain sort key."""
 
+    __slots__ = ('sort_key',)
+
     sort_key: Optional[str]
 
     def __post_init__(self) -> None:
@@ -250,8 +384,8 @@ class RemoveCategoryWithSortKeyAction(RemoveCategoryAction):
             wikilink.text == self.sort_key
 
     def summary(self, category_info: CategoryInfo) -> str:
-        return '-[[' + category_info[0] + ':' + self.category + '|' + \
-            category_info[0] + ':' + self.category + '|' + (self.sort_key or '') + ']]'
+        return '-[[' + category_info.name + ':' + self.category + '|' + \
+            category_info.name + ':' + self.category + '|' + (self.sort_key or '') + ']]'
 
     def __str__(self) -> str:
         return super().__str__() + '#' + (self.sort_key or '')
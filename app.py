@@ -2,7 +2,8 @@
 
 import bs4
 import cachetools
-from collections.abc import Callable, Iterator
+import click
+from collections.abc import Callable, Iterable, Iterator
 import datetime
 import flask
 from flask.typing import ResponseReturnValue as RRV
@@ -22,7 +23,7 @@ import warnings
 import werkzeug
 
 from batch import StoredBatch, OpenBatch
-from command import Command, CommandRecord, CommandPlan, CommandPending, CommandEdit, CommandNoop, CommandCreation, CommandFailure, CommandPageMissing, CommandTitleInvalid, CommandTitleInterwiki, CommandPageProtected, CommandPageBadContentFormat, CommandPageBadContentModel, CommandEditConflict, CommandMaxlagExceeded, CommandBlocked, CommandWikiReadOnly
+from command import Command, CommandRecord, CommandPlan, CommandPending, CommandFinish, CommandEdit, CommandNoop, CommandCreation, CommandFailure, CommandPageMissing, CommandTitleInvalid, CommandTitleInterwiki, CommandPageProtected, CommandPageBadContentFormat, CommandPageBadContentModel, CommandEditConflict, CommandMaxlagExceeded, CommandBlocked, CommandWikiReadOnly
 from init import user_agent, load_config, load_consumer_token, load_database_params
 from localuser import LocalUser
 from pagepile import load_pagepile, create_pagepile
@@ -30,7 +31,7 @@ import parse_wikitext
 import parse_tpsv
 from querytime import flush_querytime, slow_queries, query_summary
 from runner import Runner
-from store import BatchStore, PreferenceStore, WatchlistParam
+from store import BatchStore, PreferenceStore, TitleHtmlStore, WatchlistParam
 from timestamp import now, utc_timestamp_to_datetime
 
 
@@ -45,15 +46,17 @@ consumer_token = load_consumer_token(app.config)
 
 batch_store: BatchStore
 preference_store: PreferenceStore
+title_html_store: TitleHtmlStore
 database_params = load_database_params(app.config)
 if database_params is not None:
-    from database import DatabaseBatchStore, DatabasePreferenceStore
+    from database import DatabaseBatchStore, DatabasePreferenceStore, DatabaseTitleHtmlStore
     batch_store = DatabaseBatchStore(database_params, app)
     preference_store = DatabasePreferenceStore(batch_store)
+    title_html_store = DatabaseTitleHtmlStore(batch_store)
 
     def sometimes_flush_querytime() -> None:
         if random.randrange(128) == 0:
-            with cast(DatabaseBatchStore, batch_store)._connect() as connection:
+            with cast(DatabaseBatchStore, batch_store).connect() as connection:
                 flush_querytime(connection)
 
     class SometimesFlushQuerytimeMiddleware:
@@ -64,11 +67,18 @@ if database_params is not None:
             return werkzeug.wsgi.ClosingIterator(self.app(environ, start_response), sometimes_flush_querytime)
 
     app.wsgi_app = SometimesFlushQuerytimeMiddleware(app.wsgi_app)  # type: ignore # “cannot assign to a method”
+
+    @app.cli.command('recompute-status-counts')
+    @click.argument('batch_ids', nargs=-1, type=int)
+    def recompute_status_counts(batch_ids: tuple[int, ...]) -> None:
+        """Recompute the command status counts of the given batches (default: all batches)."""
+        cast(DatabaseBatchStore, batch_store).recompute_status_counts(list(batch_ids) or None)
 else:
-    from in_memory import InMemoryBatchStore, InMemoryPreferenceStore
+    from in_memory import InMemoryBatchStore, InMemoryPreferenceStore, InMemoryTitleHtmlStore
     print('No database configuration, using in-memory store (batches will be lost on every restart)')
     batch_store = InMemoryBatchStore()
     preference_store = InMemoryPreferenceStore()
+    title_html_store = InMemoryTitleHtmlStore()
 
 stewards_global_user_ids_cache = cachetools.TTLCache(maxsize=1, ttl=24*60*60)  # type: cachetools.TTLCache[Any, list[int]]
 stewards_global_user_ids_cache_lock = threading.RLock()
@@ -305,7 +315,45 @@ def render_local_user(local_user: LocalUser) -> Markup:
 def render_batch_title(batch: StoredBatch) -> Optional[Markup]:
     if not batch.title:
         return None
-    return parse_wikitext.parse_summary(anonymous_session(batch.domain), batch.title)
+    render_batch_titles([batch])
+    return flask.g.batch_title_htmls[(batch.domain, batch.title)]
+
+# stored batch titles are rendered again after this time,
+# so that e.g. red links turn blue eventually once the page has been created
+batch_title_html_max_age = datetime.timedelta(days=7)
+
+def render_batch_titles(batches: Iterable[StoredBatch]) -> None:
+    """Render the titles of the given batches for render_batch_title.
+
+    Titles are taken from the title_html_store if possible;
+    the remaining ones are rendered with concurrent API requests
+    (rather than one after another as the template is rendered)
+    and stored for later requests.
+    The HTML is remembered in flask.g for the rest of the request."""
+    title_htmls: dict[tuple[str, str], Markup] = flask.g.setdefault('batch_title_htmls', {})
+    titles = {(batch.domain, batch.title)
+              for batch in batches
+              if batch.title and (batch.domain, batch.title) not in title_htmls}
+    if not titles:
+        return
+    for domain_and_title, stored_title_html in title_html_store.get_title_htmls(titles, batch_title_html_max_age).items():
+        title_htmls[domain_and_title] = Markup(stored_title_html)
+    missing_titles = [domain_and_title for domain_and_title in titles if domain_and_title not in title_htmls]
+    if not missing_titles:
+        return
+
+    sessions = {domain: anonymous_session(domain) for domain, title in missing_titles}
+    rendered_title_htmls = parse_wikitext.parse_summaries([(sessions[domain], title) for domain, title in missing_titles])
+    new_title_htmls: dict[tuple[str, str], str] = {}
+    for (domain, title), title_html in zip(missing_titles, rendered_title_htmls):
+        if title_html is None:
+            # show the wikitext for now, and try to render it again next time
+            title_htmls[(domain, title)] = Markup.escape(title)
+        else:
+            title_htmls[(domain, title)] = title_html
+            new_title_htmls[(domain, title)] = title_html
+    if new_title_htmls and not app.config.get('READ_ONLY_REASON'):
+        title_html_store.set_title_htmls(new_title_htmls)
 
 @app.template_filter()
 def html_text(html: str | Markup) -> Markup:
@@ -338,10 +386,12 @@ def any_session(domain: str = 'meta.wikimedia.org') -> mwapi.Session:
 
 @app.route('/')
 def index() -> RRV:
+    batches = batch_store.get_batches_slice(offset=0, limit=10)
+    render_batch_titles(batches)
     return flask.render_template('index.html',
                                  default_domain=flask.session.get('default-domain', None),
                                  suggested_domains=flask.session.get('suggested-domains', []),
-                                 batches=batch_store.get_batches_slice(offset=0, limit=10),
+                                 batches=batches,
                                  read_only_reason=app.config.get('READ_ONLY_REASON'))
 
 @app.route('/batch/new/commands', methods=['POST'])
@@ -439,11 +489,11 @@ def new_batch_from_pagepile() -> RRV:
         return flask.render_template('new_batch_errort.html',
                                      message='The actions for this batch are missing.'), 400
     try:
-        batch = parse_tpsv.parse_batch('\n'.join([page + '|' + actions
-                                                  for page in pages]),
-                                       title=title,
-                                       default_resolve_redirects='default_resolve_redirects' in flask.request.form,
-                                       default_create_missing_page='default_create_missing_page' in flask.request.form)
+        batch = parse_tpsv.parse_pagepile_batch(pages,
+                                                actions,
+                                                title=title,
+                                                default_resolve_redirects='default_resolve_redirects' in flask.request.form,
+                                                default_create_missing_page='default_create_missing_page' in flask.request.form)
     except parse_tpsv.ParseBatchError as e:
         return flask.render_template('new_batch_error.html',
                                      message=str(e)), 400
@@ -456,8 +506,14 @@ def new_batch_from_pagepile() -> RRV:
 @app.route('/batch/')
 def batches() -> RRV:
     offset, limit = slice_from_args(flask.request.args)
+    after_id, before_id = keyset_from_args(flask.request.args)
+    batches = batch_store.get_batches_slice(offset=keyset_offset(offset, after_id, before_id),
+                                            limit=limit,
+                                            before_id=before_id,
+                                            after_id=after_id)
+    render_batch_titles(batches)
     return flask.render_template('batches.html',
-                                 batches=batch_store.get_batches_slice(offset=offset, limit=limit),
+                                 batches=batches,
                                  offset=offset,
                                  limit=limit,
                                  count=batch_store.get_batches_count())
@@ -505,6 +561,11 @@ def batch(id: int) -> RRV:
         flask.g.can_stop_background = False
 
     offset, limit = slice_from_args(flask.request.args)
+    after_id, before_id = keyset_from_args(flask.request.args)
+    command_records = batch.command_records.get_slice(keyset_offset(offset, after_id, before_id),
+                                                      limit,
+                                                      after_id=after_id,
+                                                      before_id=before_id)
 
     edit_group_link = None
     for edit_group_config in app.config.get('EDITGROUPS', {}).values():
@@ -518,8 +579,11 @@ def batch(id: int) -> RRV:
     return flask.render_template('batch.html',
                                  batch=batch,
                                  edit_group_link=edit_group_link,
+                                 command_records=command_records,
                                  offset=offset,
                                  limit=limit,
+                                 after_id=after_id,
+                                 before_id=before_id,
                                  read_only_reason=app.config.get('READ_ONLY_REASON'))
 
 @app.route('/batch/<int:id>/background_history')
@@ -636,33 +700,42 @@ def run_batch_slice(id: int) -> RRV:
     runner = Runner(session, watchlist_param, batch.title, summary_batch_link)
 
     offset, limit = slice_from_args(flask.request.form)
-    command_pendings = batch.command_records.make_plans_pending(offset, limit)
-
-    try:
-        runner.resolve_pages([command_pending.command.page for command_pending in command_pendings])
-        for command_pending in command_pendings:
-            for attempt in range(5):
-                command_finish = runner.run_command(command_pending)
-                if isinstance(command_finish, CommandFailure) and command_finish.can_retry_immediately():
-                    continue
-                else:
-                    break
-            batch.command_records.store_finish(command_finish)
-            if isinstance(command_finish, CommandFailure):
-                can_continue = command_finish.can_continue_batch()
-                if isinstance(can_continue, datetime.datetime):
-                    batch_store.suspend_background(batch, until=can_continue)
-                    break
-                elif not can_continue:
-                    batch_store.stop_background(batch)
-                    break
-    finally:
-        batch.command_records.make_pendings_planned([command_pending.id for command_pending in command_pendings])
-
-    return flask.redirect(flask.url_for('batch',
-                                        id=id,
-                                        offset=offset,
-                                        limit=limit))
+    after_id, before_id = keyset_from_args(flask.request.form)
+    command_pendings = batch.command_records.make_plans_pending(keyset_offset(offset, after_id, before_id),
+                                                                limit,
+                                                                after_id=after_id,
+                                                                before_id=before_id)
+
+    def run() -> Iterator[CommandFinish]:
+        stored_batch = cast(StoredBatch, batch)
+        try:
+            for command_finish in runner.run_commands(command_pendings):
+                # store each result right away, so that it isn’t lost if the worker dies
+                # (the edit has already been made, and the command would otherwise stay pending)
+                stored_batch.command_records.store_finish(command_finish)
+                yield command_finish
+                if isinstance(command_finish, CommandFailure):
+                    can_continue = command_finish.can_continue_batch()
+                    if isinstance(can_continue, datetime.datetime):
+                        batch_store.suspend_background(stored_batch, until=can_continue)
+                        break
+                    elif not can_continue:
+                        batch_store.stop_background(stored_batch)
+                        break
+        finally:
+            stored_batch.command_records.make_pendings_planned([command_pending.id for command_pending in command_pendings])
+
+    # stream the results as the commands are run, rather than redirecting at the end;
+    # long slices rely on the threaded gunicorn workers (see Procfile) not to be killed by the worker timeout.
+    # if the client disconnects, the generator is closed at the next yield:
+    # the results so far are stored and the remaining commands go back to being planned
+    return flask.stream_template('batch_run_slice.html',
+                                 batch=batch,
+                                 command_finishes=run(),
+                                 offset=offset,
+                                 limit=limit,
+                                 after_id=after_id,
+                                 before_id=before_id)
 
 @app.route('/batch/<int:id>/start_background', methods=['POST'])
 def start_batch_background(id: int) -> RRV:
@@ -694,10 +767,13 @@ def start_batch_background(id: int) -> RRV:
     batch_store.start_background(batch, session)
 
     offset, limit = slice_from_args(flask.request.form)
+    after_id, before_id = keyset_from_args(flask.request.form)
     return flask.redirect(flask.url_for('batch',
                                         id=id,
                                         offset=offset,
-                                        limit=limit))
+                                        limit=limit,
+                                        after=after_id,
+                                        before=before_id))
 
 @app.route('/batch/<int:id>/stop_background', methods=['POST'])
 def stop_batch_background(id: int) -> RRV:
@@ -726,10 +802,13 @@ def stop_batch_background(id: int) -> RRV:
     batch_store.stop_background(batch, session)
 
     offset, limit = slice_from_args(flask.request.form)
+    after_id, before_id = keyset_from_args(flask.request.form)
     return flask.redirect(flask.url_for('batch',
                                         id=id,
                                         offset=offset,
-                                        limit=limit))
+                                        limit=limit,
+                                        after=after_id,
+                                        before=before_id))
 
 @app.route('/preferences', methods=['GET', 'POST'])
 def preferences() -> RRV:
@@ -841,7 +920,9 @@ def query_times() -> RRV:
                                  since=since,
                                  until=until,
                                  slowest_queries=slowest_queries,
-                                 summary=summary)
+                                 summary=summary,
+                                 connection_pools={'regular': batch_store.connection_pool.stats(),
+                                                   'streaming': batch_store.streaming_connection_pool.stats()})
 
 
 def is_wikimedia_domain(domain: str) -> bool:
@@ -862,6 +943,32 @@ def slice_from_args(args: dict) -> tuple[int, int]:
 
     return offset, limit
 
+def keyset_from_args(args: dict) -> tuple[Optional[int], Optional[int]]:
+    """Get the after and before IDs for keyset pagination from the args.
+
+    At most one of them is set (after takes precedence over before).
+    Pagination links carry one of these IDs in addition to the offset,
+    so that deep pages don’t need to skip over all the earlier rows;
+    the offset is then only used to render the navigation."""
+    for name in ['after', 'before']:
+        try:
+            id = int(args[name])
+        except (KeyError, ValueError):
+            continue
+        if id < 0:
+            continue
+        if name == 'after':
+            return id, None
+        else:
+            return None, id
+    return None, None
+
+def keyset_offset(offset: int, after_id: Optional[int], before_id: Optional[int]) -> int:
+    """Get the offset to pass to the store along with the given IDs."""
+    if after_id is None and before_id is None:
+        return offset  # no ID, e.g. an old link: fall back to the offset
+    return 0
+
 @cachetools.cached(cache=stewards_global_user_ids_cache,
                    key=lambda: '#stewards',
                    lock=stewards_global_user_ids_cache_lock)
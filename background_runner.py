@@ -3,20 +3,27 @@
 
 import datetime
 import flask
+import mwapi  # type: ignore
 import os
 import pathlib
 import random
 import signal
+import socket
 import sys
+import threading
 import time
+import traceback
 from typing import Any
 
-from command import CommandFailure
+from batch import OpenBatch
+from command import CommandPending, CommandFailure, CommandMaxlagExceeded
 from database import DatabaseBatchStore, DatabasePreferenceStore
 from init import user_agent, load_config, load_consumer_token, load_database_params
 from querytime import flush_querytime
 from runner import Runner
+from scheduler import EditScheduler
 from store import WatchlistParam
+from timestamp import now
 
 
 config = flask.Config(os.path.dirname(__file__))
@@ -35,7 +42,10 @@ database_params = load_database_params(config)
 if database_params is None:
     print('No database configuration, cannot run in background')
     sys.exit(1)
+# each worker may use two connections at once (e.g. when a batch is closed while storing results)
+database_params.setdefault('pool_size', 2 * config.get('BACKGROUND_RUNNER_WORKERS', 1) + 2)
 batch_store = DatabaseBatchStore(database_params)
+batch_store.preload_strings()
 preference_store = DatabasePreferenceStore(batch_store)
 
 if 'READ_ONLY_REASON' in config:
@@ -44,56 +54,260 @@ if 'READ_ONLY_REASON' in config:
 
 
 stopped = False
+failed = False
 def on_sigterm(signalnum: int, frame: Any) -> None:
     global stopped
     stopped = True
-    print('Received SIGTERM, will stop once the current command is done', flush=True)
+    print('Received SIGTERM, will stop once the current commands are done', flush=True)
 signal.signal(signal.SIGTERM, on_sigterm)  # NOQA: E305 (no blank lines after function definition)
 
 
 health_check_path = pathlib.Path('/tmp/quickcategories-background-runner-healthy')
 
 
-while not stopped:
-    health_check_path.touch()
-    pending = batch_store.make_plan_pending_background(consumer_token, user_agent)
+# how many planned commands of a batch a worker claims at once
+background_window_size = config.get('BACKGROUND_RUNNER_WINDOW', 10)
+
+
+# the scheduler only limits the edits of this process,
+# so the configured rates are split evenly between the replicas of the background runner
+edit_rate = config.get('BACKGROUND_RUNNER_EDIT_RATE', {})
+replicas = config.get('BACKGROUND_RUNNER_REPLICAS', 1)
+scheduler = EditScheduler(domain_rate=edit_rate.get('per_wiki', 120) / 60 / replicas,
+                          user_rate=edit_rate.get('per_user', 60) / 60 / replicas)
+
+
+# how often the process checks (cheaply) whether a background run was started or a suspended one may continue;
+# one thread polls for the whole process and wakes up the idle workers (see wait_for_work),
+# so the number of workers doesn’t affect the idle load on the database
+background_poll_seconds = 1
+# how long an idle worker waits at most before trying to pick a command again anyway
+# (e.g. because another runner released or lost its lease on a batch, which the poller doesn’t notice)
+background_max_idle_seconds = 15
+
+
+# how often in a row a thread may fail (e.g. while the database or a wiki is unavailable)
+# before the whole process gives up (see stop_after_failure),
+# and how long the thread waits after each of those failures
+max_consecutive_failures = 5
+failure_delay_seconds = 10
+
+
+# how often the poller noticed that there might be new work for idle workers
+background_changes = 0
+background_changed = threading.Condition()
+
+
+def stop_after_failure(thread_name: str) -> None:
+    """Stop all workers after a thread failed unrecoverably with the exception currently being handled.
+
+    The workers stop once their current commands are done,
+    and the process then exits with an error, so that it is restarted
+    instead of running on with fewer workers."""
+    global stopped, failed
+    print('[%s] Failed, stopping all workers' % thread_name, flush=True)
+    traceback.print_exc()
+    stopped = True
+    failed = True
+
+
+def note_failure(thread_name: str, consecutive_failures: int) -> None:
+    """Log the exception currently being handled by a thread,
+    and wait a bit before the thread tries again.
+
+    If the thread failed too often in a row,
+    re-raise the exception instead (which should stop all workers)."""
+    if consecutive_failures >= max_consecutive_failures:
+        raise
+    print('[%s] Failed (%d times in a row), will try again' % (thread_name, consecutive_failures), flush=True)
+    traceback.print_exc()
+    time.sleep(failure_delay_seconds)
+
+
+def poll_background_changes() -> None:
+    """Increment background_changes whenever a background run was started
+    or a suspended background run may continue, until stopped,
+    notifying the workers waiting for it to change."""
+    global background_changes
+    consecutive_failures = 0
+    try:
+        background_sequence = batch_store.get_background_sequence()
+        next_background_wakeup = batch_store.get_next_background_wakeup()
+        while not stopped:
+            time.sleep(background_poll_seconds)
+            try:
+                new_background_sequence = batch_store.get_background_sequence()
+                new_next_background_wakeup = batch_store.get_next_background_wakeup()
+            except Exception:
+                consecutive_failures += 1
+                note_failure('poller', consecutive_failures)
+                continue
+            consecutive_failures = 0
+            # the next wakeup is no longer returned once it has passed
+            # (rather than as soon as it is reached, since suspensions are stored with a precision of one second)
+            woken_up = next_background_wakeup is not None and \
+                (new_next_background_wakeup is None or new_next_background_wakeup > next_background_wakeup)
+            if new_background_sequence != background_sequence or woken_up:
+                with background_changed:
+                    background_changes += 1
+                    background_changed.notify_all()
+            background_sequence = new_background_sequence
+            next_background_wakeup = new_next_background_wakeup
+    except Exception:
+        stop_after_failure('poller')
+
+
+def wait_for_work(seen_background_changes: int) -> None:
+    """Sleep until there might be a command to run again.
+
+    That is when the poller notices a change
+    (i.e. background_changes differs from the given one),
+    when the scheduler has budget again for a wiki or user it had skipped,
+    or at the latest after background_max_idle_seconds."""
+    deadline = time.monotonic() + background_max_idle_seconds
+    seconds_until_available = scheduler.seconds_until_available()
+    if seconds_until_available is not None:
+        deadline = min(deadline, time.monotonic() + seconds_until_available)
+    while not stopped and time.monotonic() < deadline:
+        health_check_path.touch()
+        with background_changed:
+            if background_changes != seen_background_changes:
+                return
+            # also wake up regularly to touch the health check file and notice when we’re stopped
+            background_changed.wait(max(min(background_poll_seconds, deadline - time.monotonic()), 0))
+
+
+def run_worker(lease_owner: str) -> None:
+    """Run background commands until stopped.
+
+    Each worker leases the batch of the commands it runs,
+    so several workers (in this process or others)
+    never run commands of the same batch concurrently.
+
+    If a worker fails with an exception, it logs it,
+    releases the commands it claimed, and carries on;
+    only if it fails too often in a row do all workers stop (see note_failure)."""
+    try:
+        run_worker_loop(lease_owner)
+    except Exception:
+        stop_after_failure(lease_owner)
+
+
+def run_worker_loop(lease_owner: str) -> None:
+    consecutive_failures = 0
+    while not stopped:
+        health_check_path.touch()
+        try:
+            run_worker_iteration(lease_owner)
+        except Exception:
+            consecutive_failures += 1
+            note_failure(lease_owner, consecutive_failures)
+        else:
+            consecutive_failures = 0
+
+
+def run_worker_iteration(lease_owner: str) -> None:
+    """Pick and run one window of commands, or wait for work if there is none."""
+    # read before picking, so we can’t miss any change
+    # (if the poller hasn’t seen a change yet, then either the pick sees it, or the poller sees it later)
+    with background_changed:
+        seen_background_changes = background_changes
+    pending = batch_store.make_plans_pending_background(consumer_token,
+                                                        user_agent,
+                                                        background_window_size,
+                                                        lease_owner,
+                                                        skip_domains=scheduler.exhausted_domains(),
+                                                        skip_global_user_ids=scheduler.exhausted_global_user_ids())
     if not pending:
         if random.randrange(16) == 0:
             with batch_store.connect() as connection:
                 flush_querytime(connection)
-        time.sleep(5)
-        continue
-    else:
-        if random.randrange(128) == 0:
-            with batch_store.connect() as connection:
-                flush_querytime(connection)
-    batch, command_pending, session = pending
+            print('[%s] Connection pool: %s' % (lease_owner, batch_store.connection_pool.stats()), flush=True)
+        wait_for_work(seen_background_changes)
+        return
+    if random.randrange(128) == 0:
+        with batch_store.connect() as connection:
+            flush_querytime(connection)
+    batch, command_pendings, session = pending
+    unfinished_ids = [command_pending.id for command_pending in command_pendings]
 
     try:
-        print('Running command %d of batch #%d... ' % (command_pending.id, batch.id), end='', flush=True)
+        run_window(lease_owner, batch, command_pendings, session, unfinished_ids)
+    finally:
+        batch.command_records.make_pendings_planned(unfinished_ids)
+        batch_store.release_background_lease(batch, lease_owner)
 
-        if 'SUMMARY_BATCH_LINK' in config:
-            summary_batch_link = config['SUMMARY_BATCH_LINK'].format(batch.id)
-        else:
-            summary_batch_link = None
-        watchlist_param = preference_store.get_watchlist_param(session) or WatchlistParam.preferences
-        runner = Runner(session, watchlist_param, batch.title, summary_batch_link)
 
+def run_window(lease_owner: str, batch: OpenBatch, command_pendings: list[CommandPending], session: mwapi.Session, unfinished_ids: list[int]) -> None:
+    """Run the claimed commands of a batch in order, for as long as that’s allowed.
+
+    The IDs of finished commands are removed from unfinished_ids
+    once their results have been stored."""
+    if 'SUMMARY_BATCH_LINK' in config:
+        summary_batch_link = config['SUMMARY_BATCH_LINK'].format(batch.id)
+    else:
+        summary_batch_link = None
+    watchlist_param = preference_store.get_watchlist_param(session) or WatchlistParam.preferences
+    runner = Runner(session, watchlist_param, batch.title, summary_batch_link)
+
+    # resolve all the pages at once, except for repeated pages,
+    # which must be resolved again after the earlier command edited them
+    pages = []
+    titles = set()
+    for command_pending in command_pendings:
+        if command_pending.command.page.title not in titles:
+            titles.add(command_pending.command.page.title)
+            pages.append(command_pending.command.page)
+    runner.resolve_pages(pages)
+
+    for index, command_pending in enumerate(command_pendings):
+        if stopped:
+            return
+        if index > 0:
+            if batch.domain in scheduler.exhausted_domains() or \
+               batch.local_user.global_user_id in scheduler.exhausted_global_user_ids():
+                return  # let other wikis and users have a turn
+        if not batch_store.renew_background_lease(batch, lease_owner):
+            return  # the background run was stopped or suspended meanwhile (possibly right after it was picked)
+        scheduler.take(batch.domain, batch.local_user.global_user_id)
+
+        print('[%s] Running command %d of batch #%d...' % (lease_owner, command_pending.id, batch.id), flush=True)
         for attempt in range(5):
             command_finish = runner.run_command(command_pending)
             if isinstance(command_finish, CommandFailure) and command_finish.can_retry_immediately():
                 continue
             else:
                 break
-        print(type(command_finish).__name__, flush=True)
+        print('[%s] %s' % (lease_owner, type(command_finish).__name__), flush=True)
+        # store each result right away, so that a crash of the process
+        # leaves at most the command that was just run pending, not the whole window
         batch.command_records.store_finish(command_finish)
+        unfinished_ids.remove(command_finish.id)
+        if isinstance(command_finish, CommandMaxlagExceeded):
+            # other batches on the same wiki should also wait
+            scheduler.pause_domain(batch.domain, (command_finish.retry_after - now()).total_seconds())
         if isinstance(command_finish, CommandFailure):
             can_continue = command_finish.can_continue_batch()
             if isinstance(can_continue, datetime.datetime):
                 batch_store.suspend_background(batch, until=can_continue)
+                return
             elif not can_continue:
                 batch_store.stop_background(batch)
-    finally:
-        batch.command_records.make_pendings_planned([command_pending.id])
+                return
+
 
+workers = [threading.Thread(target=run_worker,
+                            args=('%s:%d:%d' % (socket.gethostname(), os.getpid(), index),),
+                            name='worker-%d' % index)
+           for index in range(config.get('BACKGROUND_RUNNER_WORKERS', 1))]
+# a daemon thread, so that it doesn’t keep the process alive once the workers are done
+poller = threading.Thread(target=poll_background_changes, name='poller', daemon=True)
+poller.start()
+for worker in workers:
+    worker.start()
+for worker in workers:
+    worker.join()
+
+if failed:
+    sys.exit(1)
 print('Done.')
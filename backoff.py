@@ -0,0 +1,42 @@
+from collections.abc import Callable
+from dataclasses import dataclass, field
+import random
+import threading
+from typing import Optional
+
+
+@dataclass
+class AdaptiveBackoff:
+    """An exponential backoff policy with jitter, per host.
+
+    Each consecutive failure on a host (e.g. due to maxlag)
+    doubles the delay before the next attempt, starting at base seconds;
+    a success resets it. The delay is capped by the limit reported by
+    the server (e.g. the Retry-After header or the replication lag),
+    or by the default cap if the server reported nothing, and jittered
+    so that several runners don’t retry in lockstep.
+
+    The state is shared by everything using the same instance,
+    so that all batches on a host back off together;
+    the methods are thread-safe."""
+
+    base: float = 1
+    default_cap: float = 5
+    max_cap: float = 300
+    uniform: Callable[[float, float], float] = random.uniform  # for jitter
+    _failures: dict[str, int] = field(default_factory=dict, init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    def failure(self, host: str, reported_limit: Optional[float] = None) -> float:
+        """Record a failure on the given host and return the number of seconds to wait."""
+        with self._lock:
+            failures = self._failures.get(host, 0)
+            self._failures[host] = failures + 1
+        cap = min(max(reported_limit if reported_limit is not None else self.default_cap, self.base), self.max_cap)
+        delay = min(self.base * 2 ** min(failures, 32), cap)
+        return self.uniform(delay / 2, delay)
+
+    def success(self, host: str) -> None:
+        """Record a success on the given host, resetting its backoff."""
+        with self._lock:
+            self._failures.pop(host, None)
@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 from collections.abc import Iterator
+from typing import Optional
 
 from command import Command, CommandRecord, CommandPending, CommandFinish
 from page import Page
@@ -9,8 +10,14 @@ class BatchCommandRecords(ABC):
     """Accessor for the CommandRecords of a StoredBatch."""
 
     @abstractmethod
-    def get_slice(self, offset: int, limit: int) -> list[CommandRecord]:
-        """Get up to limit command records from the given offset."""
+    def get_slice(self, offset: int, limit: int, *, after_id: Optional[int] = None, before_id: Optional[int] = None) -> list[CommandRecord]:
+        """Get up to limit command records from the given offset.
+
+        If after_id or before_id is given, only command records with a higher or lower ID
+        are considered, the offset counting away from that ID;
+        with an offset of 0, this is keyset pagination,
+        which does not need to skip over all the command records of the earlier pages.
+        (before_id returns the command records closest to it, still in order.)"""
 
     @abstractmethod
     def get_summary(self) -> dict[type[CommandRecord], int]:
@@ -25,8 +32,10 @@ class BatchCommandRecords(ABC):
         """Get a stream of all the commands in a batch."""
 
     @abstractmethod
-    def make_plans_pending(self, offset: int, limit: int) -> list[CommandPending]:
-        """Mark up to limit command records from the given offset as pending and return them."""
+    def make_plans_pending(self, offset: int, limit: int, *, after_id: Optional[int] = None, before_id: Optional[int] = None) -> list[CommandPending]:
+        """Mark up to limit command records from the given offset as pending and return them.
+
+        The command records are selected like in get_slice."""
 
     @abstractmethod
     def make_pendings_planned(self, command_record_ids: list[int]) -> None:
@@ -1,14 +1,16 @@
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
 import datetime
+import mwparserfromhell
+from mwparserfromhell.wikicode import Wikicode
 from typing import Optional
 
-from action import Action
+from action import Action, CategoryTail
 from page import Page
 from siteinfo import CategoryInfo
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Command:
     """A list of actions to perform on a page."""
 
@@ -19,14 +21,34 @@ class Command:
         """Apply the actions of this command to the given wikitext and return
         the result as well as the actions together with the
         information whether they were a no-op or not.
+
+        If possible, all actions are applied to just the category links
+        at the end of the wikitext (see CategoryTail), without parsing it.
+        Otherwise, the wikitext is parsed again after each action that changed it
+        (but not after no-op actions), since a change can affect how the rest
+        of the wikitext is parsed (e.g. a line break added after a category link
+        in a heading ends that heading), and later actions must see the same
+        nodes as if they had been applied on their own.
         """
         actions = []
 
-        for action in self.actions:
-            new_wikitext = action.apply(wikitext, category_info)
-            actions.append((action, wikitext == new_wikitext))
-            wikitext = new_wikitext
+        if (category_tail := CategoryTail.split(wikitext, category_info)) is not None:
+            for action in self.actions:
+                changed = action.apply_to_category_tail(category_tail, category_info)
+                actions.append((action, not changed))
+            if all(noop for action, noop in actions):
+                return wikitext, actions  # no need to serialize the unchanged wikitext
+            return str(category_tail), actions
 
+        wikicode: Optional[Wikicode] = None
+        for action in self.actions:
+            if wikicode is None:
+                wikicode = mwparserfromhell.parse(wikitext)
+            changed = action.apply_to_wikicode(wikicode, category_info)
+            if changed:
+                wikitext = str(wikicode)
+                wikicode = None
+            actions.append((action, not changed))
         return wikitext, actions
 
     def cleanup(self) -> None:
@@ -36,8 +58,7 @@ class Command:
         normalization via the MediaWiki API.
         """
         self.page.cleanup()
-        for action in self.actions:
-            action.cleanup()
+        self.actions[:] = [action.cleanup() for action in self.actions]
 
     def actions_tpsv(self) -> str:
         return '|'.join([str(action) for action in self.actions])
@@ -50,6 +71,8 @@ class Command:
 class CommandRecord(ABC):
     """A command that was recorded in some store."""
 
+    __slots__ = ('id', 'command')
+
     id: int
     command: Command
 
@@ -57,6 +80,8 @@ class CommandRecord(ABC):
 class CommandPlan(CommandRecord):
     """A command that should be run in the future."""
 
+    __slots__ = ()
+
     def __str__(self) -> str:
         return str(self.command)
 
@@ -64,6 +89,8 @@ class CommandPlan(CommandRecord):
 class CommandPending(CommandRecord):
     """A command that is about to be run or currently running."""
 
+    __slots__ = ()
+
     def __str__(self) -> str:
         return str(self.command)
 
@@ -72,6 +99,8 @@ class CommandFinish(CommandRecord):
     """A command that was intended to be run at some point
     and should now no longer be run."""
 
+    __slots__ = ()
+
     def __str__(self) -> str:
         return '# ' + str(self.command)
 
@@ -79,11 +108,15 @@ class CommandFinish(CommandRecord):
 class CommandSuccess(CommandFinish):
     """A command that was successfully run."""
 
+    __slots__ = ()
+
 
 @dataclass(frozen=True)
 class CommandEdit(CommandSuccess):
     """A command that resulted in an edit on a page."""
 
+    __slots__ = ('base_revision', 'revision')
+
     base_revision: int
     revision: int
 
@@ -95,6 +128,8 @@ class CommandEdit(CommandSuccess):
 class CommandNoop(CommandSuccess):
     """A command that resulted in no change to a page."""
 
+    __slots__ = ('revision',)
+
     revision: Optional[int]  # None = page did not exist and the command would have resulted in empty wikitext
 
 
@@ -102,12 +137,16 @@ class CommandNoop(CommandSuccess):
 class CommandCreation(CommandSuccess):
     """A command that resulted in a previously page being created."""
 
+    __slots__ = ('revision',)
+
     revision: int
 
 
 class CommandFailure(CommandFinish):
     """A command that was not successfully run."""
 
+    __slots__ = ()
+
     @abstractmethod
     def can_retry_immediately(self) -> bool:
         """Whether it is okay to retry running this command immediately.
@@ -142,6 +181,8 @@ class CommandFailure(CommandFinish):
 class CommandPageMissing(CommandFailure):
     """A command that failed because the specified page was found to be missing at the time."""
 
+    __slots__ = ('curtimestamp',)
+
     curtimestamp: str
 
     def can_retry_immediately(self) -> bool:
@@ -161,6 +202,8 @@ class CommandTitleInvalid(CommandFailure):
     This also includes empty titles (which in the API output are absent,
     rather than reported as invalid)."""
 
+    __slots__ = ('curtimestamp',)
+
     curtimestamp: str
 
     def can_retry_immediately(self) -> bool:
@@ -177,6 +220,8 @@ class CommandTitleInvalid(CommandFailure):
 class CommandTitleInterwiki(CommandFailure):
     """A command that failed because the specified title was an interwiki link."""
 
+    __slots__ = ('curtimestamp',)
+
     curtimestamp: str
 
     def can_retry_immediately(self) -> bool:
@@ -193,6 +238,8 @@ class CommandTitleInterwiki(CommandFailure):
 class CommandPageProtected(CommandFailure):
     """A command that failed because the specified page was protected at the time."""
 
+    __slots__ = ('curtimestamp',)
+
     curtimestamp: str
 
     def can_retry_immediately(self) -> bool:
@@ -214,6 +261,8 @@ class CommandPageBadContentFormat(CommandFailure):
     QuickCategories only supports the text/x-wiki content format,
     and this is unlikely to ever change."""
 
+    __slots__ = ('content_format', 'content_model', 'revision')
+
     content_format: str
     content_model: str
     revision: int
@@ -238,6 +287,8 @@ class CommandPageBadContentModel(CommandFailure):
     as long as they use the text/x-wiki content format;
     an error of this kind can potentially be made supported later."""
 
+    __slots__ = ('content_format', 'content_model', 'revision')
+
     content_format: Optional[str]  # None = page did not exist and the API only told us the content model it would have, not its format
     content_model: str
     revision: Optional[int]  # None = page did not exist
@@ -255,6 +306,8 @@ class CommandPageBadContentModel(CommandFailure):
 class CommandEditConflict(CommandFailure):
     """A command that failed due to an edit conflict."""
 
+    __slots__ = ()
+
     def can_retry_immediately(self) -> bool:
         return True
 
@@ -269,6 +322,8 @@ class CommandEditConflict(CommandFailure):
 class CommandMaxlagExceeded(CommandFailure):
     """A command that failed because replication lag in the database cluster was too high."""
 
+    __slots__ = ('retry_after',)
+
     retry_after: datetime.datetime
 
     def can_retry_immediately(self) -> bool:
@@ -285,6 +340,8 @@ class CommandMaxlagExceeded(CommandFailure):
 class CommandBlocked(CommandFailure):
     """A command that failed because the user or IP address was blocked."""
 
+    __slots__ = ('auto', 'blockinfo')
+
     auto: bool
     blockinfo: Optional[dict]
 
@@ -305,6 +362,8 @@ class CommandBlocked(CommandFailure):
 class CommandWikiReadOnly(CommandFailure):
     """A command that failed because the wiki was in read-only mode."""
 
+    __slots__ = ('reason', 'retry_after')
+
     reason: Optional[str]
     retry_after: Optional[datetime.datetime]
 
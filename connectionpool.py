@@ -0,0 +1,210 @@
+from collections.abc import Callable, Generator
+import contextlib
+from dataclasses import dataclass, field
+import pymysql
+import threading
+import time
+from typing import Optional
+
+
+class ConnectionPoolTimeout(Exception):
+    """No connection of a ConnectionPool became available in time."""
+
+
+@dataclass
+class _PooledConnection:
+
+    connection: pymysql.connections.Connection
+    created: float
+    last_used: float
+
+
+@dataclass
+class ConnectionPool:
+    """A bounded pool of database connections.
+
+    Connections are reused, most recently used first,
+    so that most uses don’t need to set up a new connection.
+    A connection is closed instead of being reused
+    once it is older than max_lifetime or has been idle for longer than max_idle;
+    a connection that has been idle for longer than check_after
+    is pinged before it is reused.
+
+    When a connection is returned to the pool, its transaction is rolled back,
+    so that no snapshot or lock carries over to its next user.
+    (Writes must be committed before that, as usual.)
+    A connection that is returned because of an exception
+    (including an abandoned generator) is closed instead.
+
+    The pool is thread-safe,
+    so it can be shared by all the threads of a process."""
+
+    connect: Callable[[], pymysql.connections.Connection]
+    max_size: int = 8  # maximum number of open connections, idle or in use
+    max_lifetime: float = 60 * 60  # seconds
+    max_idle: float = 5 * 60  # seconds
+    check_after: float = 30  # seconds
+    timeout: float = 30  # seconds to wait for a connection when max_size connections are in use
+    clock: Callable[[], float] = time.monotonic
+    _idle: list[_PooledConnection] = field(default_factory=list, init=False, repr=False)
+    _in_use: dict[int, _PooledConnection] = field(default_factory=dict, init=False, repr=False)
+    _size: int = field(default=0, init=False, repr=False)  # idle + in use + being connected
+    _stats: dict[str, int] = field(default_factory=lambda: dict.fromkeys(['created', 'reused', 'closed', 'failed_checks', 'waits', 'timeouts'], 0), init=False, repr=False)
+    _condition: threading.Condition = field(default_factory=threading.Condition, init=False, repr=False)
+
+    @contextlib.contextmanager
+    def connection(self) -> Generator[pymysql.connections.Connection, None, None]:
+        """Use a connection from the pool for the duration of a with block."""
+        connection = self.acquire()
+        try:
+            yield connection
+        except BaseException:
+            self.release(connection, reusable=False)
+            raise
+        else:
+            self.release(connection)
+
+    def acquire(self) -> pymysql.connections.Connection:
+        """Take a connection from the pool, or open a new one.
+
+        Every acquired connection must be passed to release eventually.
+        Raises ConnectionPoolTimeout if the pool is exhausted for too long."""
+        deadline = self.clock() + self.timeout
+        while True:
+            pooled = self._take(deadline)
+            if pooled is None:
+                return self._open()
+            if self.clock() - pooled.last_used > self.check_after:
+                try:
+                    pooled.connection.ping(reconnect=False)
+                except pymysql.err.Error:
+                    with self._condition:
+                        self._stats['failed_checks'] += 1
+                    self._discard(pooled)
+                    continue
+            with self._condition:
+                self._stats['reused'] += 1
+                self._in_use[id(pooled.connection)] = pooled
+            return pooled.connection
+
+    def release(self, connection: pymysql.connections.Connection, reusable: bool = True) -> None:
+        """Return a connection to the pool.
+
+        If it is not reusable (e.g. after an error), it is closed instead."""
+        with self._condition:
+            pooled = self._in_use.pop(id(connection))
+        if reusable:
+            try:
+                connection.rollback()
+            except pymysql.err.Error:
+                reusable = False
+        now = self.clock()
+        if not reusable or now - pooled.created > self.max_lifetime:
+            self._discard(pooled)
+            return
+        pooled.last_used = now
+        with self._condition:
+            self._idle.append(pooled)
+            expired = self._evict(now)
+            self._condition.notify()
+        for expired_pooled in expired:
+            self._close(expired_pooled.connection)
+
+    def close_idle(self) -> None:
+        """Close all idle connections, e.g. before the process exits."""
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._stats['closed'] += len(idle)
+            self._condition.notify_all()
+        for pooled in idle:
+            self._close(pooled.connection)
+
+    def stats(self) -> dict[str, int]:
+        """Get metrics of the pool.
+
+        open, idle and in_use are the current numbers of connections;
+        the others count events since the pool was created:
+        connections created, reused and closed,
+        failed health checks, waits for a free connection,
+        and waits that ran into the timeout."""
+        with self._condition:
+            return {
+                'open': self._size,
+                'idle': len(self._idle),
+                'in_use': len(self._in_use),
+                **self._stats,
+            }
+
+    def _take(self, deadline: float) -> Optional[_PooledConnection]:
+        """Take an idle connection from the pool,
+        or reserve room for a new one (returning None),
+        waiting until one of them is possible."""
+        expired: list[_PooledConnection] = []
+        try:
+            with self._condition:
+                waited = False
+                while True:
+                    expired += self._evict(self.clock())
+                    if self._idle:
+                        return self._idle.pop()
+                    if self._size < self.max_size:
+                        self._size += 1
+                        return None
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise ConnectionPoolTimeout('no database connection available after %s seconds' % self.timeout)
+                    if not waited:
+                        self._stats['waits'] += 1
+                        waited = True
+                    self._condition.wait(remaining)
+        finally:
+            for expired_pooled in expired:
+                self._close(expired_pooled.connection)
+
+    def _evict(self, now: float) -> list[_PooledConnection]:
+        """Remove the idle connections that should no longer be reused.
+
+        Must be called with the lock held;
+        the caller must _close the returned connections (preferably without the lock),
+        though they no longer count towards max_size already."""
+        idle, expired = [], []
+        for pooled in self._idle:
+            if now - pooled.created > self.max_lifetime or now - pooled.last_used > self.max_idle:
+                expired.append(pooled)
+            else:
+                idle.append(pooled)
+        self._idle = idle
+        self._size -= len(expired)
+        self._stats['closed'] += len(expired)
+        return expired
+
+    def _open(self) -> pymysql.connections.Connection:
+        """Open a new connection, for which _take reserved room."""
+        try:
+            connection = self.connect()
+        except BaseException:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        now = self.clock()
+        with self._condition:
+            self._stats['created'] += 1
+            self._in_use[id(connection)] = _PooledConnection(connection, created=now, last_used=now)
+        return connection
+
+    def _discard(self, pooled: _PooledConnection) -> None:
+        """Close a connection that was taken out of the pool for good."""
+        with self._condition:
+            self._size -= 1
+            self._stats['closed'] += 1
+            self._condition.notify()
+        self._close(pooled.connection)
+
+    def _close(self, connection: pymysql.connections.Connection) -> None:
+        try:
+            connection.close()
+        except pymysql.err.Error:
+            pass  # already closed
@@ -1,27 +1,70 @@
-from collections.abc import Generator, Iterator, Sequence
+import cachetools
+from collections.abc import Collection, Generator, Iterator, Sequence
 import contextlib
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import datetime
 import flask
-import itertools
 import json
 import mwapi  # type: ignore
 import mwoauth  # type: ignore
+import operator
 import pymysql
+import requests
 import requests_oauthlib  # type: ignore
+import threading
 from typing import Any, Optional, cast
 
 from batch import NewBatch, StoredBatch, OpenBatch, ClosedBatch, BatchCommandRecords, BatchBackgroundRuns
 from command import Command, CommandPlan, CommandPending, CommandRecord, CommandFinish, CommandEdit, CommandNoop, CommandCreation, CommandFailure, CommandPageMissing, CommandTitleInvalid, CommandTitleInterwiki, CommandPageProtected, CommandPageBadContentFormat, CommandPageBadContentModel, CommandEditConflict, CommandMaxlagExceeded, CommandBlocked, CommandWikiReadOnly
+from connectionpool import ConnectionPool
 from localuser import LocalUser
 from page import Page
 import parse_tpsv
 from querytime import QueryTimingCursor, QueryTimingSSCursor
-from store import BatchStore, PreferenceStore, WatchlistParam, _local_user_from_session
+from store import BatchStore, PreferenceStore, TitleHtmlStore, WatchlistParam, _local_user_from_session
 from stringstore import StringTableStore
 from timestamp import now, datetime_to_utc_timestamp, utc_timestamp_to_datetime
 
 
+# sessions of background runs, reused across commands so that their connections
+# (and the CSRF tokens that the runner caches per user) don’t have to be set up again for each command
+_background_session_cache: cachetools.LRUCache[tuple[str, str], mwapi.Session] = cachetools.LRUCache(maxsize=256)
+_background_session_cache_lock = threading.RLock()
+# all background sessions share one connection pool,
+# so that different users’ commands on the same wiki can also reuse the same connections
+# (each request is authenticated separately, so this is safe)
+_background_http_adapter = requests.adapters.HTTPAdapter(pool_connections=64, pool_maxsize=16)
+
+
+def _background_session(domain: str, consumer_token: mwoauth.ConsumerToken, auth_data: dict, user_agent: str) -> mwapi.Session:
+    key = (domain, auth_data['resource_owner_key'])
+    with _background_session_cache_lock:
+        session = _background_session_cache.get(key)
+        if session is not None and \
+           session.session.auth.client.resource_owner_secret == auth_data['resource_owner_secret'] and \
+           session.session.auth.client.client_key == consumer_token.key:
+            return session
+        auth = requests_oauthlib.OAuth1(client_key=consumer_token.key, client_secret=consumer_token.secret,
+                                        resource_owner_key=auth_data['resource_owner_key'], resource_owner_secret=auth_data['resource_owner_secret'])
+        session = mwapi.Session(host='https://'+domain, auth=auth, user_agent=user_agent)
+        session.session.mount('https://', _background_http_adapter)
+        _background_session_cache[key] = session
+        return session
+
+
+def _keyset_condition(id_column_name: str, descending: bool, before_id: Optional[int], after_id: Optional[int]) -> tuple[str, str, tuple[int, ...]]:
+    """Get the WHERE condition, ORDER BY direction and parameters
+    for a slice of rows before or after the given ID (see BatchStore.get_batches_slice).
+
+    The rows closest to the ID come first in the returned order,
+    so the caller must reverse the results if the order differs from the requested one."""
+    if before_id is not None:
+        return '`%s` < %%s' % id_column_name, 'DESC', (before_id,)
+    if after_id is not None:
+        return '`%s` > %%s' % id_column_name, 'ASC', (after_id,)
+    return 'TRUE', 'DESC' if descending else 'ASC', ()
+
+
 class DatabaseBatchStore(BatchStore):
 
     _BATCH_STATUS_OPEN = 0
@@ -45,6 +88,7 @@ class DatabaseBatchStore(BatchStore):
 
     def __init__(self, connection_params: dict, app: Optional[flask.Flask] = None) -> None:
         connection_params.setdefault('charset', 'utf8mb4')
+        pool_size = connection_params.pop('pool_size', 8)
         if connection_params.pop('enable_querytime', False):
             self.connection_params = {
                 'cursorclass': cast(type[pymysql.cursors.Cursor], QueryTimingCursor),
@@ -63,41 +107,57 @@ class DatabaseBatchStore(BatchStore):
                 'cursorclass': pymysql.cursors.SSCursor,
                 **connection_params,
             }
+        # connections are shared by all threads (e.g. background runner workers) and app contexts (requests)
+        self.connection_pool = ConnectionPool(lambda: self._connect(), max_size=pool_size)
+        self.streaming_connection_pool = ConnectionPool(lambda: self._connect_streaming(), max_size=pool_size)
         self.app = app
         if app is not None:
             @app.teardown_appcontext
             def teardown_connection(exception: Optional[BaseException]) -> None:
                 connection = flask.g.pop('database_connection', None)
                 if connection is not None:
-                    connection.close()
+                    self.connection_pool.release(connection, reusable=exception is None)
         self.domain_store = StringTableStore('domain', 'domain_id', 'domain_hash', 'domain_name')
         self.title_store = StringTableStore('title', 'title_id', 'title_hash', 'title_text')
         self.actions_store = StringTableStore('actions', 'actions_id', 'actions_hash', 'actions_tpsv')
         self.local_user_store = _LocalUserStore(self.domain_store)
+        # counting all batches is a full index scan, so the count is cached for a short time
+        self._batches_count_cache: cachetools.TTLCache[str, int] = cachetools.TTLCache(maxsize=1, ttl=60)
+        self._batches_count_cache_lock = threading.RLock()
 
     @contextlib.contextmanager
     def connect(self) -> Generator[pymysql.connections.Connection, None, None]:
-        if self.app is not None:
+        if self.app is not None and flask.has_app_context():
+            # keep one connection for the whole app context, returned to the pool on teardown
             if 'database_connection' not in flask.g:
-                flask.g.database_connection = self._connect()
+                flask.g.database_connection = self.connection_pool.acquire()
             yield flask.g.database_connection
         else:
-            connection = self._connect()
-            try:
+            with self.connection_pool.connection() as connection:
                 yield connection
-            finally:
-                connection.close()
 
     def _connect(self) -> pymysql.connections.Connection:
         return pymysql.connect(**self.connection_params)
 
+    def _connect_streaming(self) -> pymysql.connections.Connection:
+        return pymysql.connect(**self.streaming_connection_params)
+
+    def preload_strings(self) -> None:
+        """Fill the in-memory caches of domains, titles and actions (see StringTableStore.preload_strings).
+
+        This is meant for long-running processes such as the background runner;
+        otherwise, the caches are filled as needed."""
+        with self.connect() as connection:
+            for string_store in [self.domain_store, self.title_store, self.actions_store]:
+                string_store.preload_strings(connection)
+            connection.commit()
+
     @contextlib.contextmanager
     def connect_streaming(self) -> Generator[pymysql.connections.Connection, None, None]:
-        connection = pymysql.connect(**self.streaming_connection_params)
-        try:
+        # if the stream is abandoned halfway, the connection is closed rather than reused,
+        # so that the rest of the results doesn’t need to be read first
+        with self.streaming_connection_pool.connection() as connection:
             yield connection
-        finally:
-            connection.close()
 
     def store_batch(self, new_batch: NewBatch, session: mwapi.Session) -> OpenBatch:
         created = now()
@@ -111,6 +171,8 @@ class DatabaseBatchStore(BatchStore):
             else:
                 title_id = None
             localuser_id = self.local_user_store.acquire_localuser_id(connection, local_user)
+            actions_tpsvs = [command.actions_tpsv() for command in new_batch.commands]
+            actions_ids = self.actions_store.acquire_ids(connection, actions_tpsvs)
             with connection.cursor() as cursor:
                 cursor.execute('INSERT INTO `batch` (`batch_localuser`, `batch_domain`, `batch_title`, `batch_created_utc_timestamp`, `batch_last_updated_utc_timestamp`, `batch_status`) VALUES (%s, %s, %s, %s, %s, %s)',
                                (localuser_id, domain_id, title_id, created_utc_timestamp, created_utc_timestamp, DatabaseBatchStore._BATCH_STATUS_OPEN))
@@ -118,10 +180,14 @@ class DatabaseBatchStore(BatchStore):
 
             with connection.cursor() as cursor:
                 cursor.executemany('INSERT INTO `command` (`command_batch`, `command_page_title`, `command_page_flags`, `command_actions`, `command_status`, `command_outcome`) VALUES (%s, %s, %s, %s, %s, NULL)',
-                                   [(batch_id, command.page.title, self._page_to_flags(command.page), self.actions_store.acquire_id(connection, command.actions_tpsv()), DatabaseBatchStore._COMMAND_STATUS_PLAN) for command in new_batch.commands])
+                                   [(batch_id, command.page.title, self._page_to_flags(command.page), actions_ids[actions_tpsv], DatabaseBatchStore._COMMAND_STATUS_PLAN) for command, actions_tpsv in zip(new_batch.commands, actions_tpsvs)])
+                self._update_status_counts(cursor, batch_id, {DatabaseBatchStore._COMMAND_STATUS_PLAN: len(new_batch.commands)})
 
             connection.commit()
 
+        with self._batches_count_cache_lock:
+            self._batches_count_cache.clear()
+
         return OpenBatch(batch_id,
                          local_user,
                          local_user.domain,
@@ -131,6 +197,56 @@ class DatabaseBatchStore(BatchStore):
                          _BatchCommandRecordsDatabase(batch_id, self),
                          _BatchBackgroundRunsDatabase(batch_id, local_user.domain, self))
 
+    def _update_status_counts(self, cursor: pymysql.cursors.Cursor, batch_id: int, deltas: dict[int, int]) -> None:
+        """Add the given deltas (per command status) to the command status counts of the batch.
+
+        This must happen in the same transaction as the changes to the commands themselves,
+        so that the counts are always consistent with the command table.
+        The rows are always upserted (and thus locked) in the order of their status,
+        regardless of the order of the deltas, so that concurrent transactions
+        (e.g. make_plans_pending and make_pendings_planned on the same batch)
+        can’t deadlock on them."""
+        deltas = {status: delta for status, delta in sorted(deltas.items()) if delta}
+        if not deltas:
+            return
+        cursor.execute('''INSERT INTO `batch_status_count` (`batch_status_count_batch`, `batch_status_count_status`, `batch_status_count_count`)
+                          VALUES %s
+                          ON DUPLICATE KEY UPDATE `batch_status_count_count` = `batch_status_count_count` + VALUES(`batch_status_count_count`)''' % ', '.join(['(%s, %s, %s)'] * len(deltas)),
+                       [value
+                        for status, delta in deltas.items()
+                        for value in (batch_id, status, delta)])
+
+    def recompute_status_counts(self, batch_ids: Optional[list[int]] = None) -> None:
+        """Recompute the command status counts of the given batches (default: all batches)
+        from the command table, in case they got out of sync somehow."""
+        if batch_ids is None:
+            with self.connect() as connection, connection.cursor() as cursor:
+                cursor.execute('SELECT `batch_id` FROM `batch` ORDER BY `batch_id` ASC')
+                batch_ids = [batch_id for (batch_id,) in cursor.fetchall()]
+                connection.commit()
+        # one transaction per chunk of batches, so that other writers aren’t blocked for too long
+        chunk_size = 100
+        for index in range(0, len(batch_ids), chunk_size):
+            chunk = batch_ids[index:index+chunk_size]
+            placeholders = ', '.join(['%s'] * len(chunk))
+            with self.connect() as connection, connection.cursor() as cursor:
+                # lock the commands first, like the other writers, so that no status changes are missed
+                cursor.execute('''SELECT COUNT(*)
+                                  FROM `command`
+                                  WHERE `command_batch` IN (%s)
+                                  FOR UPDATE''' % placeholders,
+                               chunk)
+                cursor.execute('''DELETE FROM `batch_status_count`
+                                  WHERE `batch_status_count_batch` IN (%s)''' % placeholders,
+                               chunk)
+                cursor.execute('''INSERT INTO `batch_status_count` (`batch_status_count_batch`, `batch_status_count_status`, `batch_status_count_count`)
+                                  SELECT `command_batch`, `command_status`, COUNT(*)
+                                  FROM `command`
+                                  WHERE `command_batch` IN (%s)
+                                  GROUP BY `command_batch`, `command_status`''' % placeholders,
+                               chunk)
+                connection.commit()
+
     def _page_to_flags(self, page: Page) -> int:
         flags = 0
         if page.resolve_redirects:
@@ -144,18 +260,45 @@ class DatabaseBatchStore(BatchStore):
         return flags
 
     def get_batch(self, id: int) -> Optional[StoredBatch]:
+        # also get the status counts and the last background run,
+        # which the batch page needs anyway, and prime the accessors with them
         with self.connect() as connection:
             with connection.cursor() as cursor:
-                cursor.execute('''SELECT `batch_id`, `localuser_user_name`, `localuser_local_user_id`, `localuser_global_user_id`, `domain_name`, `title_text`, `batch_created_utc_timestamp`, `batch_last_updated_utc_timestamp`, `batch_status`
+                cursor.execute('''SELECT `batch_id`, `creator`.`localuser_user_name`, `creator`.`localuser_local_user_id`, `creator`.`localuser_global_user_id`, `batch_domain`, `batch_title`, `batch_created_utc_timestamp`, `batch_last_updated_utc_timestamp`, `batch_status`,
+                                  (SELECT CAST(GROUP_CONCAT(`batch_status_count_status`, ':', `batch_status_count_count`) AS CHAR)
+                                   FROM `batch_status_count`
+                                   WHERE `batch_status_count_batch` = `batch_id`
+                                   AND `batch_status_count_count` > 0) AS `status_counts`,
+                                  `background_id`, `background_started_utc_timestamp`, `started`.`localuser_user_name`, `started`.`localuser_local_user_id`, `started`.`localuser_global_user_id`, `background_stopped_utc_timestamp`, `stopped`.`localuser_user_name`, `stopped`.`localuser_local_user_id`, `stopped`.`localuser_global_user_id`
                                   FROM `batch`
-                                  JOIN `domain` ON `batch_domain` = `domain_id`
-                                  JOIN `localuser` ON `batch_localuser` = `localuser_id`
-                                  LEFT JOIN `title` ON `batch_title` = `title_id`
+                                  JOIN `localuser` AS `creator` ON `batch_localuser` = `creator`.`localuser_id`
+                                  LEFT JOIN `background` ON `background_id` = (SELECT MAX(`background_id`) FROM `background` WHERE `background_batch` = `batch_id`)
+                                  LEFT JOIN `localuser` AS `started` ON `background_started_localuser` = `started`.`localuser_id`
+                                  LEFT JOIN `localuser` AS `stopped` ON `background_stopped_localuser` = `stopped`.`localuser_id`
                                   WHERE `batch_id` = %s''', (id,))
                 result = cursor.fetchone()
-        if not result:
-            return None
-        return self._result_to_batch(result)
+            if not result:
+                return None
+            [batch_result] = self._hydrate_batch_results(connection, [result[:9]])
+        batch = self._result_to_batch(batch_result)
+
+        status_counts, background_id, *background_run_row = result[9:]
+        command_records = cast(_BatchCommandRecordsDatabase, batch.command_records)
+        command_records._cache['summary'] = {int(status): int(count)
+                                             for status_count in (status_counts or '').split(',') if status_count
+                                             for status, count in [status_count.split(':')]}
+        background_runs = cast(_BatchBackgroundRunsDatabase, batch.background_runs)
+        if background_id is not None:
+            background_runs._cache['last'] = background_runs._row_to_background_run(*background_run_row)
+        else:
+            background_runs._cache['last'] = None
+        return batch
+
+    def _hydrate_batch_results(self, connection: pymysql.connections.Connection, results: Sequence[tuple]) -> list[tuple]:
+        """Replace the domain and title IDs in the given results with the strings (see StringTableStore.get_strings)."""
+        domains = self.domain_store.get_strings(connection, [result[4] for result in results])
+        titles = self.title_store.get_strings(connection, [result[5] for result in results if result[5] is not None])
+        return [(*result[:4], domains[result[4]], titles.get(result[5]), *result[6:]) for result in results]
 
     def _result_to_batch(self, result: tuple) -> StoredBatch:
         id, user_name, local_user_id, global_user_id, domain, title, created_utc_timestamp, last_updated_utc_timestamp, status = result
@@ -183,20 +326,25 @@ class DatabaseBatchStore(BatchStore):
         else:
             raise ValueError('Unknown batch type')
 
-    def get_batches_slice(self, offset: int, limit: int) -> Sequence[StoredBatch]:
+    def get_batches_slice(self, offset: int, limit: int, *, before_id: Optional[int] = None, after_id: Optional[int] = None) -> Sequence[StoredBatch]:
+        # with an ID, the primary key index lets the database start right there instead of skipping over earlier rows
+        where, order, params = _keyset_condition('batch_id', descending=True, before_id=before_id, after_id=after_id)
         with self.connect() as connection:
             with connection.cursor() as cursor:
-                cursor.execute('''SELECT `batch_id`, `localuser_user_name`, `localuser_local_user_id`, `localuser_global_user_id`, `domain_name`, `title_text`, `batch_created_utc_timestamp`, `batch_last_updated_utc_timestamp`, `batch_status`
+                cursor.execute('''SELECT `batch_id`, `localuser_user_name`, `localuser_local_user_id`, `localuser_global_user_id`, `batch_domain`, `batch_title`, `batch_created_utc_timestamp`, `batch_last_updated_utc_timestamp`, `batch_status`
                                   FROM `batch`
-                                  JOIN `domain` ON `batch_domain` = `domain_id`
                                   JOIN `localuser` ON `batch_localuser` = `localuser_id`
-                                  LEFT JOIN `title` ON `batch_title` = `title_id`
-                                  ORDER BY `batch_id` DESC
-                                  LIMIT %s
-                                  OFFSET %s''',
-                               (limit, offset))
-                return [self._result_to_batch(result) for result in cursor.fetchall()]
-
+                                  WHERE %s
+                                  ORDER BY `batch_id` %s
+                                  LIMIT %%s
+                                  OFFSET %%s''' % (where, order),
+                               (*params, limit, offset))
+                results = cursor.fetchall()
+            if order == 'ASC':
+                results = results[::-1]
+            return [self._result_to_batch(result) for result in self._hydrate_batch_results(connection, results)]
+
+    @cachetools.cachedmethod(operator.attrgetter('_batches_count_cache'), key=lambda self: '#batches', lock=operator.attrgetter('_batches_count_cache_lock'))
     def get_batches_count(self) -> int:
         with self.connect() as connection:
             with connection.cursor() as cursor:
@@ -207,7 +355,12 @@ class DatabaseBatchStore(BatchStore):
                 (count,) = result
         return count
 
+    def _forget_background_runs(self, batch: StoredBatch) -> None:
+        if isinstance(batch.background_runs, _BatchBackgroundRunsDatabase):
+            batch.background_runs._cache.clear()
+
     def start_background(self, batch: OpenBatch, session: mwapi.Session) -> None:
+        self._forget_background_runs(batch)
         started = now()
         started_utc_timestamp = datetime_to_utc_timestamp(started)
         local_user = _local_user_from_session(session)
@@ -238,6 +391,7 @@ class DatabaseBatchStore(BatchStore):
             connection.commit()
 
     def stop_background(self, batch: StoredBatch, session: Optional[mwapi.Session] = None) -> None:
+        self._forget_background_runs(batch)
         self._stop_background_by_id(batch.id, session)
 
     def _stop_background_by_id(self, batch_id: int, session: Optional[mwapi.Session] = None) -> None:
@@ -272,71 +426,178 @@ class DatabaseBatchStore(BatchStore):
             if cursor.rowcount > 1:
                 raise RuntimeError('Should have suspended at most 1 background run, actually affected %d!' % cursor.rowcount)
 
-    def make_plan_pending_background(self, consumer_token: mwoauth.ConsumerToken, user_agent: str) -> Optional[tuple[OpenBatch, CommandPending, mwapi.Session]]:
+    def get_background_sequence(self) -> int:
+        with self.connect() as connection, connection.cursor() as cursor:
+            cursor.execute('''SELECT MAX(`background_id`)
+                              FROM `background`''')
+            result = cursor.fetchone()
+            assert result, "MAX() must return a result"
+            (sequence,) = result
+        return sequence or 0
+
+    def get_next_background_wakeup(self) -> Optional[datetime.datetime]:
+        with self.connect() as connection, connection.cursor() as cursor:
+            cursor.execute('''SELECT MIN(`background_suspended_until_utc_timestamp`)
+                              FROM `background`
+                              WHERE `background_stopped_utc_timestamp` IS NULL
+                              AND `background_suspended_until_utc_timestamp` >= %s''',
+                           (datetime_to_utc_timestamp(now()),))
+            result = cursor.fetchone()
+            assert result, "MIN() must return a result"
+            (suspended_until_utc_timestamp,) = result
+        if suspended_until_utc_timestamp is None:
+            return None
+        return utc_timestamp_to_datetime(suspended_until_utc_timestamp)
+
+    def make_plans_pending_background(self,
+                                      consumer_token: mwoauth.ConsumerToken,
+                                      user_agent: str,
+                                      limit: int,
+                                      lease_owner: Optional[str] = None,
+                                      skip_domains: Collection[str] = frozenset(),
+                                      skip_global_user_ids: Collection[int] = frozenset()) -> Optional[tuple[OpenBatch, list[CommandPending], mwapi.Session]]:
         with self.connect() as connection:
-            # find a planned command and lock it
+            skip_conditions = ''
+            skip_params: list[int] = []
+            if skip_domains:
+                skip_conditions += '''
+                                  AND `batch_domain` NOT IN (''' + ', '.join(['%s'] * len(skip_domains)) + ')'
+                skip_params += [self.domain_store.acquire_id(connection, domain) for domain in skip_domains]
+            if skip_global_user_ids:
+                skip_conditions += '''
+                                  AND `batch_localuser` NOT IN (SELECT `localuser_id` FROM `localuser` WHERE `localuser_global_user_id` IN (''' + ', '.join(['%s'] * len(skip_global_user_ids)) + '))'
+                skip_params += skip_global_user_ids
+
+            # find the least recently updated batch with a planned command that is not leased to anyone else, and lock it;
+            # the command table is only probed per candidate batch via command_batch_status
+            # (checked by test_DatabaseBatchStore_make_plans_pending_background_explain),
+            # the backgrounds, batches and leases of the running batches are still joined and sorted,
+            # and FOR UPDATE locks all the rows read for that, not just the picked one
+            # (the suspension condition is written so that background_stopped_suspended_batch can be used as a range,
+            # and batch_last_updated_domain_localuser lets the optimizer scan batches in order instead, if that is cheaper)
             with connection.cursor() as cursor:
                 now_utc_timestamp = datetime_to_utc_timestamp(now())
-                cursor.execute('''SELECT `command_id`, `batch_id`
+                cursor.execute('''SELECT `batch_id`, `background_id`
                                   FROM `background`
                                   JOIN `batch` ON `background_batch` = `batch_id`
-                                  JOIN `command` ON `command_batch` = `batch_id`
+                                  LEFT JOIN `lease` ON `lease_batch` = `batch_id`
                                   WHERE `background_stopped_utc_timestamp` IS NULL
-                                  AND COALESCE(`background_suspended_until_utc_timestamp`, 0) < %s
-                                  AND `command_status` = %s
-                                  ORDER BY `batch_last_updated_utc_timestamp` ASC, `command_id` ASC
+                                  AND (`background_suspended_until_utc_timestamp` IS NULL OR `background_suspended_until_utc_timestamp` < %s)
+                                  AND (`lease_owner` IS NULL OR `lease_owner` = %s OR `lease_expires_utc_timestamp` < %s)
+                                  AND EXISTS (SELECT 1
+                                              FROM `command`
+                                              WHERE `command_batch` = `batch_id`
+                                              AND `command_status` = %s)''' + skip_conditions + '''
+                                  ORDER BY `batch_last_updated_utc_timestamp` ASC, `batch_id` ASC
                                   LIMIT 1
                                   FOR UPDATE''',
-                               (now_utc_timestamp, DatabaseBatchStore._COMMAND_STATUS_PLAN))
+                               (now_utc_timestamp, lease_owner, now_utc_timestamp, DatabaseBatchStore._COMMAND_STATUS_PLAN, *skip_params))
                 result = cursor.fetchone()
             if not result:
                 connection.commit()  # finish the FOR UPDATE
                 return None
+            (batch_id, background_id) = result
 
-            command_id = result[0]
-            batch_id = result[1]
+            # find and lock the first planned commands of that batch
+            # (command_batch_status implicitly includes the command_id, so this needs neither a filesort nor a table access)
+            with connection.cursor() as cursor:
+                cursor.execute('''SELECT `command_id`
+                                  FROM `command`
+                                  WHERE `command_batch` = %s
+                                  AND `command_status` = %s
+                                  ORDER BY `command_id` ASC
+                                  LIMIT %s
+                                  FOR UPDATE''',
+                               (batch_id, DatabaseBatchStore._COMMAND_STATUS_PLAN, limit))
+                command_ids = [command_id for (command_id,) in cursor.fetchall()]
+            if not command_ids:
+                connection.commit()  # the planned commands were just claimed by someone else (e.g. run_batch_slice)
+                return None
 
-            # make it pending
+            # lease the batch (in the same transaction, so no other runner can pick it in between)
+            if lease_owner is not None:
+                lease_expires_utc_timestamp = now_utc_timestamp + int(self.background_lease_duration.total_seconds())
+                with connection.cursor() as cursor:
+                    cursor.execute('''INSERT INTO `lease`
+                                      (`lease_batch`, `lease_owner`, `lease_expires_utc_timestamp`)
+                                      VALUES (%s, %s, %s)
+                                      ON DUPLICATE KEY UPDATE `lease_owner` = VALUES(`lease_owner`), `lease_expires_utc_timestamp` = VALUES(`lease_expires_utc_timestamp`)''',
+                                   (batch_id, lease_owner, lease_expires_utc_timestamp))
+
+            # make them pending
             with connection.cursor() as cursor:
                 cursor.execute('''UPDATE `command`
-                                  SET `command_status` = %s
-                                  WHERE `command_id` = %s AND `command_batch` = %s''',
-                               (DatabaseBatchStore._COMMAND_STATUS_PENDING, command_id, batch_id))
-            connection.commit()
-
-            # get the rest of the data now that we know we need it (without locking it)
+                                  SET `command_status` = %%s
+                                  WHERE `command_id` IN (%s) AND `command_batch` = %%s''' % ', '.join(['%s'] * len(command_ids)),
+                               (DatabaseBatchStore._COMMAND_STATUS_PENDING, *command_ids, batch_id))
+                self._update_status_counts(cursor, batch_id, {DatabaseBatchStore._COMMAND_STATUS_PLAN: -cursor.rowcount,
+                                                              DatabaseBatchStore._COMMAND_STATUS_PENDING: cursor.rowcount})
+
+            # get the rest of the data now that we know we need it, still in the same transaction
+            # (and by background ID, not by the conditions above, so that a stop or suspension
+            # right after the commit can’t make rows disappear; the lease renewal notices those)
             with connection.cursor() as cursor:
-                cursor.execute('''SELECT `batch_id`, `localuser_user_name`, `localuser_local_user_id`, `localuser_global_user_id`, `domain_name`, `title_text`, `batch_created_utc_timestamp`, `batch_last_updated_utc_timestamp`, `batch_status`, `background_auth`, `command_id`, `command_page_title`, `command_page_flags`, `actions_tpsv`
+                cursor.execute('''SELECT `batch_id`, `localuser_user_name`, `localuser_local_user_id`, `localuser_global_user_id`, `batch_domain`, `batch_title`, `batch_created_utc_timestamp`, `batch_last_updated_utc_timestamp`, `batch_status`, `background_auth`, `command_id`, `command_page_title`, `command_page_flags`, `command_actions`
                                   FROM `background`
                                   JOIN `batch` ON `background_batch` = `batch_id`
                                   JOIN `command` ON `command_batch` = `batch_id`
-                                  JOIN `domain` ON `batch_domain` = `domain_id`
-                                  JOIN `actions` ON `command_actions` = `actions_id`
                                   JOIN `localuser` ON `batch_localuser` = `localuser_id`
-                                  LEFT JOIN `title` ON `batch_title` = `title_id`
-                                  WHERE `command_id` = %s
-                                  AND `background_stopped_utc_timestamp` IS NULL
-                                  AND COALESCE(`background_suspended_until_utc_timestamp`, 0) < %s''',
-                               (command_id, now_utc_timestamp))
-                assert cursor.rowcount == 1
-                result = cursor.fetchone()
-                assert result is not None
-
-        auth_data = json.loads(result[9])
-        auth = requests_oauthlib.OAuth1(client_key=consumer_token.key, client_secret=consumer_token.secret,
-                                        resource_owner_key=auth_data['resource_owner_key'], resource_owner_secret=auth_data['resource_owner_secret'])
-        session = mwapi.Session(host='https://'+result[4], auth=auth, user_agent=user_agent)
-        command_pending = self._row_to_command_record(result[10],
-                                                      result[11],
-                                                      result[12],
-                                                      result[13],
-                                                      DatabaseBatchStore._COMMAND_STATUS_PENDING,
-                                                      outcome=None)
-        batch = self._result_to_batch(result[0:9])
+                                  WHERE `background_id` = %%s
+                                  AND `command_id` IN (%s)
+                                  ORDER BY `command_id` ASC''' % ', '.join(['%s'] * len(command_ids)),
+                               (background_id, *command_ids))
+                assert cursor.rowcount == len(command_ids)
+                results = cursor.fetchall()
+            connection.commit()
+            [batch_result] = self._hydrate_batch_results(connection, [results[0][0:9]])
+            actions_tpsvs = self.actions_store.get_strings(connection, [result[13] for result in results])
+
+        auth_data = json.loads(results[0][9])
+        session = _background_session(batch_result[4], consumer_token, auth_data, user_agent)
+        command_pendings = []
+        for result in results:
+            command_pending = self._row_to_command_record(result[10],
+                                                          result[11],
+                                                          result[12],
+                                                          actions_tpsvs[result[13]],
+                                                          DatabaseBatchStore._COMMAND_STATUS_PENDING,
+                                                          outcome=None)
+            assert isinstance(command_pending, CommandPending), "must be pending since we just set that status"
+            command_pendings.append(command_pending)
+        batch = self._result_to_batch(batch_result)
 
         assert isinstance(batch, OpenBatch), "must be open since at least one command is still pending"
-        assert isinstance(command_pending, CommandPending), "must be pending since we just set that status"
-        return batch, command_pending, session
+        return batch, command_pendings, session
+
+    def renew_background_lease(self, batch: StoredBatch, lease_owner: str) -> bool:
+        with self.connect() as connection, connection.cursor() as cursor:
+            now_utc_timestamp = datetime_to_utc_timestamp(now())
+            cursor.execute('''SELECT 1
+                              FROM `background`
+                              JOIN `lease` ON `lease_batch` = `background_batch`
+                              WHERE `background_batch` = %s
+                              AND `background_stopped_utc_timestamp` IS NULL
+                              AND (`background_suspended_until_utc_timestamp` IS NULL OR `background_suspended_until_utc_timestamp` < %s)
+                              AND `lease_owner` = %s
+                              FOR UPDATE''',
+                           (batch.id, now_utc_timestamp, lease_owner))
+            if not cursor.fetchone():
+                connection.commit()  # finish the FOR UPDATE
+                return False
+            cursor.execute('''UPDATE `lease`
+                              SET `lease_expires_utc_timestamp` = %s
+                              WHERE `lease_batch` = %s''',
+                           (now_utc_timestamp + int(self.background_lease_duration.total_seconds()), batch.id))
+            connection.commit()
+            return True
+
+    def release_background_lease(self, batch: StoredBatch, lease_owner: str) -> None:
+        with self.connect() as connection, connection.cursor() as cursor:
+            cursor.execute('''DELETE FROM `lease`
+                              WHERE `lease_batch` = %s
+                              AND `lease_owner` = %s''',
+                           (batch.id, lease_owner))
+            connection.commit()
 
     def _command_finish_to_row(self, command_finish: CommandFinish) -> tuple[int, dict]:
         status: int
@@ -410,7 +671,7 @@ class DatabaseBatchStore(BatchStore):
 
     def _row_to_command(self, page_title: str, page_flags: int, actions_tpsv: str) -> Command:
         return Command(self._row_to_page(page_title, page_flags),
-                       [parse_tpsv.parse_action(field) for field in actions_tpsv.split('|')])
+                       list(parse_tpsv.parse_actions(actions_tpsv)))
 
     def _row_to_command_record(self, id: int, page_title: str, page_flags: int, actions_tpsv: str, status: int, outcome: Optional[str]) -> CommandRecord:
         if outcome:
@@ -527,31 +788,53 @@ class DatabaseBatchStore(BatchStore):
 
 @dataclass(frozen=True)
 class _BatchCommandRecordsDatabase(BatchCommandRecords):
+    """Command records of a batch in the database.
+
+    The summary (status counts) is read at most once per accessor,
+    until the accessor itself changes any commands;
+    since batches are fetched again for each request,
+    this means at most once per request."""
 
     batch_id: int
     store: DatabaseBatchStore
+    _cache: dict[str, Any] = field(default_factory=dict, init=False, repr=False, compare=False)
 
-    def get_slice(self, offset: int, limit: int) -> list[CommandRecord]:
+    def get_slice(self, offset: int, limit: int, *, after_id: Optional[int] = None, before_id: Optional[int] = None) -> list[CommandRecord]:
+        where, order, params = _keyset_condition('command_id', descending=False, before_id=before_id, after_id=after_id)
         command_records = []
         with self.store.connect() as connection, connection.cursor() as cursor:
-            cursor.execute('''SELECT `command_id`, `command_page_title`, `command_page_flags`, `actions_tpsv`, `command_status`, `command_outcome`
+            cursor.execute('''SELECT `command_id`, `command_page_title`, `command_page_flags`, `command_actions`, `command_status`, `command_outcome`
                               FROM `command`
-                              JOIN `actions` ON `command_actions` = `actions_id`
-                              WHERE `command_batch` = %s
-                              ORDER BY `command_id` ASC
-                              LIMIT %s OFFSET %s''', (self.batch_id, limit, offset))
-            for id, page_title, page_flags, actions_tpsv, status, outcome in cursor.fetchall():
-                command_records.append(self.store._row_to_command_record(id, page_title, page_flags, actions_tpsv, status, outcome))
+                              WHERE `command_batch` = %%s
+                              AND %s
+                              ORDER BY `command_id` %s
+                              LIMIT %%s OFFSET %%s''' % (where, order), (self.batch_id, *params, limit, offset))
+            results = cursor.fetchall()
+            if order == 'DESC':
+                results = results[::-1]
+            actions_tpsvs = self.store.actions_store.get_strings(connection, [result[3] for result in results])
+        for id, page_title, page_flags, actions_id, status, outcome in results:
+            command_records.append(self.store._row_to_command_record(id, page_title, page_flags, actions_tpsvs[actions_id], status, outcome))
         return command_records
 
+    def _get_status_counts(self) -> dict[int, int]:
+        if 'summary' not in self._cache:
+            # read the counts maintained alongside the commands instead of counting all of them
+            with self.store.connect() as connection, connection.cursor() as cursor:
+                cursor.execute('''SELECT `batch_status_count_status`, `batch_status_count_count`
+                                  FROM `batch_status_count`
+                                  WHERE `batch_status_count_batch` = %s
+                                  AND `batch_status_count_count` > 0''',
+                               (self.batch_id,))
+                self._cache['summary'] = dict(cursor.fetchall())
+        return self._cache['summary']
+
     def get_summary(self) -> dict[type[CommandRecord], int]:
-        with self.store.connect() as connection, connection.cursor() as cursor:
-            cursor.execute('''SELECT `command_status`, COUNT(*) AS `count`
-                              FROM `command`
-                              WHERE `command_batch` = %s
-                              GROUP BY `command_status`''',
-                           (self.batch_id,))
-            return {self.store._status_to_command_record_type(status): count for status, count in cursor.fetchall()}
+        summary: dict[type[CommandRecord], int] = {}
+        for status, count in self._get_status_counts().items():
+            command_record_type = self.store._status_to_command_record_type(status)
+            summary[command_record_type] = summary.get(command_record_type, 0) + count
+        return summary
 
     def stream_pages(self) -> Iterator[Page]:
         with self.store.connect_streaming() as connection, cast(pymysql.cursors.SSCursor, connection.cursor()) as cursor:
@@ -575,14 +858,11 @@ class _BatchCommandRecordsDatabase(BatchCommandRecords):
                 yield self.store._row_to_command(page_title, page_flags, actions_tpsv)
 
     def __len__(self) -> int:
-        with self.store.connect() as connection, connection.cursor() as cursor:
-            cursor.execute('SELECT COUNT(*) FROM `command` WHERE `command_batch` = %s', (self.batch_id,))
-            result = cursor.fetchone()
-            assert result, "COUNT(*) must return a result"
-            (count,) = result
-        return count
+        return sum(self._get_status_counts().values())
 
-    def make_plans_pending(self, offset: int, limit: int) -> list[CommandPending]:
+    def make_plans_pending(self, offset: int, limit: int, *, after_id: Optional[int] = None, before_id: Optional[int] = None) -> list[CommandPending]:
+        where, order, params = _keyset_condition('command_id', descending=False, before_id=before_id, after_id=after_id)
+        self._cache.clear()
         with self.store.connect() as connection:
             command_ids: list[int] = []
 
@@ -594,13 +874,14 @@ class _BatchCommandRecordsDatabase(BatchCommandRecords):
                                   WHERE `command_id` IN ( SELECT * FROM (
                                     SELECT `command_id`
                                     FROM `command`
-                                    WHERE `command_batch` = %s
-                                    ORDER BY `command_id` ASC
-                                    LIMIT %s OFFSET %s
+                                    WHERE `command_batch` = %%s
+                                    AND %s
+                                    ORDER BY `command_id` %s
+                                    LIMIT %%s OFFSET %%s
                                   ) AS temporary_table)
-                                  AND `command_status` = %s
+                                  AND `command_status` = %%s
                                   ORDER BY `command_id` ASC
-                                  FOR UPDATE''', (self.batch_id, limit, offset, DatabaseBatchStore._COMMAND_STATUS_PLAN))
+                                  FOR UPDATE''' % (where, order), (self.batch_id, *params, limit, offset, DatabaseBatchStore._COMMAND_STATUS_PLAN))
                 for (command_id,) in cursor.fetchall():
                     command_ids.append(command_id)
 
@@ -609,25 +890,26 @@ class _BatchCommandRecordsDatabase(BatchCommandRecords):
                 return []
 
             with connection.cursor() as cursor:
-                cursor.executemany('''UPDATE `command`
-                                      SET `command_status` = %s
-                                      WHERE `command_id` = %s AND `command_batch` = %s''',
-                                   zip(itertools.repeat(DatabaseBatchStore._COMMAND_STATUS_PENDING),
-                                       command_ids,
-                                       itertools.repeat(self.batch_id)))
+                cursor.execute('''UPDATE `command`
+                                  SET `command_status` = %%s
+                                  WHERE `command_id` IN (%s) AND `command_batch` = %%s''' % ', '.join(['%s'] * len(command_ids)),
+                               (DatabaseBatchStore._COMMAND_STATUS_PENDING, *command_ids, self.batch_id))
+                self.store._update_status_counts(cursor, self.batch_id, {DatabaseBatchStore._COMMAND_STATUS_PLAN: -cursor.rowcount,
+                                                                         DatabaseBatchStore._COMMAND_STATUS_PENDING: cursor.rowcount})
             connection.commit()
 
             command_records = []
             with connection.cursor() as cursor:
-                cursor.execute('''SELECT `command_id`, `command_page_title`, `command_page_flags`, `actions_tpsv`, `command_status`, `command_outcome`
+                cursor.execute('''SELECT `command_id`, `command_page_title`, `command_page_flags`, `command_actions`, `command_status`, `command_outcome`
                                   FROM `command`
-                                  JOIN `actions` ON `command_actions` = `actions_id`
                                   WHERE `command_id` IN (%s)''' % ', '.join(['%s'] * len(command_ids)),
                                command_ids)
-            for id, page_title, page_flags, actions_tpsv, status, outcome in cursor.fetchall():
+                results = cursor.fetchall()
+            actions_tpsvs = self.store.actions_store.get_strings(connection, [result[3] for result in results])
+            for id, page_title, page_flags, actions_id, status, outcome in results:
                 assert status == DatabaseBatchStore._COMMAND_STATUS_PENDING
                 assert outcome is None
-                command_record = self.store._row_to_command_record(id, page_title, page_flags, actions_tpsv, status, outcome)
+                command_record = self.store._row_to_command_record(id, page_title, page_flags, actions_tpsvs[actions_id], status, outcome)
                 assert isinstance(command_record, CommandPending)
                 command_records.append(command_record)
         return command_records
@@ -635,23 +917,42 @@ class _BatchCommandRecordsDatabase(BatchCommandRecords):
     def make_pendings_planned(self, command_record_ids: list[int]) -> None:
         if not command_record_ids:
             return
+        self._cache.clear()
 
         with self.store.connect() as connection, connection.cursor() as cursor:
             cursor.execute('''UPDATE `command`
                               SET `command_status` = %%s
                               WHERE `command_id` IN (%s)
+                              AND `command_batch` = %%s
                               AND `command_status` = %%s''' % ', '.join(['%s'] * len(command_record_ids)),
                            [DatabaseBatchStore._COMMAND_STATUS_PLAN,
                             *command_record_ids,
+                            self.batch_id,
                             DatabaseBatchStore._COMMAND_STATUS_PENDING])
+            self.store._update_status_counts(cursor, self.batch_id, {DatabaseBatchStore._COMMAND_STATUS_PENDING: -cursor.rowcount,
+                                                                     DatabaseBatchStore._COMMAND_STATUS_PLAN: cursor.rowcount})
             connection.commit()
 
     def store_finish(self, command_finish: CommandFinish) -> None:
+        self._cache.clear()
         last_updated = now()
         last_updated_utc_timestamp = datetime_to_utc_timestamp(last_updated)
         status, outcome = self.store._command_finish_to_row(command_finish)
+        retry = isinstance(command_finish, CommandFailure) and command_finish.can_retry_later()
 
         with self.store.connect() as connection, connection.cursor() as cursor:
+            # lock the command and get its old status, to update the status counts
+            cursor.execute('''SELECT `command_status`
+                              FROM `command`
+                              WHERE `command_id` = %s AND `command_batch` = %s
+                              FOR UPDATE''',
+                           (command_finish.id, self.batch_id))
+            status_deltas: dict[int, int] = {}
+            for (old_status,) in cursor.fetchall():
+                status_deltas[old_status] = status_deltas.get(old_status, 0) - 1
+                status_deltas[status] = status_deltas.get(status, 0) + 1
+            if retry:
+                status_deltas[DatabaseBatchStore._COMMAND_STATUS_PLAN] = status_deltas.get(DatabaseBatchStore._COMMAND_STATUS_PLAN, 0) + 1
             cursor.execute('''UPDATE `command`
                               SET `command_status` = %s, `command_outcome` = %s
                               WHERE `command_id` = %s AND `command_batch` = %s''',
@@ -659,10 +960,9 @@ class _BatchCommandRecordsDatabase(BatchCommandRecords):
             cursor.execute('''UPDATE `batch`
                               SET `batch_last_updated_utc_timestamp` = %s
                               WHERE `batch_id` = %s''', (last_updated_utc_timestamp, self.batch_id))
-            connection.commit()
+            self.store._update_status_counts(cursor, self.batch_id, status_deltas)
 
-            if isinstance(command_finish, CommandFailure) and \
-               command_finish.can_retry_later():
+            if retry:
                 # append a fresh plan for the same command
                 cursor.execute('''INSERT INTO `command`
                                   (`command_batch`, `command_page_title`, `command_page_flags`, `command_actions`, `command_status`, `command_outcome`)
@@ -679,12 +979,15 @@ class _BatchCommandRecordsDatabase(BatchCommandRecords):
             else:
                 # close the batch if no planned or pending commands are left in it
                 cursor.execute('''SELECT 1
-                                  FROM `command`
-                                  WHERE `command_batch` = %s
-                                  AND `command_status` IN (%s, %s)
+                                  FROM `batch_status_count`
+                                  WHERE `batch_status_count_batch` = %s
+                                  AND `batch_status_count_status` IN (%s, %s)
+                                  AND `batch_status_count_count` > 0
                                   LIMIT 1''',
                                (self.batch_id, DatabaseBatchStore._COMMAND_STATUS_PLAN, DatabaseBatchStore._COMMAND_STATUS_PENDING))
-                if not cursor.fetchone():
+                if cursor.fetchone():
+                    connection.commit()
+                else:
                     cursor.execute('''UPDATE `batch`
                                       SET `batch_status` = %s
                                       WHERE `batch_id` = %s''',
@@ -700,12 +1003,20 @@ class _BatchCommandRecordsDatabase(BatchCommandRecords):
 
 @dataclass(frozen=True)
 class _BatchBackgroundRunsDatabase(BatchBackgroundRuns):
+    """Background runs of a batch in the database.
+
+    The last background run is read at most once per accessor,
+    until the background run is started or stopped through the store
+    (like the summary of _BatchCommandRecordsDatabase)."""
 
     batch_id: int
     domain: str
     store: DatabaseBatchStore
+    _cache: dict[str, Any] = field(default_factory=dict, init=False, repr=False, compare=False)
 
     def currently_running(self) -> bool:
+        if 'last' in self._cache:
+            return super().currently_running()
         with self.store.connect() as connection, connection.cursor() as cursor:
             cursor.execute('''SELECT 1
                               FROM `background`
@@ -733,6 +1044,11 @@ class _BatchBackgroundRunsDatabase(BatchBackgroundRuns):
         return (background_start, background_stop)
 
     def get_last(self) -> Optional[tuple[tuple[datetime.datetime, LocalUser], Optional[tuple[datetime.datetime, Optional[LocalUser]]]]]:
+        if 'last' not in self._cache:
+            self._cache['last'] = self._select_last()
+        return self._cache['last']
+
+    def _select_last(self) -> Optional[tuple[tuple[datetime.datetime, LocalUser], Optional[tuple[datetime.datetime, Optional[LocalUser]]]]]:
         with self.store.connect() as connection, connection.cursor() as cursor:
             cursor.execute('''SELECT `background_started_utc_timestamp`, `started`.`localuser_user_name`, `started`.`localuser_local_user_id`, `started`.`localuser_global_user_id`, `background_stopped_utc_timestamp`, `stopped`.`localuser_user_name`, `stopped`.`localuser_local_user_id`, `stopped`.`localuser_global_user_id`
                               FROM `background`
@@ -831,3 +1147,49 @@ class DatabasePreferenceStore(PreferenceStore):
                               ON DUPLICATE KEY UPDATE `preference_value` = %s''',
                            (local_user.global_user_id, DatabasePreferenceStore._PREFERENCE_WATCHLIST_PARAM, value.value, value.value))
             connection.commit()
+
+
+class DatabaseTitleHtmlStore(TitleHtmlStore):
+
+    def __init__(self, store: DatabaseBatchStore) -> None:
+        self.store = store  # to avoid duplicating connect() and the string stores
+
+    def get_title_htmls(self, titles: Collection[tuple[str, str]], max_age: datetime.timedelta) -> dict[tuple[str, str], str]:
+        if not titles:
+            return {}
+        min_rendered_utc_timestamp = datetime_to_utc_timestamp(now() - max_age)
+        with self.store.connect() as connection:
+            # only look up the IDs, a title whose strings aren’t stored yet can’t be cached either
+            domain_ids = self.store.domain_store.find_ids(connection, [domain for domain, title in titles])
+            title_ids = self.store.title_store.find_ids(connection, [title for domain, title in titles])
+            titles_by_ids = {(domain_ids[domain], title_ids[title]): (domain, title)
+                             for domain, title in titles
+                             if domain in domain_ids and title in title_ids}
+            if not titles_by_ids:
+                return {}
+            with connection.cursor() as cursor:
+                cursor.execute('''SELECT `title_html_domain`, `title_html_title`, `title_html_html`
+                                  FROM `title_html`
+                                  WHERE (`title_html_domain`, `title_html_title`) IN (%s)
+                                  AND `title_html_rendered_utc_timestamp` >= %%s''' % ', '.join(['(%s, %s)'] * len(titles_by_ids)),
+                               [*(id for ids in titles_by_ids for id in ids), min_rendered_utc_timestamp])
+                return {titles_by_ids[(domain_id, title_id)]: title_html
+                        for domain_id, title_id, title_html in cursor.fetchall()}
+
+    def set_title_htmls(self, title_htmls: dict[tuple[str, str], str]) -> None:
+        if not title_htmls:
+            return
+        rendered_utc_timestamp = datetime_to_utc_timestamp(now())
+        with self.store.connect() as connection:
+            domain_ids = self.store.domain_store.acquire_ids(connection, [domain for domain, title in title_htmls])
+            title_ids = self.store.title_store.acquire_ids(connection, [title for domain, title in title_htmls])
+            with connection.cursor() as cursor:
+                cursor.execute('''INSERT INTO `title_html`
+                                  (`title_html_domain`, `title_html_title`, `title_html_html`, `title_html_rendered_utc_timestamp`)
+                                  VALUES %s
+                                  ON DUPLICATE KEY UPDATE `title_html_html` = VALUES(`title_html_html`),
+                                  `title_html_rendered_utc_timestamp` = VALUES(`title_html_rendered_utc_timestamp`)''' % ', '.join(['(%s, %s, %s, %s)'] * len(title_htmls)),
+                               [value
+                                for (domain, title), title_html in title_htmls.items()
+                                for value in (domain_ids[domain], title_ids[title], title_html, rendered_utc_timestamp)])
+            connection.commit()
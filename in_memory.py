@@ -1,4 +1,4 @@
-from collections.abc import Iterator, Sequence
+from collections.abc import Collection, Iterator, Sequence
 from dataclasses import dataclass
 import datetime
 import mwapi  # type: ignore
@@ -11,7 +11,8 @@ from batch_command_records import BatchCommandRecords
 from command import Command, CommandPlan, CommandPending, CommandRecord, CommandFinish, CommandFailure
 from localuser import LocalUser
 from page import Page
-from store import BatchStore, PreferenceStore, WatchlistParam, _local_user_from_session
+from parse_tpsv import parse_actions
+from store import BatchStore, PreferenceStore, TitleHtmlStore, WatchlistParam, _local_user_from_session
 from timestamp import now
 
 
@@ -23,6 +24,8 @@ class InMemoryBatchStore(BatchStore):
         self.batches: dict[int, StoredBatch] = {}
         self.background_sessions: dict[int, mwapi.Session] = {}
         self.background_suspensions: dict[int, datetime.datetime] = {}
+        self.background_leases: dict[int, tuple[str, datetime.datetime]] = {}
+        self.background_sequence = 0
 
     def store_batch(self, new_batch: NewBatch, session: mwapi.Session) -> OpenBatch:
         created = now()
@@ -30,6 +33,8 @@ class InMemoryBatchStore(BatchStore):
 
         command_plans: list[CommandRecord] = []
         for command in new_batch.commands:
+            # share identical actions between commands, like the database store does
+            command = Command(command.page, list(parse_actions(command.actions_tpsv())))
             command_plans.append(CommandPlan(self.next_command_id, command))
             self.next_command_id += 1
 
@@ -64,8 +69,13 @@ class InMemoryBatchStore(BatchStore):
             self.batches[id] = stored_batch
         return stored_batch
 
-    def get_batches_slice(self, offset: int, limit: int) -> Sequence[StoredBatch]:
-        return [cast(StoredBatch, self.get_batch(id)) for id in sorted(self.batches.keys(), reverse=True)[offset:offset+limit]]
+    def get_batches_slice(self, offset: int, limit: int, *, before_id: Optional[int] = None, after_id: Optional[int] = None) -> Sequence[StoredBatch]:
+        if after_id is not None:
+            ids = sorted(id for id in self.batches.keys() if id > after_id)[offset:offset+limit]
+            ids.reverse()
+        else:
+            ids = sorted((id for id in self.batches.keys() if before_id is None or id < before_id), reverse=True)[offset:offset+limit]
+        return [cast(StoredBatch, self.get_batch(id)) for id in ids]
 
     def get_batches_count(self) -> int:
         return len(self.batches)
@@ -77,6 +87,7 @@ class InMemoryBatchStore(BatchStore):
         if not background_runs.currently_running():
             background_runs.background_runs.append(((started, local_user), None))
             self.background_sessions[batch.id] = session
+            self.background_sequence += 1
 
     def stop_background(self, batch: StoredBatch, session: Optional[mwapi.Session] = None) -> None:
         stopped = now()
@@ -94,26 +105,69 @@ class InMemoryBatchStore(BatchStore):
     def suspend_background(self, batch: StoredBatch, until: datetime.datetime) -> None:
         self.background_suspensions[batch.id] = until
 
-    def make_plan_pending_background(self, consumer_token: mwoauth.ConsumerToken, user_agent: str) -> Optional[tuple[OpenBatch, CommandPending, mwapi.Session]]:
+    def get_background_sequence(self) -> int:
+        return self.background_sequence
+
+    def get_next_background_wakeup(self) -> Optional[datetime.datetime]:
+        current = now()
+        return min((until for until in self.background_suspensions.values() if until >= current), default=None)
+
+    def make_plans_pending_background(self,
+                                      consumer_token: mwoauth.ConsumerToken,
+                                      user_agent: str,
+                                      limit: int,
+                                      lease_owner: Optional[str] = None,
+                                      skip_domains: Collection[str] = frozenset(),
+                                      skip_global_user_ids: Collection[int] = frozenset()) -> Optional[tuple[OpenBatch, list[CommandPending], mwapi.Session]]:
         batches_by_last_updated = sorted(self.batches.values(), key=lambda batch: batch.last_updated)
         for batch in batches_by_last_updated:
             if not batch.background_runs.currently_running():
                 continue
+            if batch.domain in skip_domains or batch.local_user.global_user_id in skip_global_user_ids:
+                continue
             if batch.id in self.background_suspensions:
                 if self.background_suspensions[batch.id] < now():
                     del self.background_suspensions[batch.id]
                 else:
                     continue
+            if batch.id in self.background_leases:
+                current_lease_owner, lease_expires = self.background_leases[batch.id]
+                if current_lease_owner != lease_owner and lease_expires >= now():
+                    continue
             assert isinstance(batch, OpenBatch)
             assert isinstance(batch.command_records, _BatchCommandRecordsList)
+            command_pendings = []
             for index, command_plan in enumerate(batch.command_records.command_records):
                 if not isinstance(command_plan, CommandPlan):
                     continue
                 command_pending = CommandPending(command_plan.id, command_plan.command)
                 batch.command_records.command_records[index] = command_pending
-                return batch, command_pending, self.background_sessions[batch.id]
+                command_pendings.append(command_pending)
+                if len(command_pendings) >= limit:
+                    break
+            if not command_pendings:
+                continue
+            if lease_owner is not None:
+                self.background_leases[batch.id] = (lease_owner, now() + self.background_lease_duration)
+            return batch, command_pendings, self.background_sessions[batch.id]
         return None
 
+    def renew_background_lease(self, batch: StoredBatch, lease_owner: str) -> bool:
+        lease = self.background_leases.get(batch.id)
+        if lease is None or lease[0] != lease_owner:
+            return False
+        if not batch.background_runs.currently_running():
+            return False
+        if batch.id in self.background_suspensions and self.background_suspensions[batch.id] >= now():
+            return False
+        self.background_leases[batch.id] = (lease_owner, now() + self.background_lease_duration)
+        return True
+
+    def release_background_lease(self, batch: StoredBatch, lease_owner: str) -> None:
+        lease = self.background_leases.get(batch.id)
+        if lease is not None and lease[0] == lease_owner:
+            del self.background_leases[batch.id]
+
 
 @dataclass(frozen=True)
 class _BatchCommandRecordsList(BatchCommandRecords):
@@ -122,8 +176,8 @@ class _BatchCommandRecordsList(BatchCommandRecords):
     batch_id: int
     store: InMemoryBatchStore
 
-    def get_slice(self, offset: int, limit: int) -> list[CommandRecord]:
-        return self.command_records[offset:offset+limit]
+    def get_slice(self, offset: int, limit: int, *, after_id: Optional[int] = None, before_id: Optional[int] = None) -> list[CommandRecord]:
+        return [self.command_records[index] for index in self._slice_indices(offset, limit, after_id, before_id)]
 
     def get_summary(self) -> dict[type[CommandRecord], int]:
         ret: dict[type[CommandRecord], int] = {}
@@ -140,9 +194,10 @@ class _BatchCommandRecordsList(BatchCommandRecords):
         for command_record in self.command_records:
             yield command_record.command
 
-    def make_plans_pending(self, offset: int, limit: int) -> list[CommandPending]:
+    def make_plans_pending(self, offset: int, limit: int, *, after_id: Optional[int] = None, before_id: Optional[int] = None) -> list[CommandPending]:
         command_pendings = []
-        for index, command_plan in enumerate(self.command_records[offset:offset+limit]):
+        for index in self._slice_indices(offset, limit, after_id, before_id):
+            command_plan = self.command_records[index]
             if not isinstance(command_plan, CommandPlan):
                 continue
             command_pending = CommandPending(command_plan.id, command_plan.command)
@@ -150,6 +205,26 @@ class _BatchCommandRecordsList(BatchCommandRecords):
             command_pendings.append(command_pending)
         return command_pendings
 
+    def _slice_indices(self, offset: int, limit: int, after_id: Optional[int], before_id: Optional[int]) -> range:
+        """Get the indices of the command records selected by get_slice."""
+        if before_id is not None:
+            end = len(self.command_records)
+            for index, command_record in enumerate(self.command_records):
+                if command_record.id >= before_id:
+                    end = index
+                    break
+            end = max(0, end - offset)
+            return range(max(0, end - limit), end)
+        start = 0
+        if after_id is not None:
+            start = len(self.command_records)
+            for index, command_record in enumerate(self.command_records):
+                if command_record.id > after_id:
+                    start = index
+                    break
+        start = min(start + offset, len(self.command_records))
+        return range(start, min(start + limit, len(self.command_records)))
+
     def make_pendings_planned(self, command_record_ids: list[int]) -> None:
         for index, command_pending in enumerate(self.command_records):
             if not isinstance(command_pending, CommandPending):
@@ -218,3 +293,24 @@ class InMemoryPreferenceStore(PreferenceStore):
     def set_watchlist_param(self, session: mwapi.Session, value: WatchlistParam) -> None:
         local_user = _local_user_from_session(session)
         self.watchlist_params[local_user] = value
+
+
+class InMemoryTitleHtmlStore(TitleHtmlStore):
+
+    def __init__(self) -> None:
+        self.title_htmls: dict[tuple[str, str], tuple[str, datetime.datetime]] = {}
+
+    def get_title_htmls(self, titles: Collection[tuple[str, str]], max_age: datetime.timedelta) -> dict[tuple[str, str], str]:
+        min_rendered = now() - max_age
+        title_htmls = {}
+        for title in titles:
+            if title in self.title_htmls:
+                title_html, rendered = self.title_htmls[title]
+                if rendered >= min_rendered:
+                    title_htmls[title] = title_html
+        return title_htmls
+
+    def set_title_htmls(self, title_htmls: dict[tuple[str, str], str]) -> None:
+        rendered = now()
+        for title, title_html in title_htmls.items():
+            self.title_htmls[title] = (title_html, rendered)
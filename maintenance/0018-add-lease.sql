@@ -0,0 +1,9 @@
+--- Add the lease table, recording which background runner currently works on a batch,
+--- so that several runners can work on different batches in parallel.
+CREATE TABLE lease (
+  lease_batch int unsigned NOT NULL PRIMARY KEY,
+  lease_owner varchar(255) binary NOT NULL,
+  lease_expires_utc_timestamp int unsigned NOT NULL
+)
+CHARACTER SET = 'utf8mb4'
+COLLATE = 'utf8mb4_bin';
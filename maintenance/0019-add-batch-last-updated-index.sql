@@ -0,0 +1,5 @@
+--- Add an index on the batch table with the columns used when picking the next batch to run in the background
+--- (least recently updated first, skipping certain domains and users),
+--- which the optimizer may use to read batches in that order without reading the full batch rows.
+--- (Whether it does depends on the plan; the pick still joins the background and lease tables.)
+CREATE INDEX batch_last_updated_domain_localuser ON batch (batch_last_updated_utc_timestamp, batch_domain, batch_localuser);
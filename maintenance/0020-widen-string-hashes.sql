@@ -0,0 +1,34 @@
+--- Widen the hashes of the string tables to the first eight bytes of the SHA2-256 hash
+--- and make them unique, so that new strings can be inserted with INSERT … ON DUPLICATE KEY UPDATE
+--- instead of locking the hash with SELECT … FOR UPDATE first.
+--- (The code also compares the stored string now, so 32-bit hash collisions can no longer go unnoticed.)
+--- Creating the unique indexes fails if a table contains the same string twice;
+--- such duplicates must be merged by hand (updating the rows that reference them) before running this.
+
+ALTER TABLE domain
+MODIFY domain_hash bigint unsigned NOT NULL;
+UPDATE domain
+SET domain_hash = CAST(CONV(SUBSTRING(SHA2(domain_name, 256), 1, 16), 16, 10) AS unsigned int);
+DROP INDEX domain_hash ON domain;
+CREATE UNIQUE INDEX domain_hash ON domain (domain_hash);
+
+ALTER TABLE title
+MODIFY title_hash bigint unsigned NOT NULL;
+UPDATE title
+SET title_hash = CAST(CONV(SUBSTRING(SHA2(title_text, 256), 1, 16), 16, 10) AS unsigned int);
+DROP INDEX title_hash ON title;
+CREATE UNIQUE INDEX title_hash ON title (title_hash);
+
+ALTER TABLE actions
+MODIFY actions_hash bigint unsigned NOT NULL;
+UPDATE actions
+SET actions_hash = CAST(CONV(SUBSTRING(SHA2(actions_tpsv, 256), 1, 16), 16, 10) AS unsigned int);
+DROP INDEX actions_hash ON actions;
+CREATE UNIQUE INDEX actions_hash ON actions (actions_hash);
+
+ALTER TABLE querytext
+MODIFY querytext_hash bigint unsigned NOT NULL;
+UPDATE querytext
+SET querytext_hash = CAST(CONV(SUBSTRING(SHA2(querytext_sql, 256), 1, 16), 16, 10) AS unsigned int);
+DROP INDEX querytext_hash ON querytext;
+CREATE UNIQUE INDEX querytext_hash ON querytext (querytext_hash);
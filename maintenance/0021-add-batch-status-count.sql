@@ -0,0 +1,17 @@
+--- Add the batch_status_count table, counting the commands of each batch by status,
+--- so that batch pages don’t need to count all the commands of the batch on every view.
+--- The counts are kept up to date by the application, in the same transactions as the commands.
+CREATE TABLE batch_status_count (
+  batch_status_count_batch int unsigned NOT NULL,
+  batch_status_count_status int unsigned NOT NULL,
+  batch_status_count_count int NOT NULL,
+  PRIMARY KEY (batch_status_count_batch, batch_status_count_status)
+)
+CHARACTER SET = 'utf8mb4'
+COLLATE = 'utf8mb4_bin';
+
+--- Fill it with the current counts (the tool should be stopped while this runs).
+INSERT INTO batch_status_count (batch_status_count_batch, batch_status_count_status, batch_status_count_count)
+SELECT command_batch, command_status, COUNT(*)
+FROM command
+GROUP BY command_batch, command_status;
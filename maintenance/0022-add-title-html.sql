@@ -0,0 +1,12 @@
+--- Add the title_html table, storing the rendered HTML of batch titles,
+--- so that batch lists don’t need to make an API request for every batch title.
+--- It starts out empty and is filled by the tool as titles are rendered.
+CREATE TABLE title_html (
+  title_html_domain int unsigned NOT NULL,
+  title_html_title int unsigned NOT NULL,
+  title_html_html text NOT NULL,
+  title_html_rendered_utc_timestamp int unsigned NOT NULL,
+  PRIMARY KEY (title_html_domain, title_html_title)
+)
+CHARACTER SET = 'utf8mb4'
+COLLATE = 'utf8mb4_bin';
@@ -2,7 +2,30 @@ from dataclasses import dataclass, KW_ONLY
 from typing import Optional
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
+class PageResolution:
+    """The state of a page on a wiki, as far as running a command on it is concerned.
+
+    Only the flags relevant to the page are set
+    (a missing page may also have a bad content model),
+    and only the fields that the API returned for such a page."""
+
+    curtimestamp: str  # when the page was resolved, also used as the start timestamp of the edit
+    _: KW_ONLY
+    missing: bool = False
+    invalid: bool = False
+    interwiki: bool = False
+    badcontentformat: bool = False
+    badcontentmodel: bool = False
+    contentformat: Optional[str] = None
+    contentmodel: Optional[str] = None
+    page_id: Optional[int] = None
+    base_timestamp: Optional[str] = None
+    base_revid: Optional[int] = None
+    wikitext: Optional[str] = None  # only set if the page can be edited (and '' for a missing page)
+
+
+@dataclass(slots=True)
 class Page:
     """A specifier for a page on a wiki, optionally resolved."""
 
@@ -10,7 +33,7 @@ class Page:
     _: KW_ONLY
     resolve_redirects: Optional[bool]  # None means “batch predates this flag” and is to be interpreted as False in accordance with the original code’s behavior
     create_missing_page: Optional[bool]  # ditto (None also means False)
-    resolution: Optional[dict] = None
+    resolution: Optional[PageResolution] = None
 
     def cleanup(self) -> None:
         """Partially normalize the page, as a convenience for users.
@@ -1,5 +1,7 @@
 """Functions to parse batches from tab/pipe-separated values syntax."""
 
+from collections.abc import Iterable, Iterator
+import functools
 from typing import Optional
 
 from action import Action, AddCategoryAction, AddCategoryWithSortKeyAction, AddCategoryProvideSortKeyAction, AddCategoryReplaceSortKeyAction, RemoveCategoryAction, RemoveCategoryWithSortKeyAction
@@ -8,24 +10,68 @@ from command import Command
 from page import Page
 
 
+max_errors = 100
+"""How many errors parse_batch collects before it stops parsing."""
+
+
 def parse_batch(tpsv: str, *, title: Optional[str], default_resolve_redirects: bool, default_create_missing_page: bool) -> NewBatch:
-    commands = []
-    errors = []
-    for line in tpsv.split('\n'):
-        line = line.rstrip('\r')
-        if not line:
-            continue
+    commands = list(parse_commands(tpsv,
+                                   default_resolve_redirects=default_resolve_redirects,
+                                   default_create_missing_page=default_create_missing_page))
+    return NewBatch(commands, title)
+
+
+def parse_commands(tpsv: str, *, default_resolve_redirects: bool, default_create_missing_page: bool) -> Iterator[Command]:
+    """Parse the commands of a batch one line at a time.
+
+    Errors are collected and raised together (as a ParseBatchError)
+    once all lines have been parsed, or as soon as there are more than max_errors of them."""
+    errors: list[Exception] = []
+    for line in _lines(tpsv):
         try:
-            commands.append(parse_command(line,
-                                          default_resolve_redirects=default_resolve_redirects,
-                                          default_create_missing_page=default_create_missing_page))
+            command = parse_command(line,
+                                    default_resolve_redirects=default_resolve_redirects,
+                                    default_create_missing_page=default_create_missing_page)
         except Exception as e:
             errors.append(e)
+            if len(errors) > max_errors:
+                raise ParseBatchError(errors[:max_errors], truncated=True)
+            continue
+        if not errors:
+            yield command
     if errors:
         raise ParseBatchError(errors)
+
+
+def parse_pagepile_batch(pages: Iterable[str], actions: str, *, title: Optional[str], default_resolve_redirects: bool, default_create_missing_page: bool) -> NewBatch:
+    """Parse a batch running the same actions on every page of a PagePile.
+
+    The actions are only parsed once and shared by all the commands."""
+    try:
+        parsed_actions = parse_actions(actions.replace('\t', '|'))
+    except ParseActionsError as e:
+        raise ParseBatchError(e.errors)
+    commands = [Command(Page(page.strip(),
+                             resolve_redirects=default_resolve_redirects,
+                             create_missing_page=default_create_missing_page),
+                        list(parsed_actions))
+                for page in pages]
     return NewBatch(commands, title)
 
 
+def _lines(tpsv: str) -> Iterator[str]:
+    """Yield the non-empty lines of the string, without building a list of all of them."""
+    start = 0
+    while start < len(tpsv):
+        end = tpsv.find('\n', start)
+        if end == -1:
+            end = len(tpsv)
+        line = tpsv[start:end].rstrip('\r')
+        if line:
+            yield line
+        start = end + 1
+
+
 def parse_command(line: str, *, default_resolve_redirects: bool, default_create_missing_page: bool) -> Command:
     [page_field, *other_fields] = [field.strip() for field in line.replace('\t', '|').split('|')]
     if not other_fields:
@@ -62,16 +108,30 @@ def parse_command(line: str, *, default_resolve_redirects: bool, default_create_
         page = Page(page_title,
                     resolve_redirects=default_resolve_redirects,
                     create_missing_page=default_create_missing_page)
+    try:
+        actions = parse_actions('|'.join(other_fields))
+    except ParseActionsError as e:
+        raise ParseCommandError(page, e.errors)
+    return Command(page, list(actions))
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_actions(actions_tpsv: str) -> tuple[Action, ...]:
+    """Parse the pipe-separated actions of a command (see Command.actions_tpsv).
+
+    Most batches run the same actions on many pages,
+    so the result is cached and the (immutable) actions
+    are shared by all the commands that use them."""
     actions = []
     errors = []
-    for field in other_fields:
+    for field in actions_tpsv.split('|'):
         try:
-            actions.append(parse_action(field))
+            actions.append(parse_action(field.strip()))
         except Exception as e:
             errors.append(e)
     if errors:
-        raise ParseCommandError(page, errors)
-    return Command(page, actions)
+        raise ParseActionsError(errors)
+    return tuple(actions)
 
 
 def parse_action(field: str) -> Action:
@@ -103,9 +163,20 @@ def parse_action(field: str) -> Action:
 
 class ParseBatchError(ValueError):
 
+    def __init__(self, errors: list[Exception], truncated: bool = False) -> None:
+        self.errors = errors
+        self.truncated = truncated
+        message = 'errors parsing batch: %s' % '; '.join(map(str, errors))
+        if truncated:
+            message += '; (further errors omitted)'
+        super().__init__(message)
+
+
+class ParseActionsError(ValueError):
+
     def __init__(self, errors: list[Exception]) -> None:
         self.errors = errors
-        super().__init__('errors parsing batch: %s' % '; '.join(map(str, errors)))
+        super().__init__('errors parsing actions: %s' % ', '.join(map(str, errors)))
 
 
 class ParseCommandError(ValueError):
@@ -1,9 +1,15 @@
 import bs4
 import cachetools
+from collections.abc import Sequence
+import concurrent.futures
 from markupsafe import Markup
 import mwapi  # type: ignore
 import threading
-from typing import cast
+from typing import Optional, cast
+
+
+# how many action=parse requests parse_summaries makes at once
+parse_summaries_workers = 8
 
 
 summary_cache: cachetools.LRUCache[tuple[str, str], Markup] = cachetools.LRUCache(maxsize=1024)
@@ -16,18 +22,54 @@ summary_cache_lock = threading.RLock()
 def parse_summary(session: mwapi.Session, summary: str) -> Markup:
     """Parses a summary text or fragment into HTML."""
 
+    summary_html = _try_parse_summary(session, summary)
+    if summary_html is None:
+        return Markup.escape(summary)
+    return summary_html
+
+def parse_summaries(sessions_and_summaries: Sequence[tuple[mwapi.Session, str]]) -> list[Optional[Markup]]:
+    """Parses several summary texts or fragments into HTML, concurrently.
+
+    Unlike parse_summary, this does not use the cache,
+    and returns None for any summary that could not be parsed,
+    so that the caller can tell the HTML apart from a fallback.
+    The same session may be used for several summaries.
+    Errors reaching a wiki are also treated as failures to parse,
+    so that one unavailable wiki doesn’t break the whole page."""
+    if len(sessions_and_summaries) <= 1:
+        return [_try_parse_summary_if_reachable(session, summary) for session, summary in sessions_and_summaries]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(parse_summaries_workers, len(sessions_and_summaries)),
+                                               thread_name_prefix='parse_summaries') as executor:
+        return list(executor.map(lambda session_and_summary: _try_parse_summary_if_reachable(*session_and_summary), sessions_and_summaries))
+
+def _try_parse_summary(session: mwapi.Session, summary: str) -> Optional[Markup]:
     try:
-        response = session.get(action='parse',
-                               summary=summary,
-                               prop=[],
-                               title='Special:X',  # T279585
-                               formatversion=2)
+        return _parse_summary(session, summary)
     except mwapi.errors.APIError as e:
         print("Error formatting summary {!r}: {}".format(summary, e))
-        return Markup.escape(summary)
-    else:
-        summary_html = response['parse']['parsedsummary']
-        return fix_markup(summary_html, session.host)
+        return None
+
+def _try_parse_summary_if_reachable(session: mwapi.Session, summary: str) -> Optional[Markup]:
+    # parse_summary doesn’t catch these errors, it would cache the fallback
+    try:
+        return _try_parse_summary(session, summary)
+    except (mwapi.errors.ConnectionError,
+            mwapi.errors.TimeoutError,
+            mwapi.errors.HTTPError,
+            mwapi.errors.TooManyRedirectsError,
+            mwapi.errors.RequestError,
+            ValueError) as e:  # mwapi raises ValueError if the response is not JSON, e.g. an error page
+        print("Error requesting summary {!r}: {}".format(summary, e))
+        return None
+
+def _parse_summary(session: mwapi.Session, summary: str) -> Markup:
+    response = session.get(action='parse',
+                           summary=summary,
+                           prop=[],
+                           title='Special:X',  # T279585
+                           formatversion=2)
+    summary_html = response['parse']['parsedsummary']
+    return fix_markup(summary_html, session.host)
 
 def fix_markup(html: str, host: str) -> Markup:
     soup = bs4.BeautifulSoup(html, 'html.parser')
@@ -1,16 +1,100 @@
-from dataclasses import dataclass
+import cachetools
+from collections.abc import Generator
+import concurrent.futures
+from dataclasses import dataclass, replace
 import datetime
+import functools
+import itertools
+import math
 import mwapi  # type: ignore
-from typing import Optional, cast
+import requests
+import requests_oauthlib  # type: ignore
+import threading
+from typing import Any, Optional, cast
 
-from command import CommandPending, CommandFinish, CommandEdit, CommandNoop, CommandCreation, CommandPageMissing, CommandTitleInvalid, CommandTitleInterwiki, CommandPageProtected, CommandPageBadContentFormat, CommandPageBadContentModel, CommandEditConflict, CommandMaxlagExceeded, CommandBlocked, CommandWikiReadOnly
-from page import Page
+from backoff import AdaptiveBackoff
+from command import CommandPending, CommandFinish, CommandFailure, CommandEdit, CommandNoop, CommandCreation, CommandPageMissing, CommandTitleInvalid, CommandTitleInterwiki, CommandPageProtected, CommandPageBadContentFormat, CommandPageBadContentModel, CommandEditConflict, CommandMaxlagExceeded, CommandBlocked, CommandWikiReadOnly
+from page import Page, PageResolution
 from store import WatchlistParam
 import siteinfo
 
 
 wikitext_content_models = {'wikitext', 'proofread-index'}
 
+# the maximum number of titles in a single action=query request (for non-bots)
+resolve_pages_chunk_size = 50
+
+# how many threads run_commands uses to resolve pages and prepare edits ahead of time
+run_commands_workers = 4
+
+# shared by all runners, so that all batches on a wiki back off together
+maxlag_backoff = AdaptiveBackoff()
+
+_last_response = threading.local()
+
+
+def _remember_response(response: requests.Response, *args: Any, **kwargs: Any) -> None:
+    _last_response.response = response
+
+
+def _last_error(code: str) -> dict:
+    """Get the full error object of the last API response in this thread,
+    if it was an error with the given code.
+
+    mwapi only exposes the code and info of an error,
+    but the response can also include the replication lag,
+    the read-only reason or the block info,
+    and the Retry-After header."""
+    response: Optional[requests.Response] = getattr(_last_response, 'response', None)
+    if response is None:
+        return {}
+    try:
+        error = response.json().get('error', {})
+    except ValueError:
+        return {}
+    if error.get('code') != code:
+        return {}
+    if 'Retry-After' in response.headers:
+        error = {**error, 'retry-after': response.headers['Retry-After']}
+    return error
+
+
+# CSRF tokens stay valid as long as the user doesn’t log out (i.e. the OAuth grant is not revoked),
+# so we fetch them only once per wiki and user, and again if the API reports a bad token
+_csrf_token_cache: cachetools.LRUCache[tuple[str, str], str] = cachetools.LRUCache(maxsize=1024)
+_csrf_token_cache_lock = threading.RLock()
+
+
+def _csrf_token(session: mwapi.Session, refresh: bool = False) -> str:
+    auth = session.session.auth
+    if not isinstance(auth, requests_oauthlib.OAuth1):
+        # not an OAuth session (e.g. tests using bot passwords), don’t cache
+        return session.get(action='query',
+                           meta='tokens')['query']['tokens']['csrftoken']
+    key = (session.host, auth.client.resource_owner_key)
+    with _csrf_token_cache_lock:
+        if refresh:
+            _csrf_token_cache.pop(key, None)
+        token = _csrf_token_cache.get(key)
+    if token is None:
+        token = session.get(action='query',
+                            meta='tokens')['query']['tokens']['csrftoken']
+        with _csrf_token_cache_lock:
+            _csrf_token_cache[key] = token
+    return token
+
+
+@dataclass
+class PreparedEdit:
+    """An edit that is ready to be made for a command,
+    along with the page resolution it is based on
+    (without the wikitext, which is no longer needed)."""
+
+    command_pending: CommandPending
+    resolution: PageResolution
+    params: dict
+
+
 @dataclass
 class Runner():
 
@@ -20,10 +104,27 @@ class Runner():
     summary_batch_link: Optional[str] = None
 
     def __post_init__(self) -> None:
-        self.csrf_token = self.session.get(action='query',
-                                           meta='tokens')['query']['tokens']['csrftoken']
+        hooks = self.session.session.hooks['response']
+        if _remember_response not in hooks:
+            hooks.append(_remember_response)
+        self.csrf_token = _csrf_token(self.session)
+
+    def _post_with_token(self, params: dict) -> dict:
+        try:
+            return self.session.post(**params, token=self.csrf_token)
+        except mwapi.errors.APIError as e:
+            if e.code != 'badtoken':
+                raise e
+            # the cached token is no longer valid, get a fresh one and try once more
+            self.csrf_token = _csrf_token(self.session, refresh=True)
+            return self.session.post(**params, token=self.csrf_token)
 
     def resolve_pages(self, pages: list[Page]) -> None:
+        """Resolve any number of pages, in as few API requests as possible.
+
+        Pages that could not be resolved (e.g. because the API
+        truncated the response) are left with a resolution of None,
+        and will be resolved individually by run_command."""
         pages_with_resolve_redirects: list[Page] = []
         pages_without_resolve_redirects: list[Page] = []
 
@@ -33,10 +134,9 @@ class Runner():
             else:
                 pages_without_resolve_redirects.append(page)
 
-        if pages_with_resolve_redirects:
-            self.resolve_pages_of_one_kind(pages_with_resolve_redirects)
-        if pages_without_resolve_redirects:
-            self.resolve_pages_of_one_kind(pages_without_resolve_redirects)
+        for pages_of_one_kind in [pages_with_resolve_redirects, pages_without_resolve_redirects]:
+            for chunk in itertools.batched(pages_of_one_kind, resolve_pages_chunk_size):
+                self.resolve_pages_of_one_kind(list(chunk))
 
     def do_resolve_redirects(self, resolve_redirects: Optional[bool]) -> bool:
         return resolve_redirects is True  # None is equivalent to False
@@ -46,7 +146,7 @@ class Runner():
 
     def resolve_pages_of_one_kind(self, pages: list[Page]) -> None:
         assert pages
-        assert len(pages) <= 50
+        assert len(pages) <= resolve_pages_chunk_size
 
         do_resolve_redirects = self.do_resolve_redirects(pages[0].resolve_redirects)
 
@@ -76,63 +176,53 @@ class Runner():
 
         for interwiki in response.get('query', {}).get('interwiki', []):
             page = pages_by_title[interwiki['title']]
-            page.resolution = {
-                'interwiki': True,
-                'curtimestamp': response['curtimestamp'],
-            }
+            page.resolution = PageResolution(response['curtimestamp'],
+                                             interwiki=True)
 
         for response_page in response.get('query', {}).get('pages', []):
             title = response_page['title']
             page = pages_by_title[title]
             if 'missing' in response_page:
-                page.resolution = {
-                    'missing': True,
-                    'curtimestamp': response['curtimestamp'],
-                    'contentmodel': response_page['contentmodel'],
-                }
-                if page.resolution['contentmodel'] in wikitext_content_models:
-                    page.resolution |= {
-                        'wikitext': '',
-                    }
+                if response_page['contentmodel'] in wikitext_content_models:
+                    page.resolution = PageResolution(response['curtimestamp'],
+                                                     missing=True,
+                                                     contentmodel=response_page['contentmodel'],
+                                                     wikitext='')
                 else:
-                    page.resolution |= {
-                        'badcontentmodel': True,
-                    }
+                    page.resolution = PageResolution(response['curtimestamp'],
+                                                     missing=True,
+                                                     contentmodel=response_page['contentmodel'],
+                                                     badcontentmodel=True)
                 continue
             if 'invalid' in response_page:
-                page.resolution = {
-                    'invalid': True,
-                    'curtimestamp': response['curtimestamp'],
-                }
+                page.resolution = PageResolution(response['curtimestamp'],
+                                                 invalid=True)
+                continue
+            if 'revisions' not in response_page:
+                # the content did not fit into this response (see rvcontinue);
+                # leave the page unresolved, run_command will resolve it on its own
                 continue
             revision = response_page['revisions'][0]
             slot = revision['slots']['main']
-            page.resolution = {
-                'contentformat': slot['contentformat'],
-                'contentmodel': slot['contentmodel'],
-                'page_id': response_page['pageid'],
-                'base_timestamp': revision['timestamp'],
-                'base_revid': revision['revid'],
-                'start_timestamp': response['curtimestamp'],
-            }
+            resolution = functools.partial(PageResolution,
+                                           response['curtimestamp'],
+                                           contentformat=slot['contentformat'],
+                                           contentmodel=slot['contentmodel'],
+                                           page_id=response_page['pageid'],
+                                           base_timestamp=revision['timestamp'],
+                                           base_revid=revision['revid'])
             if slot['contentformat'] != 'text/x-wiki':
                 # not wikitext, we almost certainly can’t work with this
-                page.resolution |= {
-                    'badcontentformat': True,
-                }
+                page.resolution = resolution(badcontentformat=True)
             elif slot['contentmodel'] not in wikitext_content_models:
                 # wikitext but unknown context model, better be safe and not use it
                 # (but it might be possible to add support later if users request it –
                 # we just need an example page to try it out on)
-                page.resolution |= {
-                    'badcontentmodel': True,
-                    # we *could* add 'wikitext': slot['content'] here but nothing would use it anyway
-                }
+                page.resolution = resolution(badcontentmodel=True)
+                # we *could* add wikitext=slot['content'] here but nothing would use it anyway
             else:
                 # wikitext we can edit \o/ (this is the normal case)
-                page.resolution |= {
-                    'wikitext': slot['content'],
-                }
+                page.resolution = resolution(wikitext=slot['content'])
 
 #                 raise ValueError(f'Unexpected content model {slot["contentmodel"]} '
 #                                  f'for revision {revision["revid"]} of page {title} '
@@ -144,39 +234,123 @@ class Runner():
 
         if '' in pages_by_title:
             page = pages_by_title['']
-            page.resolution = {
-                'invalid': True,
-                'curtimestamp': response['curtimestamp'],
-            }
+            page.resolution = PageResolution(response['curtimestamp'],
+                                             invalid=True)
 
     def run_command(self, command_pending: CommandPending) -> CommandFinish:
+        return self._run_prepared(self.prepare_command(command_pending))
+
+    def run_commands(self, command_pendings: list[CommandPending], attempts: int = 5) -> Generator[CommandFinish, None, None]:
+        """Run the given commands in order, yielding the result of each one.
+
+        Commands that fail in a way that can be retried immediately
+        are run up to the given number of attempts.
+
+        While the edits of one chunk of commands are made,
+        the pages of the next chunk are resolved in the background,
+        and the edits of all resolved pages are prepared in a worker pool.
+        Pages that also occur earlier in the same chunk or in the previous chunk
+        are not resolved ahead of time, since their edits must build on
+        the earlier edits to the same page.
+
+        If the caller stops iterating early (e.g. to suspend the batch),
+        the remaining commands are not run."""
+        chunks = [list(chunk) for chunk in itertools.batched(command_pendings, resolve_pages_chunk_size)]
+        if not chunks:
+            return
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=run_commands_workers,
+                                                         thread_name_prefix='runner')
+        try:
+            prepared_edits = self._resolve_and_prepare(chunks[0], set(), executor)
+            for index, chunk in enumerate(chunks):
+                if index + 1 < len(chunks):
+                    next_prepared_edits = executor.submit(self._resolve_and_prepare,
+                                                          chunks[index + 1],
+                                                          {command_pending.command.page.title for command_pending in chunk},
+                                                          executor)
+                for command_pending in chunk:
+                    prepared_edit = prepared_edits.get(command_pending.id)
+                    if prepared_edit is not None:
+                        command_finish = self._run_prepared(prepared_edit.result())
+                    else:
+                        command_finish = self.run_command(command_pending)
+                    for attempt in range(1, attempts):
+                        if isinstance(command_finish, CommandFailure) and command_finish.can_retry_immediately():
+                            command_finish = self.run_command(command_pending)
+                        else:
+                            break
+                    yield command_finish
+                if index + 1 < len(chunks):
+                    prepared_edits = next_prepared_edits.result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _resolve_and_prepare(self,
+                             command_pendings: list[CommandPending],
+                             skip_titles: set[str],
+                             executor: concurrent.futures.Executor) -> dict[int, concurrent.futures.Future[PreparedEdit | CommandFinish]]:
+        """Resolve the pages of the given commands, except for pages with the given titles
+        and repeated pages, and start preparing the edits of the resolved pages.
+
+        Returns the futures of the prepared edits by command ID."""
+        command_pendings_to_prepare = []
+        titles = set(skip_titles)
+        for command_pending in command_pendings:
+            if command_pending.command.page.title not in titles:
+                titles.add(command_pending.command.page.title)
+                command_pendings_to_prepare.append(command_pending)
+        if command_pendings_to_prepare:
+            self.resolve_pages([command_pending.command.page for command_pending in command_pendings_to_prepare])
+        return {command_pending.id: executor.submit(self.prepare_command, command_pending)
+                for command_pending in command_pendings_to_prepare
+                if command_pending.command.page.resolution is not None}
+
+    def _run_prepared(self, prepared_edit: PreparedEdit | CommandFinish) -> CommandFinish:
+        if isinstance(prepared_edit, CommandFinish):
+            command_finish = prepared_edit
+        else:
+            command_finish = self.run_prepared_edit(prepared_edit)
+        if not isinstance(command_finish, CommandFailure) or not command_finish.can_retry_later():
+            # the command will not run again, release the page (and its wikitext)
+            command_finish.command.page.resolution = None
+        return command_finish
+
+    def prepare_command(self, command_pending: CommandPending) -> PreparedEdit | CommandFinish:
+        """Prepare the edit for the given command, resolving its page if necessary.
+
+        If the command can be finished without an edit
+        (e.g. because the page is missing or the edit would be a no-op),
+        the finished command is returned instead.
+        Apart from resolving the page, this does not modify it,
+        so for resolved pages it is safe to run in a different thread."""
         page = command_pending.command.page
         if page.resolution is None:
             self.resolve_pages([page])
-        resolution = cast(dict, page.resolution)
+        resolution = cast(PageResolution, page.resolution)
         category_info = siteinfo.category_info(self.session)
 
-        if 'missing' in resolution and not self.do_create_missing_page(page.create_missing_page):
+        if resolution.missing and not self.do_create_missing_page(page.create_missing_page):
             return CommandPageMissing(command_pending.id, command_pending.command,
-                                      curtimestamp=resolution['curtimestamp'])
-        if 'invalid' in resolution:
+                                      curtimestamp=resolution.curtimestamp)
+        if resolution.invalid:
             return CommandTitleInvalid(command_pending.id, command_pending.command,
-                                       curtimestamp=resolution['curtimestamp'])
-        if 'interwiki' in resolution:
+                                       curtimestamp=resolution.curtimestamp)
+        if resolution.interwiki:
             return CommandTitleInterwiki(command_pending.id, command_pending.command,
-                                         curtimestamp=resolution['curtimestamp'])
-        if 'badcontentformat' in resolution:
+                                         curtimestamp=resolution.curtimestamp)
+        if resolution.badcontentformat:
             return CommandPageBadContentFormat(command_pending.id, command_pending.command,
-                                               content_format=resolution['contentformat'],
-                                               content_model=resolution['contentmodel'],
-                                               revision=resolution['base_revid'])
-        if 'badcontentmodel' in resolution:
+                                               content_format=cast(str, resolution.contentformat),
+                                               content_model=cast(str, resolution.contentmodel),
+                                               revision=cast(int, resolution.base_revid))
+        if resolution.badcontentmodel:
             return CommandPageBadContentModel(command_pending.id, command_pending.command,
-                                              content_format=resolution['contentformat'],
-                                              content_model=resolution['contentmodel'],
-                                              revision=resolution['base_revid'])
+                                              content_format=resolution.contentformat,
+                                              content_model=cast(str, resolution.contentmodel),
+                                              revision=resolution.base_revid)
 
-        wikitext, actions = command_pending.command.apply(resolution['wikitext'], category_info)
+        assert resolution.wikitext is not None
+        wikitext, actions = command_pending.command.apply(resolution.wikitext, category_info)
         summary = ''
         major_commands, minor_commands = 0, 0
         for action, noop in actions:
@@ -202,73 +376,92 @@ class Runner():
             summary += siteinfo.semicolon_separator(self.session)
             summary += self.summary_batch_link
 
-        if wikitext == resolution['wikitext']:
-            return CommandNoop(command_pending.id, command_pending.command, resolution.get('base_revid'))
+        if wikitext == resolution.wikitext:
+            return CommandNoop(command_pending.id, command_pending.command, resolution.base_revid)
+        params = {'action': 'edit',
+                  'text': wikitext,
+                  'summary': summary,
+                  'bot': True,
+                  'watchlist': self.watchlist_param.name,
+                  'contentformat': 'text/x-wiki',
+                  'contentmodel': resolution.contentmodel,  # usually 'wikitext'
+                  'assert': 'user',
+                  'maxlag': 5,
+                  'formatversion': 2}
+        if resolution.missing:
+            params |= {
+                'title': page.title,
+                'createonly': True,
+            }
+        else:
+            params |= {
+                'pageid': resolution.page_id,
+                'basetimestamp': resolution.base_timestamp,
+                'starttimestamp': resolution.curtimestamp,
+            }
+        if minor_commands < 2 and not major_commands:
+            params['minor'] = ''
+        return PreparedEdit(command_pending, replace(resolution, wikitext=None), params)
+
+    def run_prepared_edit(self, prepared_edit: PreparedEdit) -> CommandFinish:
+        """Make the given prepared edit."""
+        command_pending = prepared_edit.command_pending
+        page = command_pending.command.page
+        resolution = prepared_edit.resolution
         try:
-            params = {'action': 'edit',
-                      'text': wikitext,
-                      'summary': summary,
-                      'bot': True,
-                      'watchlist': self.watchlist_param.name,
-                      'contentformat': 'text/x-wiki',
-                      'contentmodel': resolution['contentmodel'],  # usually 'wikitext'
-                      'token': self.csrf_token,
-                      'assert': 'user',
-                      'maxlag': 5,
-                      'formatversion': 2}
-            if 'missing' in resolution:
-                params |= {
-                    'title': page.title,
-                    'createonly': True,
-                }
-            else:
-                params |= {
-                    'pageid': resolution['page_id'],
-                    'basetimestamp': resolution['base_timestamp'],
-                    'starttimestamp': resolution['start_timestamp'],
-                }
-            if minor_commands < 2 and not major_commands:
-                params['minor'] = ''
-            response = self.session.post(**params)
+            response = self._post_with_token(prepared_edit.params)
         except mwapi.errors.APIError as e:
             if e.code in {'editconflict', 'articleexists'}:
                 # 'articleexists' means someone else created the page of this create_missing_page=True command since we resolved it
                 page.resolution = None  # this must be outdated now
                 return CommandEditConflict(command_pending.id, command_pending.command)
             elif e.code == 'protectedpage':
-                return CommandPageProtected(command_pending.id, command_pending.command, curtimestamp=resolution['start_timestamp'])
+                return CommandPageProtected(command_pending.id, command_pending.command, curtimestamp=resolution.curtimestamp)
             elif e.code == 'maxlag':
-                retry_after_seconds = 5  # the API returns this in a Retry-After header, but mwapi hides that from us :(
+                error = _last_error(e.code)
+                reported_limit = None
+                try:
+                    reported_limit = float(error['retry-after'])
+                except (KeyError, ValueError):
+                    if isinstance(error.get('lag'), (int, float)):
+                        reported_limit = error['lag']
+                retry_after_seconds = math.ceil(maxlag_backoff.failure(self.session.host, reported_limit))
                 retry_after = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=retry_after_seconds)
                 retry_after = retry_after.replace(microsecond=0)
                 return CommandMaxlagExceeded(command_pending.id, command_pending.command, retry_after)
             elif e.code == 'blocked' or e.code == 'autoblocked':
                 auto = e.code == 'autoblocked'
-                blockinfo = None  # the API returns this in a 'blockinfo' member of the 'error' object, but mwapi hides that from us :(
+                blockinfo = _last_error(e.code).get('blockinfo')
                 return CommandBlocked(command_pending.id, command_pending.command, auto, blockinfo)
             elif e.code == 'readonly':
-                reason = None  # the API returns this in a 'readonlyreason' member of the 'error' object, but mwapi hides that from us :(
-                # maintenance-related read-only times are usually done within a few minutes (though scheduled for an hour),
-                # and MediaWiki automatically enters temporary read-only mode if replication lag exceeds 30 seconds,
-                # so guess a fairly short retry time
-                retry_after_minutes = 5
-                retry_after = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=retry_after_minutes)
+                error = _last_error(e.code)
+                reason = error.get('readonlyreason')
+                try:
+                    retry_after_seconds = math.ceil(float(error['retry-after']))
+                except (KeyError, ValueError):
+                    # maintenance-related read-only times are usually done within a few minutes (though scheduled for an hour),
+                    # and MediaWiki automatically enters temporary read-only mode if replication lag exceeds 30 seconds,
+                    # so guess a fairly short retry time
+                    retry_after_seconds = 5 * 60
+                retry_after = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=retry_after_seconds)
                 retry_after = retry_after.replace(microsecond=0)
                 return CommandWikiReadOnly(command_pending.id, command_pending.command, reason, retry_after)
             else:
                 raise e
 
+        maxlag_backoff.success(self.session.host)
+
         if 'nochange' in response['edit']:
             page.resolution = None  # this must be outdated now, otherwise we would’ve detected the no-op before trying to edit
-            assert 'missing' not in resolution  # creating a page cannot be a 'nochange'
-            return CommandNoop(command_pending.id, command_pending.command, resolution['base_revid'])
+            assert not resolution.missing  # creating a page cannot be a 'nochange'
+            return CommandNoop(command_pending.id, command_pending.command, resolution.base_revid)
 
-        if 'missing' not in resolution:
-            assert response['edit']['oldrevid'] == resolution['base_revid']
+        if not resolution.missing:
+            assert response['edit']['oldrevid'] == resolution.base_revid
         page.resolution = None  # this must be outdated now, and we don’t know the new wikitext since non-conflicting edits may have been merged
         if 'new' in response['edit']:
-            assert 'missing' in resolution
+            assert resolution.missing
             return CommandCreation(command_pending.id, command_pending.command, response['edit']['newrevid'])
         else:
-            assert 'missing' not in resolution
+            assert not resolution.missing
             return CommandEdit(command_pending.id, command_pending.command, response['edit']['oldrevid'], response['edit']['newrevid'])
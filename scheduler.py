@@ -0,0 +1,118 @@
+from collections.abc import Callable
+from dataclasses import dataclass, field
+import threading
+import time
+from typing import Optional
+
+
+@dataclass
+class TokenBucket:
+    """A token bucket, allowing rate edits per second on average,
+    with bursts of up to capacity edits.
+
+    The number of tokens may become negative,
+    if edits were made without waiting for a token
+    (e.g. by several workers at once),
+    in which case the bucket takes correspondingly longer to refill."""
+
+    rate: float
+    capacity: float
+    tokens: float
+    updated: float
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def seconds_until_available(self) -> float:
+        """The number of seconds until at least one token is available,
+        as of the last refill."""
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+@dataclass
+class EditScheduler:
+    """A scheduler limiting the edit rate of background runs.
+
+    It keeps one token bucket per wiki (domain)
+    and one per user (global user ID);
+    a command may only be run if both buckets have a token available.
+    Wikis and users without available tokens should be skipped
+    when picking the next command to run,
+    so that other wikis and users can use the time.
+
+    The scheduler is thread-safe,
+    so it can be shared by all the workers of a background runner.
+    However, the buckets only exist in one process:
+    several background runner processes (e.g. job replicas)
+    must each be given their share of the overall rates."""
+
+    domain_rate: float  # edits per second per wiki
+    user_rate: float  # edits per second per user
+    burst: float = 5  # edits that can be made in quick succession after a break
+    clock: Callable[[], float] = time.monotonic
+    _domain_buckets: dict[str, TokenBucket] = field(default_factory=dict, init=False, repr=False)
+    _user_buckets: dict[int, TokenBucket] = field(default_factory=dict, init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    def _bucket[K](self, buckets: dict[K, TokenBucket], key: K, rate: float, now: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, self.burst, self.burst, now)
+            buckets[key] = bucket
+        else:
+            bucket.refill(now)
+        return bucket
+
+    def _exhausted[K](self, buckets: dict[K, TokenBucket]) -> set[K]:
+        now = self.clock()
+        exhausted = set()
+        for key, bucket in list(buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del buckets[key]  # full buckets behave the same as new ones, no need to keep them around
+            elif bucket.tokens < 1:
+                exhausted.add(key)
+        return exhausted
+
+    def exhausted_domains(self) -> set[str]:
+        """The domains of wikis which currently may not be edited."""
+        with self._lock:
+            return self._exhausted(self._domain_buckets)
+
+    def exhausted_global_user_ids(self) -> set[int]:
+        """The global user IDs of users who currently may not edit."""
+        with self._lock:
+            return self._exhausted(self._user_buckets)
+
+    def take(self, domain: str, global_user_id: int) -> None:
+        """Take a token for an edit by the given user on the given wiki.
+
+        This always succeeds, even if no token is available,
+        since another worker may have taken the last token
+        between the exhausted_* check and this call;
+        the buckets then take longer to refill."""
+        with self._lock:
+            now = self.clock()
+            self._bucket(self._domain_buckets, domain, self.domain_rate, now).tokens -= 1
+            self._bucket(self._user_buckets, global_user_id, self.user_rate, now).tokens -= 1
+
+    def pause_domain(self, domain: str, seconds: float) -> None:
+        """Make no edits on the given wiki for the given number of seconds,
+        e.g. because it reported replication lag."""
+        with self._lock:
+            bucket = self._bucket(self._domain_buckets, domain, self.domain_rate, self.clock())
+            bucket.tokens = min(bucket.tokens, 1 - seconds * bucket.rate)
+
+    def seconds_until_available(self) -> Optional[float]:
+        """The number of seconds until any exhausted wiki or user may edit again,
+        or None if nothing is exhausted."""
+        with self._lock:
+            self._exhausted(self._domain_buckets)
+            self._exhausted(self._user_buckets)
+            seconds = [bucket.seconds_until_available()
+                       for bucket in [*self._domain_buckets.values(), *self._user_buckets.values()]
+                       if bucket.tokens < 1]
+        return min(seconds, default=None)
@@ -1,12 +1,63 @@
 import cachetools
+from dataclasses import dataclass, field
+import functools
 import mwapi  # type: ignore
+import re
 import threading
 
 
-type CategoryInfo = tuple[str, list[str], str]
-"""The primary name of the category namespace,
-all the names with which a category link may be formed,
-and the case of the category namespace ("first-letter" or "case-sensitive")."""
+_whitespace_re = re.compile(r'[ _\u00A0\u1680\u180E\u2000-\u200A\u2028\u2029\u202F\u205F\u3000]+')
+
+
+@functools.lru_cache(maxsize=65536)
+def _category_key(category: str, case: str) -> str:
+    if case == 'first-letter':
+        category = category[:1].upper() + category[1:]
+    elif case == 'case-sensitive':
+        pass
+    else:
+        raise ValueError('Unknown case handling %s' % case)
+
+    # clean up whitespace (and convert to dbkey form, i.e. underscores);
+    # for the MediaWiki implementation of this, see MediaWikiTitleCodec::splitTitleString()
+    return _whitespace_re.sub('_', category).strip('_')
+
+
+@dataclass(frozen=True)
+class CategoryInfo:
+    """How category links are formed on a wiki.
+
+    Besides the raw information from the API,
+    this holds a precompiled matcher for category links,
+    so that actions can check many links quickly."""
+
+    name: str
+    """The primary name of the category namespace."""
+
+    names: list[str]
+    """All the names with which a category link may be formed."""
+
+    case: str
+    """The case of the category namespace ("first-letter" or "case-sensitive")."""
+
+    link_prefixes: tuple[str, ...] = field(init=False, repr=False, compare=False)
+    _link_re: re.Pattern[str] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        link_prefixes = tuple('[[' + name + ':' for name in self.names)
+        object.__setattr__(self, 'link_prefixes', link_prefixes)
+        object.__setattr__(self, '_link_re', re.compile('|'.join(re.escape(link_prefix) for link_prefix in link_prefixes)))
+
+    def is_category_link(self, wikilink: str) -> bool:
+        """Whether the given wikilink (including the brackets) is a category link."""
+        return self._link_re.match(wikilink) is not None
+
+    def category_key(self, category: str) -> str:
+        """Normalize the given category name (without namespace),
+        so that two names refer to the same category if and only if their keys are equal.
+
+        This is memoized, since the same categories are compared over and over."""
+        return _category_key(category, self.case)
 
 
 type _SiteInfo = tuple[CategoryInfo, dict[str, str]]
@@ -35,7 +86,7 @@ def _get_siteinfo(session: mwapi.Session) -> _SiteInfo:
     for namespacealias in response['query']['namespacealiases']:
         if namespacealias['id'] == category_namespace_id:
             category_namespace_names.append(namespacealias['alias'])
-    category_info = (category_namespace_name, category_namespace_names, category_namespace_case)
+    category_info = CategoryInfo(category_namespace_name, category_namespace_names, category_namespace_case)
 
     messages = {}
     for message in response['query']['allmessages']:
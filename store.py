@@ -1,6 +1,6 @@
 from abc import ABC, abstractmethod
 import cachetools
-from collections.abc import Sequence
+from collections.abc import Collection, Sequence
 import datetime
 from enum import Enum, unique
 import mwapi  # type: ignore
@@ -16,6 +16,9 @@ from localuser import LocalUser
 
 class BatchStore(ABC):
 
+    background_lease_duration = datetime.timedelta(minutes=10)
+    """How long a background runner may work on a batch without renewing its lease."""
+
     @abstractmethod
     def store_batch(self, new_batch: NewBatch, session: mwapi.Session) -> OpenBatch:
         """Store the given batch and return it as a batch with ID."""
@@ -25,12 +28,21 @@ class BatchStore(ABC):
         """Get the batch with the given ID."""
 
     @abstractmethod
-    def get_batches_slice(self, offset: int, limit: int) -> Sequence[StoredBatch]:
-        """Get up to limit batches from the given offset."""
+    def get_batches_slice(self, offset: int, limit: int, *, before_id: Optional[int] = None, after_id: Optional[int] = None) -> Sequence[StoredBatch]:
+        """Get up to limit batches from the given offset, newest first.
+
+        If before_id or after_id is given, only batches with a lower or higher ID
+        are considered, the offset counting away from that ID;
+        with an offset of 0, this is keyset pagination,
+        which does not need to skip over all the batches of the earlier pages.
+        (after_id returns the batches closest to it, still newest first.)"""
 
     @abstractmethod
     def get_batches_count(self) -> int:
-        """Get the total number of stored batches."""
+        """Get the total number of stored batches.
+
+        The count may be cached for a short time,
+        so batches stored by other processes may be missing from it."""
 
     @abstractmethod
     def start_background(self, batch: OpenBatch, session: mwapi.Session) -> None:
@@ -45,9 +57,70 @@ class BatchStore(ABC):
         """Mark the given batch to stop background runs until the given datetime."""
 
     @abstractmethod
-    def make_plan_pending_background(self, consumer_token: mwoauth.ConsumerToken, user_agent: str) -> Optional[tuple[OpenBatch, CommandPending, mwapi.Session]]:
+    def get_background_sequence(self) -> int:
+        """Get a number that increases whenever a background run is started.
+
+        This is cheap to check, so a background runner that has nothing to do
+        can poll it frequently instead of trying to pick a command."""
+
+    @abstractmethod
+    def get_next_background_wakeup(self) -> Optional[datetime.datetime]:
+        """Get the earliest time when a currently suspended background run may continue, if any."""
+
+    def make_plan_pending_background(self,
+                                     consumer_token: mwoauth.ConsumerToken,
+                                     user_agent: str,
+                                     lease_owner: Optional[str] = None,
+                                     skip_domains: Collection[str] = frozenset(),
+                                     skip_global_user_ids: Collection[int] = frozenset()) -> Optional[tuple[OpenBatch, CommandPending, mwapi.Session]]:
         """Pick one planned command from a batch that’s marked to be run in the background,
-           mark that command as pending and return it with credentials."""
+           mark that command as pending and return it with credentials.
+
+           See make_plans_pending_background for the other parameters."""
+        pending = self.make_plans_pending_background(consumer_token,
+                                                     user_agent,
+                                                     1,
+                                                     lease_owner,
+                                                     skip_domains,
+                                                     skip_global_user_ids)
+        if pending is None:
+            return None
+        batch, [command_pending], session = pending
+        return batch, command_pending, session
+
+    @abstractmethod
+    def make_plans_pending_background(self,
+                                      consumer_token: mwoauth.ConsumerToken,
+                                      user_agent: str,
+                                      limit: int,
+                                      lease_owner: Optional[str] = None,
+                                      skip_domains: Collection[str] = frozenset(),
+                                      skip_global_user_ids: Collection[int] = frozenset()) -> Optional[tuple[OpenBatch, list[CommandPending], mwapi.Session]]:
+        """Pick a batch that’s marked to be run in the background,
+           mark up to limit of its next planned commands as pending
+           and return them (in order) with credentials.
+
+           Batches on the given domains or of the given users are skipped
+           (see EditScheduler).
+
+           Batches leased to another owner are skipped.
+           If a lease owner is given, the batch is leased to it
+           until release_background_lease is called or the lease expires,
+           so that several background runners can work in parallel
+           without running commands of the same batch out of order.
+           Commands that the owner ends up not running
+           should be returned with make_pendings_planned."""
+
+    @abstractmethod
+    def renew_background_lease(self, batch: StoredBatch, lease_owner: str) -> bool:
+        """Extend the lease of the given batch, if it is held by the given owner.
+
+           Returns whether the owner should continue running commands of the batch,
+           i.e. it still holds the lease and the background run was neither stopped nor suspended."""
+
+    @abstractmethod
+    def release_background_lease(self, batch: StoredBatch, lease_owner: str) -> None:
+        """Release the lease of the given batch, if it is held by the given owner."""
 
 
 @unique
@@ -86,6 +159,28 @@ class PreferenceStore(ABC):
         """Set the watchlist parameter preference for the given session."""
 
 
+class TitleHtmlStore(ABC):
+    """A persistent store for rendered batch titles.
+
+    Rendering a batch title takes an API request to the wiki of the batch,
+    so the HTML is stored once it has been rendered, and reused by all processes
+    until it is older than the maximum age requested by the caller
+    (after which it should be rendered again, e.g. because a red link turned blue).
+
+    Titles are identified by their domain and wikitext,
+    so batches with the same title on the same wiki share the stored HTML.
+    """
+
+    @abstractmethod
+    def get_title_htmls(self, titles: Collection[tuple[str, str]], max_age: datetime.timedelta) -> dict[tuple[str, str], str]:
+        """Get the stored HTML of the given (domain, title) pairs,
+        omitting any title that has not been stored in the last max_age."""
+
+    @abstractmethod
+    def set_title_htmls(self, title_htmls: dict[tuple[str, str], str]) -> None:
+        """Store the HTML of the given (domain, title) pairs, rendered just now."""
+
+
 _local_user_cache: cachetools.LRUCache[tuple[str, str], LocalUser] = cachetools.LRUCache(maxsize=1024)
 _local_user_cache_lock = threading.RLock()
 def _local_user_cache_key(session: mwapi.Session) -> tuple[str, str]:
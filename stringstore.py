@@ -1,4 +1,5 @@
 import cachetools
+from collections.abc import Iterable
 from dataclasses import dataclass
 import hashlib
 import operator
@@ -12,12 +13,16 @@ class StringTableStore:
 
     The separate table is expected to have three columns:
     an automatically incrementing ID,
-    an unsigned integer hash (the first four bytes of the SHA2-256 hash of the string),
+    a unique unsigned big integer hash (the first eight bytes of the SHA2-256 hash of the string),
     and the string itself.
 
+    Strings are looked up by their hash, but the stored string is always
+    compared with the requested one, so that a hash collision raises an error
+    instead of silently returning the ID of a different string.
+
     IDs for the least recently used strings are cached,
-    but to look up the string for an ID,
-    callers should use a plain SQL JOIN for now."""
+    and so are the strings for the least recently used IDs (see get_strings),
+    so callers don’t need to JOIN the table to look up the string for an ID."""
 
     table_name: str
     id_column_name: str
@@ -26,31 +31,196 @@ class StringTableStore:
 
     def __post_init__(self) -> None:
         self._cache: cachetools.LRUCache[str, int] = cachetools.LRUCache(maxsize=1024)
+        self._strings_cache: cachetools.LRUCache[int, str] = cachetools.LRUCache(maxsize=4096)
         self._cache_lock = threading.RLock()
 
     def _hash(self, string: str) -> int:
         hex = hashlib.sha256(string.encode('utf8')).hexdigest()
-        return int(hex[:8], base=16)
+        return int(hex[:16], base=16)
 
     @cachetools.cachedmethod(operator.attrgetter('_cache'), key=lambda self, connection, string: string, lock=operator.attrgetter('_cache_lock'))
     def acquire_id(self, connection: pymysql.connections.Connection, string: str) -> int:
         hash = self._hash(string)
 
         with connection.cursor() as cursor:
-            cursor.execute('''SELECT `%s`
-                              FROM `%s`
-                              WHERE `%s` = %%s
-                              FOR UPDATE''' % (self.id_column_name, self.table_name, self.hash_column_name),
-                           (hash,))
-            result = cursor.fetchone()
-        if result:
-            connection.commit()  # finish the FOR UPDATE
-            return result[0]
+            ids_by_hash = self._select_ids(cursor, {hash: string})
+        if ids_by_hash:
+            connection.commit()  # finish the read
+            string_id = ids_by_hash[hash]
+            with self._cache_lock:
+                self._strings_cache[string_id] = string
+            return string_id
 
         with connection.cursor() as cursor:
+            # another writer may have inserted the same string meanwhile;
+            # in that case, LAST_INSERT_ID(…) makes lastrowid return the existing ID
             cursor.execute('''INSERT INTO `%s` (`%s`, `%s`)
-                              VALUES (%%s, %%s)''' % (self.table_name, self.string_column_name, self.hash_column_name),
+                              VALUES (%%s, %%s)
+                              ON DUPLICATE KEY UPDATE `%s` = LAST_INSERT_ID(`%s`)''' % (self.table_name, self.string_column_name, self.hash_column_name, self.id_column_name, self.id_column_name),
                            (string, hash))
             string_id = cursor.lastrowid
+            if cursor.rowcount != 1:  # not inserted, check that the existing row has the same string
+                # (with a locking read, since the row may be newer than our snapshot)
+                self._select_ids(cursor, {hash: string}, lock=True)
         connection.commit()
+        with self._cache_lock:
+            self._strings_cache[string_id] = string
         return string_id
+
+    def acquire_ids(self, connection: pymysql.connections.Connection, strings: Iterable[str]) -> dict[str, int]:
+        """Get the IDs of all the given strings, like acquire_id.
+
+        Uncached strings are looked up with a single query,
+        and missing ones are inserted with a single multi-row INSERT,
+        rather than one round trip (and commit) per string.
+        Returns a dict from each string to its ID."""
+        ids, strings_by_hash = self._get_cached_ids(strings)
+        if not strings_by_hash:
+            return ids
+
+        with connection.cursor() as cursor:
+            ids_by_hash = self._select_ids(cursor, strings_by_hash)
+            missing_hashes = [hash for hash in strings_by_hash if hash not in ids_by_hash]
+            if missing_hashes:
+                # rows inserted by another writer meanwhile are left alone and selected below,
+                # with a locking read, since they may be newer than the snapshot of the first SELECT
+                values = ', '.join(['(%s, %s)'] * len(missing_hashes))
+                cursor.execute('''INSERT INTO `%s` (`%s`, `%s`)
+                                  VALUES %s
+                                  ON DUPLICATE KEY UPDATE `%s` = `%s`''' % (self.table_name, self.string_column_name, self.hash_column_name, values, self.id_column_name, self.id_column_name),
+                               [value
+                                for hash in missing_hashes
+                                for value in (strings_by_hash[hash], hash)])
+                ids_by_hash |= self._select_ids(cursor, {hash: strings_by_hash[hash] for hash in missing_hashes}, lock=True)
+        connection.commit()  # finish the read (and the INSERT)
+
+        with self._cache_lock:
+            for hash, string in strings_by_hash.items():
+                ids[string] = self._cache[string] = ids_by_hash[hash]
+                self._strings_cache[ids_by_hash[hash]] = string
+        return ids
+
+    def find_ids(self, connection: pymysql.connections.Connection, strings: Iterable[str]) -> dict[str, int]:
+        """Get the IDs of those of the given strings that are already stored.
+
+        Unlike acquire_ids, this never inserts any strings,
+        so it is suitable for read-only lookups (e.g. of cached data);
+        strings that are not stored yet are missing from the returned dict."""
+        ids, strings_by_hash = self._get_cached_ids(strings)
+        if not strings_by_hash:
+            return ids
+
+        with connection.cursor() as cursor:
+            ids_by_hash = self._select_ids(cursor, strings_by_hash)
+
+        with self._cache_lock:
+            for hash, string in strings_by_hash.items():
+                if hash in ids_by_hash:
+                    ids[string] = self._cache[string] = ids_by_hash[hash]
+                    self._strings_cache[ids_by_hash[hash]] = string
+                else:
+                    del ids[string]
+        return ids
+
+    def _get_cached_ids(self, strings: Iterable[str]) -> tuple[dict[str, int], dict[int, str]]:
+        """Look up the IDs of the given strings in the cache.
+
+        Returns a dict from each string to its cached ID (or 0 as a placeholder),
+        and a dict from hash to string for the strings that were not cached."""
+        ids: dict[str, int] = {}
+        strings_by_hash: dict[int, str] = {}
+        with self._cache_lock:
+            for string in strings:
+                if string in ids:
+                    continue
+                id = self._cache.get(string)
+                if id is not None:
+                    ids[string] = id
+                else:
+                    hash = self._hash(string)
+                    if strings_by_hash.setdefault(hash, string) != string:
+                        raise HashCollisionError(self.table_name, strings_by_hash[hash], string)
+                    ids[string] = 0  # placeholder until the ID is known (also deduplicates the string)
+        return ids, strings_by_hash
+
+    def get_strings(self, connection: pymysql.connections.Connection, ids: Iterable[int]) -> dict[int, str]:
+        """Get the strings with the given IDs.
+
+        The tables are append-only, so strings are cached by ID indefinitely
+        (bounded by an LRU), and only uncached strings are selected,
+        with a single query, instead of joining the table in every query.
+        Returns a dict from each ID to its string."""
+        strings: dict[int, str] = {}
+        missing_ids: set[int] = set()
+        with self._cache_lock:
+            for id in ids:
+                string = self._strings_cache.get(id)
+                if string is not None:
+                    strings[id] = string
+                else:
+                    missing_ids.add(id)
+        if not missing_ids:
+            return strings
+
+        with connection.cursor() as cursor:
+            cursor.execute('''SELECT `%s`, `%s`
+                              FROM `%s`
+                              WHERE `%s` IN (%s)''' % (self.id_column_name, self.string_column_name, self.table_name, self.id_column_name, ', '.join(['%s'] * len(missing_ids))),
+                           list(missing_ids))
+            rows = cursor.fetchall()
+        with self._cache_lock:
+            for id, string in rows:
+                strings[id] = self._strings_cache[id] = string
+                self._cache[string] = id  # for acquire_id(s), e.g. to look up related rows by string
+        if len(rows) != len(missing_ids):
+            raise KeyError('unknown %s IDs: %s' % (self.table_name, sorted(missing_ids - strings.keys())))
+        return strings
+
+    def preload_strings(self, connection: pymysql.connections.Connection) -> None:
+        """Fill the cache of get_strings with the most recently added strings,
+        e.g. when a long-running process starts."""
+        with connection.cursor() as cursor:
+            cursor.execute('''SELECT `%s`, `%s`
+                              FROM `%s`
+                              ORDER BY `%s` DESC
+                              LIMIT %%s''' % (self.id_column_name, self.string_column_name, self.table_name, self.id_column_name),
+                           (self._strings_cache.maxsize,))
+            rows = cursor.fetchall()
+        with self._cache_lock:
+            for id, string in reversed(rows):  # oldest first, so that the newest strings are the least recently used
+                self._strings_cache[id] = string
+
+    def _select_ids(self, cursor: pymysql.cursors.Cursor, strings_by_hash: dict[int, str], lock: bool = False) -> dict[int, int]:
+        """Select the IDs of the strings with the given hashes, if they exist,
+        checking that the stored strings are the expected ones.
+
+        With lock=True, this is a locking read, which (unlike a plain SELECT
+        under REPEATABLE READ) also sees rows committed after the transaction’s snapshot,
+        e.g. by a concurrent writer whose INSERT made ours a no-op."""
+        hashes = ', '.join(['%s'] * len(strings_by_hash))
+        lock_in_share_mode = 'LOCK IN SHARE MODE' if lock else ''
+        cursor.execute('''SELECT `%s`, `%s`, `%s`
+                          FROM `%s`
+                          WHERE `%s` IN (%s)
+                          %s''' % (self.id_column_name, self.hash_column_name, self.string_column_name, self.table_name, self.hash_column_name, hashes, lock_in_share_mode),
+                       list(strings_by_hash))
+        ids_by_hash = {}
+        for string_id, hash, stored_string in cursor.fetchall():
+            if stored_string != strings_by_hash[hash]:
+                raise HashCollisionError(self.table_name, stored_string, strings_by_hash[hash])
+            ids_by_hash[hash] = string_id
+        return ids_by_hash
+
+
+class HashCollisionError(Exception):
+    """Two different strings of a StringTableStore have the same hash.
+
+    This is extremely unlikely with 64-bit hashes,
+    and the unique index on the hash column cannot store both strings,
+    so it is reported instead of mapping one string to the other’s ID."""
+
+    def __init__(self, table_name: str, string1: str, string2: str) -> None:
+        self.table_name = table_name
+        self.string1 = string1
+        self.string2 = string2
+        super().__init__('hash collision in %s table between %r and %r' % (table_name, string1, string2))
@@ -11,6 +11,10 @@ CREATE TABLE batch (
 CHARACTER SET = 'utf8mb4'
 COLLATE = 'utf8mb4_bin';
 
+-- index for finding the least recently updated batches, optionally skipping certain domains and users,
+-- which the background runner may use (covering, together with the implicit batch_id)
+CREATE INDEX batch_last_updated_domain_localuser ON batch (batch_last_updated_utc_timestamp, batch_domain, batch_localuser);
+
 
 -- commands to be performed for each batch
 CREATE TABLE command (
@@ -30,48 +34,74 @@ COLLATE = 'utf8mb4_bin';
 CREATE INDEX command_batch ON command (command_batch);
 
 -- index for finding commands of a certain batch with a certain status,
--- used by the batch summary and by the background runner (first planned command of a certain batch)
+-- used by the background runner (first planned command of a certain batch) and to recompute batch_status_count
 CREATE INDEX command_batch_status ON command (command_batch, command_status);
 
 
+-- number of commands of each batch with a certain status,
+-- kept up to date together with the commands (and recomputed with DatabaseBatchStore.recompute_status_counts if necessary),
+-- used by the batch summary and command count instead of counting the commands
+CREATE TABLE batch_status_count (
+  batch_status_count_batch int unsigned NOT NULL, -- referencing batch.batch_id
+  batch_status_count_status int unsigned NOT NULL, -- command_status of the commands
+  batch_status_count_count int NOT NULL, -- signed, so that updates can add negative deltas
+  PRIMARY KEY (batch_status_count_batch, batch_status_count_status)
+)
+CHARACTER SET = 'utf8mb4'
+COLLATE = 'utf8mb4_bin';
+
+
 -- wiki domains (normalized)
 CREATE TABLE domain (
   domain_id int unsigned NOT NULL PRIMARY KEY AUTO_INCREMENT,
-  domain_hash int unsigned NOT NULL, -- first four bytes of the SHA2-256 hash of the domain_name
+  domain_hash bigint unsigned NOT NULL, -- first eight bytes of the SHA2-256 hash of the domain_name
   domain_name varchar(255) binary NOT NULL
 )
 CHARACTER SET = 'utf8mb4'
 COLLATE = 'utf8mb4_bin';
 
--- index for finding a domain ID by its hash
-CREATE INDEX domain_hash ON domain (domain_hash);
+-- unique index for finding a domain ID by its hash
+CREATE UNIQUE INDEX domain_hash ON domain (domain_hash);
 
 
 -- batch titles (normalized)
 CREATE TABLE title (
   title_id int unsigned NOT NULL PRIMARY KEY AUTO_INCREMENT,
-  title_hash int unsigned NOT NULL, -- first four bytes of the SHA2-256 hash of the title_text
+  title_hash bigint unsigned NOT NULL, -- first eight bytes of the SHA2-256 hash of the title_text
   title_text varchar(255) binary NOT NULL
 )
 CHARACTER SET = 'utf8mb4'
 COLLATE = 'utf8mb4_bin';
 
--- index for finding a title ID by its hash
-CREATE INDEX title_hash ON title (title_hash);
+-- unique index for finding a title ID by its hash
+CREATE UNIQUE INDEX title_hash ON title (title_hash);
+
+
+-- rendered HTML of batch titles (per wiki, since links depend on the wiki),
+-- rendered again by the tool once it is too old
+CREATE TABLE title_html (
+  title_html_domain int unsigned NOT NULL, -- referencing domain.domain_id
+  title_html_title int unsigned NOT NULL, -- referencing title.title_id
+  title_html_html text NOT NULL,
+  title_html_rendered_utc_timestamp int unsigned NOT NULL,
+  PRIMARY KEY (title_html_domain, title_html_title)
+)
+CHARACTER SET = 'utf8mb4'
+COLLATE = 'utf8mb4_bin';
 
 
 -- actions of commands (normalized)
 -- table name is plural because an individual row lists multiple actions (they are not split up)
 CREATE TABLE actions (
   actions_id int unsigned NOT NULL PRIMARY KEY AUTO_INCREMENT,
-  actions_hash int unsigned NOT NULL, -- first four bytes of the SHA2-256 hash of the actions_tpsv
+  actions_hash bigint unsigned NOT NULL, -- first eight bytes of the SHA2-256 hash of the actions_tpsv
   actions_tpsv text NOT NULL
 )
 CHARACTER SET = 'utf8mb4'
 COLLATE = 'utf8mb4_bin';
 
--- index for finding an actions ID by its hash
-CREATE INDEX actions_hash ON actions (actions_hash);
+-- unique index for finding an actions ID by its hash
+CREATE UNIQUE INDEX actions_hash ON actions (actions_hash);
 
 
 -- background runs of batches
@@ -95,6 +125,16 @@ CREATE INDEX background_batch_stopped ON background (background_batch, backgroun
 CREATE INDEX background_stopped_suspended_batch ON background (background_stopped_utc_timestamp, background_suspended_until_utc_timestamp, background_batch);
 
 
+-- leases of batches to background runners, so that at most one runner works on any batch at a time
+CREATE TABLE lease (
+  lease_batch int unsigned NOT NULL PRIMARY KEY, -- referencing batch.batch_id
+  lease_owner varchar(255) binary NOT NULL, -- identifies the background runner (host, process and thread)
+  lease_expires_utc_timestamp int unsigned NOT NULL -- the lease is ignored after this time, in case the owner crashed
+)
+CHARACTER SET = 'utf8mb4'
+COLLATE = 'utf8mb4_bin';
+
+
 -- user accounts local to wikis
 CREATE TABLE localuser (
   localuser_id int unsigned NOT NULL PRIMARY KEY AUTO_INCREMENT,
@@ -150,11 +190,11 @@ CREATE INDEX querytime_utc_timestamp_duration_querytext ON querytime (querytime_
 -- text of SQL queries (normalized)
 CREATE TABLE querytext (
   querytext_id int unsigned NOT NULL PRIMARY KEY AUTO_INCREMENT,
-  querytext_hash int unsigned NOT NULL, -- first four bytes of the SHA2-256 hash of the querytext_sql
+  querytext_hash bigint unsigned NOT NULL, -- first eight bytes of the SHA2-256 hash of the querytext_sql
   querytext_sql text NOT NULL
 )
 CHARACTER SET = 'utf8mb4'
 COLLATE = 'utf8mb4_bin';
 
--- index for finding a querytext ID by its hash
-CREATE INDEX querytext_hash ON querytext (querytext_hash);
+-- unique index for finding a querytext ID by its hash
+CREATE UNIQUE INDEX querytext_hash ON querytext (querytext_hash);
@@ -1,6 +1,10 @@
+import dataclasses
+import mwparserfromhell
 import pytest
+from random import Random
 
-from action import AddCategoryAction, AddCategoryAndSortKeyAction, AddCategoryWithSortKeyAction, AddCategoryProvideSortKeyAction, AddCategoryReplaceSortKeyAction, CategoryAction, RemoveCategoryAction, RemoveCategoryWithSortKeyAction
+from action import AddCategoryAction, AddCategoryAndSortKeyAction, AddCategoryWithSortKeyAction, AddCategoryProvideSortKeyAction, AddCategoryReplaceSortKeyAction, CategoryAction, CategoryTail, RemoveCategoryAction, RemoveCategoryWithSortKeyAction
+from siteinfo import CategoryInfo
 
 
 addCategory1 = AddCategoryAction('Cat 1')
@@ -49,7 +53,7 @@ def test_CategoryAction_init_category_namespace(class_: type[CategoryAction]) ->
 ])
 def test_AddCategoryAction_apply(wikitext: str, expected: str) -> None:
     action = AddCategoryAction('Test')
-    actual = action.apply(wikitext, ('Category', ['Category', 'Kategorie', 'K'], 'first-letter'))
+    actual = action.apply(wikitext, CategoryInfo('Category', ['Category', 'Kategorie', 'K'], 'first-letter'))
     assert expected == actual
 
 @pytest.mark.parametrize('wikitext, category', [
@@ -63,7 +67,7 @@ def test_AddCategoryAction_apply(wikitext: str, expected: str) -> None:
 ])
 def test_AddCategoryAction_apply_whitespace(wikitext: str, category: str) -> None:
     action = AddCategoryAction(category)
-    assert wikitext == action.apply(wikitext, ('Category', ['Category'], 'first-letter'))
+    assert wikitext == action.apply(wikitext, CategoryInfo('Category', ['Category'], 'first-letter'))
 
 # note: the following test is no longer as relevant since we clean up all new batches to never contain underscores
 def test_AddCategoryAction_apply_preserves_underscores() -> None:
@@ -73,26 +77,36 @@ def test_AddCategoryAction_apply_preserves_underscores() -> None:
     expected = '[[Category:Test Category 1]]\n[[Category:Test_Category_2]]\n[[Category:Test_Category 3]]'
     actual = ''
     for action in [action1, action2, action3]:
-        actual = action.apply(actual, ('Category', ['Category'], 'first-letter'))
+        actual = action.apply(actual, CategoryInfo('Category', ['Category'], 'first-letter'))
     assert expected == actual
 
 def test_AddCategoryAction_apply_case_sensitive() -> None:
     action = AddCategoryAction('Test')
     wikitext = '[[Category:test]]'
     expected = '[[Category:test]]\n[[Category:Test]]'
-    assert expected == action.apply(wikitext, ('Category', ['Category'], 'case-sensitive'))
+    assert expected == action.apply(wikitext, CategoryInfo('Category', ['Category'], 'case-sensitive'))
 
 def test_AddCategoryAction_summary() -> None:
-    assert AddCategoryAction('Test').summary(('Kategorie', ['Kategorie', 'Category'], 'first-letter')) == '+[[Kategorie:Test]]'
+    assert AddCategoryAction('Test').summary(CategoryInfo('Kategorie', ['Kategorie', 'Category'], 'first-letter')) == '+[[Kategorie:Test]]'
 
 def test_AddCategoryAction_is_minor() -> None:
     assert AddCategoryAction('Test').is_minor()
 
 def test_AddCategoryAction_cleanup() -> None:
     action = AddCategoryAction('User_input_from_URL')
-    action.cleanup()
+    action = action.cleanup()
     assert action == AddCategoryAction('User input from URL')
 
+def test_AddCategoryAction_cleanup_unchanged() -> None:
+    action = AddCategoryAction('Clean input')
+    assert action.cleanup() is action
+
+def test_AddCategoryAction_immutable() -> None:
+    action = AddCategoryAction('Test')
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        action.category = 'Other'  # type: ignore
+    assert not hasattr(action, '__dict__')
+
 def test_AddCategoryAction_str() -> None:
     assert str(addCategory1) == '+Category:Cat 1'
 
@@ -104,7 +118,7 @@ def test_AddCategoryAndSortKeyAction_init_empty_sort_key(class_: type[AddCategor
 
 @pytest.mark.parametrize('class_', [AddCategoryWithSortKeyAction, AddCategoryProvideSortKeyAction, AddCategoryReplaceSortKeyAction])
 def test_AddCategoryAndSortKeyAction_summary(class_: type[AddCategoryAndSortKeyAction]) -> None:
-    assert class_('Test', 'Sortierschlüssel').summary(('Kategorie', ['Kategorie', 'Category'], 'first-letter')) == '+[[Kategorie:Test|Kategorie:Test|Sortierschlüssel]]'
+    assert class_('Test', 'Sortierschlüssel').summary(CategoryInfo('Kategorie', ['Kategorie', 'Category'], 'first-letter')) == '+[[Kategorie:Test|Kategorie:Test|Sortierschlüssel]]'
 
 
 @pytest.mark.parametrize('wikitext, expected', [
@@ -114,7 +128,7 @@ def test_AddCategoryAndSortKeyAction_summary(class_: type[AddCategoryAndSortKeyA
 ])
 def test_AddCategoryWithSortKeyAction_apply(wikitext: str, expected: str) -> None:
     action = AddCategoryWithSortKeyAction('Test', 'sort key')
-    actual = action.apply(wikitext, ('Category', ['Category', 'Kategorie', 'K'], 'first-letter'))
+    actual = action.apply(wikitext, CategoryInfo('Category', ['Category', 'Kategorie', 'K'], 'first-letter'))
     assert expected == actual
 
 def test_AddCategoryWithSortKeyAction_str() -> None:
@@ -128,7 +142,7 @@ def test_AddCategoryWithSortKeyAction_str() -> None:
 ])
 def test_AddCategoryProvideSortKeyAction_apply(wikitext: str, expected: str) -> None:
     action = AddCategoryProvideSortKeyAction('Test', 'sort key')
-    actual = action.apply(wikitext, ('Category', ['Category', 'Kategorie', 'K'], 'first-letter'))
+    actual = action.apply(wikitext, CategoryInfo('Category', ['Category', 'Kategorie', 'K'], 'first-letter'))
     assert expected == actual
 
 def test_AddCategoryProvideSortKeyAction_str() -> None:
@@ -142,16 +156,28 @@ def test_AddCategoryProvideSortKeyAction_str() -> None:
 ])
 def test_AddCategoryReplaceSortKeyAction_apply(wikitext: str, expected: str) -> None:
     action = AddCategoryReplaceSortKeyAction('Test', 'sort key')
-    actual = action.apply(wikitext, ('Category', ['Category', 'Kategorie', 'K'], 'first-letter'))
+    actual = action.apply(wikitext, CategoryInfo('Category', ['Category', 'Kategorie', 'K'], 'first-letter'))
     assert expected == actual
 
 def test_AddCategoryReplaceSortKeyAction_apply_remove_sort_key() -> None:
     action = AddCategoryReplaceSortKeyAction('Test', None)
     wikitext = '[[Category:Test|sort key]]'
     expected = '[[Category:Test]]'
-    actual = action.apply(wikitext, ('Category', ['Category', 'Kategorie', 'K'], 'first-letter'))
+    actual = action.apply(wikitext, CategoryInfo('Category', ['Category', 'Kategorie', 'K'], 'first-letter'))
     assert expected == actual
 
+@pytest.mark.parametrize('wikitext, changed', [
+    ('', True),
+    ('[[Category:Test]]', True),
+    ('[[Category:Test|other sort key]]', True),
+    ('[[Category:Test|sort key]]', False),
+])
+def test_AddCategoryReplaceSortKeyAction_apply_to_wikicode(wikitext: str, changed: bool) -> None:
+    action = AddCategoryReplaceSortKeyAction('Test', 'sort key')
+    wikicode = mwparserfromhell.parse(wikitext)
+    assert action.apply_to_wikicode(wikicode, CategoryInfo('Category', ['Category'], 'first-letter')) == changed
+    assert (str(wikicode) != wikitext) == changed
+
 def test_AddCategoryReplaceSortKeyAction_str() -> None:
     assert str(addCategoryReplaceSortKey1) == '+Category:Cat 1###sort key'
 
@@ -175,7 +201,7 @@ def test_AddCategoryReplaceSortKeyAction_str() -> None:
 ])
 def test_RemoveCategoryAction_apply(wikitext: str, expected: str) -> None:
     action = RemoveCategoryAction('Test')
-    actual = action.apply(wikitext, ('Category', ['Category', 'Kategorie', 'K'], 'first-letter'))
+    actual = action.apply(wikitext, CategoryInfo('Category', ['Category', 'Kategorie', 'K'], 'first-letter'))
     assert expected == actual
 
 @pytest.mark.parametrize('wikitext, category', [
@@ -189,23 +215,23 @@ def test_RemoveCategoryAction_apply(wikitext: str, expected: str) -> None:
 ])
 def test_RemoveCategoryAction_apply_whitespace(wikitext: str, category: str) -> None:
     action = RemoveCategoryAction(category)
-    actual = action.apply(wikitext, ('Category', ['Category'], 'first-letter'))
+    actual = action.apply(wikitext, CategoryInfo('Category', ['Category'], 'first-letter'))
     assert '' == actual
 
 def test_RemoveCategoryAction_apply_case_sensitive() -> None:
     action = RemoveCategoryAction('Test')
     wikitext = '[[category:test]]'
-    assert wikitext == action.apply(wikitext, ('Category', ['Category'], 'case-sensitive'))
+    assert wikitext == action.apply(wikitext, CategoryInfo('Category', ['Category'], 'case-sensitive'))
 
 def test_RemoveCategoryAction_summary() -> None:
-    assert RemoveCategoryAction('Test').summary(('Kategorie', ['Kategorie', 'Category'], 'first-letter')) == '-[[Kategorie:Test]]'
+    assert RemoveCategoryAction('Test').summary(CategoryInfo('Kategorie', ['Kategorie', 'Category'], 'first-letter')) == '-[[Kategorie:Test]]'
 
 def test_RemoveCategoryAction_is_minor() -> None:
     assert not RemoveCategoryAction('Test').is_minor()
 
 def test_RemoveCategoryAction_cleanup() -> None:
     action = RemoveCategoryAction('User_input_from_URL')
-    action.cleanup()
+    action = action.cleanup()
     assert action == RemoveCategoryAction('User input from URL')
 
 def test_RemoveCategoryAction_str() -> None:
@@ -217,7 +243,7 @@ def test_RemoveCategoryWithSortKeyAction_init_empty_sort_key() -> None:
         RemoveCategoryWithSortKeyAction('Category', '')
 
 def test_RemoveCategoryWithSortKeyAction_summary() -> None:
-    assert RemoveCategoryWithSortKeyAction('Test', 'Sortierschlüssel').summary(('Kategorie', ['Kategorie', 'Category'], 'first-letter')) == '-[[Kategorie:Test|Kategorie:Test|Sortierschlüssel]]'
+    assert RemoveCategoryWithSortKeyAction('Test', 'Sortierschlüssel').summary(CategoryInfo('Kategorie', ['Kategorie', 'Category'], 'first-letter')) == '-[[Kategorie:Test|Kategorie:Test|Sortierschlüssel]]'
 
 @pytest.mark.parametrize('wikitext, expected', [
     ('', ''),
@@ -226,8 +252,72 @@ def test_RemoveCategoryWithSortKeyAction_summary() -> None:
 ])
 def test_RemoveCategoryWithSortKeyAction_apply(wikitext: str, expected: str) -> None:
     action = RemoveCategoryWithSortKeyAction('Test', 'sort key')
-    actual = action.apply(wikitext, ('Category', ['Category', 'Kategorie', 'K'], 'first-letter'))
+    actual = action.apply(wikitext, CategoryInfo('Category', ['Category', 'Kategorie', 'K'], 'first-letter'))
     assert expected == actual
 
 def test_RemoveCategoryWithSortKeyAction_str() -> None:
     assert str(removeCategoryWithSortKey1) == '-Category:Cat 1#sort key'
+
+
+@pytest.mark.parametrize('wikitext, head', [
+    ('', ''),
+    ('Text', 'Text'),
+    ('Text\n[[Category:A]]\n[[K:B|sort key]]\n', 'Text\n'),
+    ('{{Template}}\n\n[[Category:A]] [[Category:B]]', '{{Template}}\n\n'),
+    ('{{Unclosed template\n[[Category:A]]', '{{Unclosed template\n'),
+])
+def test_CategoryTail_split(wikitext: str, head: str) -> None:
+    category_tail = CategoryTail.split(wikitext, CategoryInfo('Category', ['Category', 'K'], 'first-letter'))
+    assert category_tail is not None
+    assert category_tail.head == head
+    assert str(category_tail) == wikitext
+
+@pytest.mark.parametrize('wikitext', [
+    '[[Category:A]]\nText',
+    'Text [[Category:A]]',
+    '[[Category:A]]\n{{Template}}\n[[Category:B]]',
+    '<!-- [[Category:A]] -->\n[[Category:B]]',
+    '{{Template|\n[[Category:A]]\n}}',
+    '[[Category:A]]\n[[de:A]]',
+])
+def test_CategoryTail_split_ambiguous(wikitext: str) -> None:
+    assert CategoryTail.split(wikitext, CategoryInfo('Category', ['Category', 'K'], 'first-letter')) is None
+
+differential_fragments = [
+    'Text', 'Text\n', '\n', '\n\n', ' ',
+    '[[Category:A]]', '[[Category:B|sort key]]', '[[Category:C|]]', '[[K:A]]', '[[Category: a ]]', '[[category:B]]', '[[:Category:A]]', '[[Category:A&amp;B]]',
+    '[[de:A]]', '[[File:X.jpg|thumb|', '[[Link]]', ']]',
+    '{{Template}}', '{{Template|[[Category:B]]}}', '{{Unclosed', '}}', '{|', '|}',
+    '<!-- [[Category:C]] -->', '<!-- unclosed', '<nowiki>', '</nowiki>', '<ref>', '<pre>',
+    "''", '== Heading ==', '=', '* ', '[http://example.com', '[//', 'http://example.com', '&amp;',
+]
+differential_actions = [
+    AddCategoryAction('A'), AddCategoryAction('D'),
+    AddCategoryWithSortKeyAction('B', 'x'), AddCategoryProvideSortKeyAction('A', 'y'), AddCategoryProvideSortKeyAction('C', 'y'),
+    AddCategoryReplaceSortKeyAction('B', None), AddCategoryReplaceSortKeyAction('D', 'z'),
+    RemoveCategoryAction('A'), RemoveCategoryAction('B'), RemoveCategoryAction('D'),
+    RemoveCategoryWithSortKeyAction('B', 'sort key'), RemoveCategoryWithSortKeyAction('C', None),
+]
+
+@pytest.mark.parametrize('seed', range(10))
+def test_apply_to_category_tail_same_as_apply_to_wikicode(seed: int) -> None:
+    category_info = CategoryInfo('Category', ['Category', 'K'], 'first-letter')
+    random = Random(seed)
+    split_pages = 0
+    for i in range(500):
+        wikitext = ''.join(random.choices(differential_fragments, k=random.randrange(8)))
+        if random.randrange(2):
+            wikitext += '\n' + ''.join(random.choices(['[[Category:A]]', '[[Category:B|sort key]]', '[[K:C]]', '\n', ' '], k=random.randrange(1, 6)))
+        actions = random.choices(differential_actions, k=random.randrange(1, 5))
+
+        category_tail = CategoryTail.split(wikitext, category_info)
+        if category_tail is None:
+            continue
+        split_pages += 1
+        wikicode = mwparserfromhell.parse(wikitext)
+        for action in actions:
+            expected_changed = action.apply_to_wikicode(wikicode, category_info)
+            actual_changed = action.apply_to_category_tail(category_tail, category_info)
+            assert actual_changed == expected_changed, (wikitext, actions)
+            assert str(category_tail) == str(wikicode), (wikitext, actions)
+    assert split_pages >= 50  # make sure the fast path is actually exercised
@@ -65,6 +65,31 @@ def test_slice_from_args_with_invalid_offset(offset: str) -> None:
 def test_slice_from_args_with_invalid_limit(limit: str, effective_limit: int) -> None:
     assert quickcategories.slice_from_args({'limit': limit}) == (0, effective_limit)
 
+def test_keyset_from_args_default() -> None:
+    assert quickcategories.keyset_from_args({}) == (None, None)
+
+def test_keyset_from_args_with_after() -> None:
+    assert quickcategories.keyset_from_args({'after': '1234'}) == (1234, None)
+
+def test_keyset_from_args_with_before() -> None:
+    assert quickcategories.keyset_from_args({'before': '1234'}) == (None, 1234)
+
+def test_keyset_from_args_with_after_and_before() -> None:
+    assert quickcategories.keyset_from_args({'after': '12', 'before': '34'}) == (12, None)
+
+@pytest.mark.parametrize('id', [
+    '-1',
+    'one hundred',
+    '; DROP DATABASE; --',
+])
+def test_keyset_from_args_with_invalid_id(id: str) -> None:
+    assert quickcategories.keyset_from_args({'after': id, 'before': id}) == (None, None)
+
+def test_keyset_offset() -> None:
+    assert quickcategories.keyset_offset(100, None, None) == 100
+    assert quickcategories.keyset_offset(100, 1234, None) == 0
+    assert quickcategories.keyset_offset(100, None, 1234) == 0
+
 
 def test_steward_global_user_ids_Martin_Urbanec(internet_connection: None) -> None:
     assert 34722510 in quickcategories.steward_global_user_ids()
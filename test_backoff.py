@@ -0,0 +1,31 @@
+from backoff import AdaptiveBackoff
+
+
+def test_AdaptiveBackoff_exponential() -> None:
+    backoff = AdaptiveBackoff(base=1, default_cap=5, uniform=lambda a, b: b)
+    assert [backoff.failure('test.wikipedia.org') for _ in range(5)] == [1, 2, 4, 5, 5]
+
+def test_AdaptiveBackoff_reported_limit() -> None:
+    backoff = AdaptiveBackoff(base=1, max_cap=60, uniform=lambda a, b: b)
+    assert [backoff.failure('test.wikipedia.org', 3) for _ in range(3)] == [1, 2, 3]
+    assert backoff.failure('test.wikipedia.org', 0.1) == 1  # never below base
+    assert [backoff.failure('test.wikipedia.org', 600) for _ in range(3)] == [16, 32, 60]  # never above max_cap
+
+def test_AdaptiveBackoff_success_resets() -> None:
+    backoff = AdaptiveBackoff(uniform=lambda a, b: b)
+    backoff.failure('test.wikipedia.org')
+    backoff.failure('test.wikipedia.org')
+    backoff.success('test.wikipedia.org')
+    assert backoff.failure('test.wikipedia.org') == 1
+
+def test_AdaptiveBackoff_per_host() -> None:
+    backoff = AdaptiveBackoff(uniform=lambda a, b: b)
+    backoff.failure('test.wikipedia.org')
+    backoff.failure('test.wikipedia.org')
+    assert backoff.failure('test.wikidata.org') == 1
+
+def test_AdaptiveBackoff_jitter() -> None:
+    backoff = AdaptiveBackoff(base=2)
+    for _ in range(100):
+        backoff.success('test.wikipedia.org')
+        assert 1 <= backoff.failure('test.wikipedia.org') <= 2
@@ -1,12 +1,15 @@
 import datetime
+import mwparserfromhell
 import pytest
+from random import Random
 from typing import TypedDict
 
-from action import AddCategoryAction, RemoveCategoryAction
+from action import Action, AddCategoryAction, AddCategoryWithSortKeyAction, AddCategoryProvideSortKeyAction, AddCategoryReplaceSortKeyAction, RemoveCategoryAction, RemoveCategoryWithSortKeyAction
 from command import Command, CommandPlan, CommandPending, CommandEdit, CommandNoop, CommandCreation, CommandPageMissing, CommandTitleInvalid, CommandTitleInterwiki, CommandPageProtected, CommandPageBadContentFormat, CommandPageBadContentModel, CommandEditConflict, CommandMaxlagExceeded, CommandBlocked, CommandWikiReadOnly
 from page import Page
+from siteinfo import CategoryInfo
 
-from test_action import addCategory1, removeCategory1, addCategory2
+from test_action import addCategory1, removeCategory1, addCategory2, differential_fragments, differential_actions
 
 
 page1 = Page('Page 1', resolve_redirects=True, create_missing_page=None)
@@ -26,13 +29,78 @@ def test_Command_apply() -> None:
                                                                AddCategoryAction('Already present cat'),
                                                                RemoveCategoryAction('Removed cat'),
                                                                RemoveCategoryAction('Not present cat')])
-    new_wikitext, actions = command.apply(wikitext, ('Category', ['Category'], 'first-letter'))
+    new_wikitext, actions = command.apply(wikitext, CategoryInfo('Category', ['Category'], 'first-letter'))
     assert new_wikitext == 'Test page for the QuickCategories tool.\n[[Category:Already present cat]]\n[[Category:Added cat]]\nBottom text'
     assert actions == [(command.actions[0], False),
                        (command.actions[1], True),
                        (command.actions[2], False),
                        (command.actions[3], True)]
 
+def apply_separately(wikitext: str, actions: list[Action], category_info: CategoryInfo) -> tuple[str, list[tuple[Action, bool]]]:
+    """Apply the actions one after another, parsing the wikitext again for each one,
+    like Command.apply originally did (before it parsed the wikitext only once)."""
+    noops = []
+    for action in actions:
+        wikicode = mwparserfromhell.parse(wikitext)
+        action.apply_to_wikicode(wikicode, category_info)
+        new_wikitext = str(wikicode)
+        noops.append((action, new_wikitext == wikitext))
+        wikitext = new_wikitext
+    return wikitext, noops
+
+@pytest.mark.parametrize('wikitext', [
+    '',
+    'Text',
+    '[[Category:A]]',
+    'Text\n[[Category:A]]\n[[Category:B|sort key]]\nBottom text',
+    '[[Category:B]][[Category:A]]\n\n[[Category:A]]',
+    '{{Template|[[Category:A]]}}\n[[Category:B]]',
+    '<!-- [[Category:A]] -->\n[[Category:C|]]',
+    '=[[K:C]]=',
+    '[//[[K:C]]]',
+    '[[Category:A]]\n[[Category:B]]\n',
+    'Text\n[[Category:A]]\nText\n[[Category:B]]\n',
+])
+@pytest.mark.parametrize('actions', [
+    [AddCategoryAction('A'), AddCategoryAction('C')],
+    [AddCategoryAction('C'), RemoveCategoryAction('C')],
+    [RemoveCategoryAction('A'), RemoveCategoryAction('A'), AddCategoryAction('A')],
+    [RemoveCategoryAction('B'), RemoveCategoryAction('A'), RemoveCategoryAction('C')],
+    [AddCategoryWithSortKeyAction('D', 'x'), AddCategoryProvideSortKeyAction('A', 'y'), AddCategoryReplaceSortKeyAction('B', None)],
+    [AddCategoryReplaceSortKeyAction('C', None), RemoveCategoryWithSortKeyAction('B', 'sort key'), AddCategoryAction('E')],
+    [AddCategoryReplaceSortKeyAction('B', None), RemoveCategoryAction('C')],
+    [AddCategoryAction('D'), RemoveCategoryAction('C')],
+])
+def test_Command_apply_same_as_separate_actions(wikitext: str, actions: list[Action]) -> None:
+    category_info = CategoryInfo('Category', ['Category', 'K'], 'first-letter')
+    command = Command(Page('Page title', **irrelevant_flags), actions)
+    assert command.apply(wikitext, category_info) == apply_separately(wikitext, actions, category_info)
+
+@pytest.mark.parametrize('wikitext, actions, expected_wikitext', [
+    ('=[[K:C]]=', [AddCategoryReplaceSortKeyAction('B', None), RemoveCategoryAction('C')], '=[[Category:B]]='),
+    ('[//[[K:C]]]', [AddCategoryAction('D'), RemoveCategoryAction('C')], '[//[[Category:D]]]'),
+    ('[[Category:A]]\n[[Category:B]]\n', [RemoveCategoryAction('B'), RemoveCategoryAction('A')], ''),
+])
+def test_Command_apply_reparsed(wikitext: str, actions: list[Action], expected_wikitext: str) -> None:
+    """Later actions see the wikitext as if it had been parsed again after the earlier ones."""
+    category_info = CategoryInfo('Category', ['Category', 'K'], 'first-letter')
+    command = Command(Page('Page title', **irrelevant_flags), actions)
+    new_wikitext, noops = command.apply(wikitext, category_info)
+    assert new_wikitext == expected_wikitext
+    assert not any(noop for action, noop in noops)
+
+@pytest.mark.parametrize('seed', range(10))
+def test_Command_apply_same_as_separate_actions_random(seed: int) -> None:
+    category_info = CategoryInfo('Category', ['Category', 'K'], 'first-letter')
+    random = Random(seed)
+    for i in range(500):
+        wikitext = ''.join(random.choices(differential_fragments, k=random.randrange(8)))
+        if random.randrange(2):
+            wikitext += '\n' + ''.join(random.choices(['[[Category:A]]', '[[Category:B|sort key]]', '[[K:C]]', '\n', ' '], k=random.randrange(1, 6)))
+        actions: list[Action] = list(random.choices(differential_actions, k=random.randrange(1, 5)))
+        command = Command(Page('Page title', **irrelevant_flags), actions)
+        assert command.apply(wikitext, category_info) == apply_separately(wikitext, actions, category_info), (wikitext, actions)
+
 def test_Command_cleanup() -> None:
     command = Command(Page('Page_from_URL', **irrelevant_flags), [AddCategoryAction('Category_from_URL')])
     command.cleanup()
@@ -48,6 +116,12 @@ def test_Command_str() -> None:
 commandPlan1 = CommandPlan(42, command1)
 
 
+def test_CommandRecord_slots() -> None:
+    for record in [CommandPlan(0, command1), CommandEdit(0, command1, 1, 2), CommandEditConflict(0, command1)]:
+        assert not hasattr(record, '__dict__')
+    assert not hasattr(command1, '__dict__')
+    assert not hasattr(command1.page, '__dict__')
+
 def test_CommandPlan_str() -> None:
     assert str(commandPlan1) == str(command1)
 
@@ -0,0 +1,146 @@
+import pymysql
+import pytest
+import threading
+from typing import Any, cast
+from unittest.mock import Mock
+
+from connectionpool import ConnectionPool, ConnectionPoolTimeout
+
+from test_scheduler import FakeClock
+
+
+def make_pool(**kwargs: Any) -> tuple[ConnectionPool, FakeClock]:
+    clock = FakeClock()
+    pool = ConnectionPool(lambda: Mock(), clock=clock, **kwargs)
+    return pool, clock
+
+
+def test_ConnectionPool_reuse() -> None:
+    pool, clock = make_pool()
+    with pool.connection() as connection1:
+        pass
+    assert cast(Mock, connection1.rollback).called
+    assert not cast(Mock, connection1.close).called
+    with pool.connection() as connection2:
+        assert connection2 is connection1
+        with pool.connection() as connection3:
+            assert connection3 is not connection1
+    stats = pool.stats()
+    assert stats['created'] == 2
+    assert stats['reused'] == 1
+    assert stats['open'] == 2
+    assert stats['idle'] == 2
+    assert stats['in_use'] == 0
+
+def test_ConnectionPool_most_recently_used_first() -> None:
+    pool, clock = make_pool()
+    with pool.connection() as connection1, pool.connection() as connection2:
+        pass
+    # connection1 was released last
+    with pool.connection() as connection:
+        assert connection is connection1
+    with pool.connection() as connection, pool.connection() as connection_:
+        assert connection is connection1
+        assert connection_ is connection2
+
+def test_ConnectionPool_max_size() -> None:
+    pool, clock = make_pool(max_size=2, timeout=0)
+    with pool.connection(), pool.connection():
+        with pytest.raises(ConnectionPoolTimeout):
+            pool.acquire()
+    assert pool.stats()['timeouts'] == 1
+    with pool.connection(), pool.connection():
+        pass
+    assert pool.stats()['created'] == 2
+
+def test_ConnectionPool_waits_for_release() -> None:
+    pool = ConnectionPool(lambda: Mock(), max_size=1, timeout=10)
+    connection1 = pool.acquire()
+    acquired = []
+    thread = threading.Thread(target=lambda: acquired.append(pool.acquire()))
+    thread.start()
+    while pool.stats()['waits'] == 0:
+        pass
+    pool.release(connection1)
+    thread.join()
+    assert acquired == [connection1]
+
+def test_ConnectionPool_error() -> None:
+    pool, clock = make_pool()
+    with pytest.raises(ValueError):
+        with pool.connection() as connection1:
+            raise ValueError
+    assert cast(Mock, connection1.close).called
+    assert not cast(Mock, connection1.rollback).called
+    with pool.connection() as connection2:
+        assert connection2 is not connection1
+    assert pool.stats()['closed'] == 1
+
+def test_ConnectionPool_failed_rollback() -> None:
+    pool, clock = make_pool()
+    with pool.connection() as connection1:
+        cast(Mock, connection1.rollback).side_effect = pymysql.err.OperationalError
+    assert cast(Mock, connection1.close).called
+    stats = pool.stats()
+    assert stats['open'] == 0
+    assert stats['closed'] == 1
+
+def test_ConnectionPool_failed_connect() -> None:
+    pool = ConnectionPool(Mock(side_effect=pymysql.err.OperationalError), max_size=1, timeout=0)
+    for i in range(2):
+        with pytest.raises(pymysql.err.OperationalError):
+            pool.acquire()
+    assert pool.stats()['open'] == 0
+
+def test_ConnectionPool_health_check() -> None:
+    pool, clock = make_pool(check_after=30)
+    with pool.connection() as connection1:
+        pass
+    clock.now += 10
+    with pool.connection() as connection:
+        assert connection is connection1
+    assert not cast(Mock, connection1.ping).called
+    clock.now += 40
+    with pool.connection() as connection:
+        assert connection is connection1
+    cast(Mock, connection1.ping).assert_called_once_with(reconnect=False)
+    clock.now += 40
+    cast(Mock, connection1.ping).side_effect = pymysql.err.OperationalError
+    with pool.connection() as connection2:
+        assert connection2 is not connection1
+    assert cast(Mock, connection1.close).called
+    assert pool.stats()['failed_checks'] == 1
+
+def test_ConnectionPool_max_idle() -> None:
+    pool, clock = make_pool(max_idle=300, check_after=1000)
+    with pool.connection() as connection1:
+        pass
+    clock.now += 301
+    with pool.connection() as connection2:
+        assert connection2 is not connection1
+    assert cast(Mock, connection1.close).called
+    assert pool.stats()['open'] == 1
+
+def test_ConnectionPool_max_idle_frees_room() -> None:
+    pool, clock = make_pool(max_size=1, max_idle=300, check_after=1000, timeout=0)
+    with pool.connection() as connection1:
+        pass
+    clock.now += 301
+    with pool.connection() as connection2:
+        assert connection2 is not connection1
+
+def test_ConnectionPool_max_lifetime() -> None:
+    pool, clock = make_pool(max_lifetime=3600, max_idle=1000, check_after=1000)
+    with pool.connection() as connection1:
+        clock.now += 3601
+    assert cast(Mock, connection1.close).called
+    assert pool.stats()['open'] == 0
+
+def test_ConnectionPool_close_idle() -> None:
+    pool, clock = make_pool()
+    with pool.connection() as connection1, pool.connection() as connection2:
+        pass
+    pool.close_idle()
+    assert cast(Mock, connection1.close).called
+    assert cast(Mock, connection2.close).called
+    assert pool.stats()['open'] == 0
@@ -1,13 +1,15 @@
+from collections.abc import Generator
 import flask
 import json
+import mwoauth  # type: ignore
 import pymysql
 import pytest
 from typing import Any, Optional, cast
 from unittest.mock import Mock, patch
 
-from batch import StoredBatch
-from command import CommandEdit, CommandFinish, CommandNoop, CommandRecord
-from database import DatabaseBatchStore, _LocalUserStore
+from batch import NewBatch, OpenBatch, StoredBatch
+from command import CommandEdit, CommandEditConflict, CommandFinish, CommandNoop, CommandPlan, CommandRecord
+from database import DatabaseBatchStore, _BatchBackgroundRunsDatabase, _LocalUserStore
 from localuser import LocalUser
 from stringstore import StringTableStore
 
@@ -52,6 +54,47 @@ def test_DatabaseBatchStore_store_batch(database_connection_params: dict) -> Non
             assert bool(command2_page_flags & 8) == (command2.command.page.create_missing_page is None)
             assert command2_actions_tpsv == command2.command.actions_tpsv()
 
+def test_DatabaseBatchStore_get_batches_count_cached(database_connection_params: dict) -> None:
+    store = DatabaseBatchStore(database_connection_params)
+    store.store_batch(newBatch1, fake_session)
+    assert store.get_batches_count() == 1
+
+    # a batch stored by another process only shows up once the cache expires
+    other_store = DatabaseBatchStore(database_connection_params)
+    other_store.store_batch(newBatch1, fake_session)
+    assert store.get_batches_count() == 1
+
+    # but batches stored by this store are counted immediately
+    store.store_batch(newBatch1, fake_session)
+    assert store.get_batches_count() == 3
+
+def test_DatabaseBatchStore_get_batch_prefetches(database_connection_params: dict) -> None:
+    store = DatabaseBatchStore(database_connection_params)
+    stored_batch = store.store_batch(newBatch1, fake_session)
+    [command_plan_1, command_plan_2] = stored_batch.command_records.get_slice(0, 2)
+    stored_batch.command_records.store_finish(CommandNoop(command_plan_1.id, command_plan_1.command, revision=1))
+
+    loaded_batch = cast(StoredBatch, store.get_batch(stored_batch.id))
+    with patch.object(store, 'connect', side_effect=AssertionError('should not query the database')):
+        assert loaded_batch.command_records.get_summary() == {CommandPlan: 1, CommandNoop: 1}
+        assert len(loaded_batch.command_records) == 2
+        assert loaded_batch.background_runs.get_last() is None
+        assert not loaded_batch.background_runs.currently_running()
+
+    assert isinstance(loaded_batch, OpenBatch)
+    store.start_background(loaded_batch, fake_session)
+    assert loaded_batch.background_runs.currently_running()  # not cached across the change
+    loaded_batch = cast(StoredBatch, store.get_batch(stored_batch.id))
+    with patch.object(store, 'connect', side_effect=AssertionError('should not query the database')):
+        background_run = loaded_batch.background_runs.get_last()
+        assert background_run is not None
+        assert background_run[0][1].user_name == 'Lucas Werkmeister'
+        assert background_run[1] is None
+    assert background_run == _BatchBackgroundRunsDatabase(stored_batch.id, stored_batch.domain, store).get_last()
+
+    loaded_batch.command_records.store_finish(CommandNoop(command_plan_2.id, command_plan_2.command, revision=2))
+    assert loaded_batch.command_records.get_summary() == {CommandNoop: 2}  # not cached across the change
+
 def test_DatabaseBatchStore_update_batch(database_connection_params: dict, frozen_time: Any) -> None:
     store = DatabaseBatchStore(database_connection_params)
     stored_batch = store.store_batch(newBatch1, fake_session)
@@ -191,41 +234,192 @@ def test_DatabaseBatchStore_row_to_command_record(expected_command_record: Comma
     actual_command_record = store._row_to_command_record(*full_row)
     assert expected_command_record == actual_command_record
 
+def test_DatabaseBatchStore_make_plans_pending_background_rows_read(database_connection_params: dict) -> None:
+    """Benchmark the background pick by the number of rows the server reads for it.
+
+    Picking from a batch with many planned commands should only read
+    the commands it picks (and a few index entries),
+    not all planned commands of all running batches."""
+    app = flask.Flask(__name__)
+    store = DatabaseBatchStore(database_connection_params, app)
+    consumer_token = mwoauth.ConsumerToken('fake', 'fake')
+
+    def rows_read(connection: pymysql.connections.Connection) -> int:
+        with connection.cursor() as cursor:
+            cursor.execute("SHOW SESSION STATUS LIKE 'Handler_read%'")
+            return sum(int(value) for name, value in cursor.fetchall())
+
+    with app.app_context():  # the store reuses one connection per app context, so the session status covers all its queries
+        for i in range(3):
+            open_batch = store.store_batch(NewBatch([commandPlan1.command] * 1000, title=None), fake_session)
+            store.start_background(open_batch, fake_session)
+        with store.connect() as connection:
+            rows_read_before = rows_read(connection)
+        pending = store.make_plans_pending_background(consumer_token, 'fake user agent', 10)
+        with store.connect() as connection:
+            rows_read_after = rows_read(connection)
+
+    assert pending is not None
+    assert len(pending[1]) == 10
+    assert rows_read_after - rows_read_before < 300  # the old query read (and sorted) all 3000 planned commands
+
+def test_DatabaseBatchStore_make_plans_pending_background_explain(database_connection_params: dict, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Check the plan of the background pick query.
+
+    Only the command table is checked: it must be probed per batch
+    via command_batch_status, never scanned, however many commands are planned.
+    (The plan for the small background, batch and lease tables depends on the data.)"""
+    store = DatabaseBatchStore(database_connection_params)
+    consumer_token = mwoauth.ConsumerToken('fake', 'fake')
+    for i in range(3):
+        open_batch = store.store_batch(NewBatch([commandPlan1.command] * 1000, title=None), fake_session)
+        store.start_background(open_batch, fake_session)
+
+    executed: list[tuple[str, Any]] = []
+    execute = pymysql.cursors.Cursor.execute
+
+    def record_execute(self: pymysql.cursors.Cursor, query: str, args: Any = None) -> int:
+        executed.append((query, args))
+        return execute(self, query, args)
+    monkeypatch.setattr(pymysql.cursors.Cursor, 'execute', record_execute)
+    assert store.make_plans_pending_background(consumer_token, 'fake user agent', 10,
+                                               skip_domains={'de.wikipedia.org'},
+                                               skip_global_user_ids={1}) is not None
+    monkeypatch.undo()
+    [(query, args)] = [(query, args) for query, args in executed if query.startswith('SELECT `batch_id`, `background_id`')]
+
+    with store.connect() as connection, connection.cursor() as cursor:
+        cursor.execute('EXPLAIN ' + query, args)
+        columns = [column[0] for column in cursor.description]
+        plan = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    command_accesses = [access for access in plan if access['table'] == 'command']
+    assert command_accesses, plan
+    for access in command_accesses:
+        assert access['type'] == 'ref', plan
+        assert access['key'] == 'command_batch_status', plan
+
+def test_DatabaseBatchStore_update_status_counts_order() -> None:
+    store = DatabaseBatchStore({})
+    plan, pending = DatabaseBatchStore._COMMAND_STATUS_PLAN, DatabaseBatchStore._COMMAND_STATUS_PENDING
+    cursor_1, cursor_2 = Mock(), Mock()
+
+    store._update_status_counts(cursor_1, 1, {plan: -2, pending: 2})
+    store._update_status_counts(cursor_2, 1, {pending: -2, plan: 2})
+
+    # the rows must be locked in the same order regardless of the order of the deltas
+    [sql_1, args_1] = cursor_1.execute.call_args.args
+    [sql_2, args_2] = cursor_2.execute.call_args.args
+    assert sql_1 == sql_2
+    assert args_1 == [1, plan, -2, 1, pending, 2]
+    assert args_2 == [1, plan, 2, 1, pending, -2]
+
+def test_DatabaseBatchStore_status_counts(database_connection_params: dict) -> None:
+    store = DatabaseBatchStore(database_connection_params)
+    consumer_token = mwoauth.ConsumerToken('fake', 'fake')
+    open_batch = store.store_batch(NewBatch([commandPlan1.command] * 5, title=None), fake_session)
+    command_records = open_batch.command_records
+
+    def counts_from_commands() -> dict[type[CommandRecord], int]:
+        with store.connect() as connection, connection.cursor() as cursor:
+            cursor.execute('''SELECT `command_status`, COUNT(*)
+                              FROM `command`
+                              WHERE `command_batch` = %s
+                              GROUP BY `command_status`''',
+                           (open_batch.id,))
+            return {store._status_to_command_record_type(status): count for status, count in cursor.fetchall()}
+
+    assert command_records.get_summary() == counts_from_commands() == {CommandPlan: 5}
+    [pending_1, pending_2] = command_records.make_plans_pending(0, 2)
+    command_records.make_pendings_planned([pending_2.id])
+    command_records.store_finish(CommandNoop(pending_1.id, pending_1.command, revision=1))
+    store.start_background(open_batch, fake_session)
+    pending = store.make_plans_pending_background(consumer_token, 'fake user agent', 2)
+    assert pending is not None
+    [pending_3, pending_4] = pending[1]
+    command_records.store_finish(CommandEditConflict(pending_3.id, pending_3.command))  # retried later
+    command_records.store_finish(CommandNoop(pending_4.id, pending_4.command, revision=2))
+    assert command_records.get_summary() == counts_from_commands() == {CommandPlan: 3, CommandNoop: 2, CommandEditConflict: 1}
+    assert len(command_records) == 6
+
+def test_DatabaseBatchStore_recompute_status_counts(database_connection_params: dict) -> None:
+    store = DatabaseBatchStore(database_connection_params)
+    open_batch_1 = store.store_batch(newBatch1, fake_session)
+    open_batch_2 = store.store_batch(newBatch1, fake_session)
+    with store.connect() as connection, connection.cursor() as cursor:
+        cursor.execute('UPDATE `batch_status_count` SET `batch_status_count_count` = 42')
+        connection.commit()
+
+    store.recompute_status_counts([open_batch_1.id])
+    assert open_batch_1.command_records.get_summary() == {CommandPlan: 2}
+    assert open_batch_2.command_records.get_summary() == {CommandPlan: 42}
+
+    store.recompute_status_counts()
+    assert open_batch_2.command_records.get_summary() == {CommandPlan: 2}
+
 def test_DatabaseBatchStore_connection_reuse() -> None:
     with patch('database.DatabaseBatchStore._connect') as connect_patch:
         connect_patch.side_effect = lambda: Mock()  # new mock per call
         app = flask.Flask(__name__)
         store = DatabaseBatchStore({}, app)
-        # reuse connection within one app context (and only close at the end)
+        # reuse connection within one app context (and only return it to the pool at the end)
         with app.app_context():
             with store.connect() as conn1:
                 pass
-            assert not cast(Mock, conn1.close).called
+            assert not cast(Mock, conn1.rollback).called
             with store.connect() as conn2:
                 pass
-            assert not cast(Mock, conn2.close).called
+            assert not cast(Mock, conn2.rollback).called
             assert conn2 is conn1
-        assert cast(Mock, conn1.close).called
-        assert cast(Mock, conn1.close).call_count == 1
-        # don’t reuse connection in another app context
+        assert cast(Mock, conn1.rollback).call_count == 1
+        assert not cast(Mock, conn1.close).called
+        # reuse the pooled connection in another app context
         with app.app_context():
             with store.connect() as conn3:
                 pass
-            assert conn3 is not conn1
+            assert conn3 is conn1
+        # but not after an error
+        with pytest.raises(ValueError):
+            with app.app_context():
+                with store.connect() as conn4:
+                    raise ValueError
+        assert cast(Mock, conn4.close).called
+        with app.app_context():
+            with store.connect() as conn5:
+                pass
+            assert conn5 is not conn1
+        assert connect_patch.call_count == 2
 
 def test_DatabaseBatchStore_connection_reuse_without_app() -> None:
     with patch('database.DatabaseBatchStore._connect') as connect_patch:
         connect_patch.side_effect = lambda: Mock()  # new mock per call
         store = DatabaseBatchStore({})
-        # without an app, no connection reuse, close as soon as context manager exits
+        # without an app, the connection is returned to the pool as soon as context manager exits
         with store.connect() as conn1:
+            with store.connect() as conn2:
+                assert conn2 is not conn1
+        assert not cast(Mock, conn1.close).called
+        assert cast(Mock, conn1.rollback).called
+        with store.connect() as conn3:
             pass
-        assert cast(Mock, conn1.close).called
-        with store.connect() as conn2:
-            pass
-        assert cast(Mock, conn2.close).called
-        assert conn2 is not conn1
+        assert conn3 in (conn1, conn2)
+        assert connect_patch.call_count == 2
+
+def test_DatabaseBatchStore_connect_streaming_abandoned() -> None:
+    with patch('database.DatabaseBatchStore._connect_streaming') as connect_patch:
+        connect_patch.side_effect = lambda: Mock()  # new mock per call
+        store = DatabaseBatchStore({})
 
+        def stream() -> Generator[int, None, None]:
+            with store.connect_streaming():
+                yield 1
+                yield 2
+
+        assert list(stream()) == [1, 2]
+        abandoned = stream()
+        next(abandoned)
+        abandoned.close()
+        assert store.streaming_connection_pool.stats()['closed'] == 1
+        assert store.streaming_connection_pool.stats()['open'] == 0
 
 def test_LocalUserStore_store_two_users(database_connection_params: dict) -> None:
     connection = pymysql.connect(**database_connection_params)
@@ -104,3 +104,57 @@ def test_parse_batch_preserves_title() -> None:
                                    default_resolve_redirects=True,
                                    default_create_missing_page=False)
     assert batch.title == 'Test title'
+
+def test_parse_batch_collects_errors() -> None:
+    tpsv = 'Page 1|+Category:Cat\nPage 2|Cat\nPage 3\nPage 4|-Category:Dog'
+    with pytest.raises(parse_tpsv.ParseBatchError) as excinfo:
+        parse_tpsv.parse_batch(tpsv, **irrelevant_params)
+    assert len(excinfo.value.errors) == 2
+    assert not excinfo.value.truncated
+
+def test_parse_batch_bounds_errors() -> None:
+    tpsv = '\n'.join(['Page %d|Cat' % i for i in range(parse_tpsv.max_errors * 10)])
+    with pytest.raises(parse_tpsv.ParseBatchError) as excinfo:
+        parse_tpsv.parse_batch(tpsv, **irrelevant_params)
+    assert len(excinfo.value.errors) == parse_tpsv.max_errors
+    assert excinfo.value.truncated
+    assert str(excinfo.value).endswith('(further errors omitted)')
+
+def test_parse_commands_is_lazy() -> None:
+    commands = parse_tpsv.parse_commands('Page 1|+Category:Cat\nPage 2|Cat',
+                                         default_resolve_redirects=True,
+                                         default_create_missing_page=False)
+    assert next(commands).page.title == 'Page 1'
+    with pytest.raises(parse_tpsv.ParseBatchError):
+        next(commands)
+
+@pytest.mark.parametrize('actions', [
+    '+Category:Cat',
+    '+Category:Cat|-Category:Dog#sort key',
+    ' +Category:Cat\t-Category:Dog ',
+])
+def test_parse_pagepile_batch_same_as_parse_batch(actions: str) -> None:
+    pages = ['Page 1', 'Page 2', 'Page 3']
+    batch1 = parse_tpsv.parse_pagepile_batch(pages, actions, title='Title', default_resolve_redirects=True, default_create_missing_page=False)
+    batch2 = parse_tpsv.parse_batch('\n'.join([page + '|' + actions for page in pages]), title='Title', default_resolve_redirects=True, default_create_missing_page=False)
+    assert batch1 == batch2
+
+def test_parse_pagepile_batch_shares_actions() -> None:
+    batch = parse_tpsv.parse_pagepile_batch(['Page 1', 'Page 2'], '+Category:Cat', title=None, default_resolve_redirects=True, default_create_missing_page=False)
+    assert batch.commands[0].actions[0] is batch.commands[1].actions[0]
+
+def test_parse_pagepile_batch_error() -> None:
+    with pytest.raises(parse_tpsv.ParseBatchError) as excinfo:
+        parse_tpsv.parse_pagepile_batch(['Page 1', 'Page 2'], '+Category:Cat|Dog', title=None, default_resolve_redirects=True, default_create_missing_page=False)
+    assert len(excinfo.value.errors) == 1
+
+def test_parse_actions_shared() -> None:
+    batch = parse_tpsv.parse_batch('Page 1|+Category:Cat|-Category:Dog\nPage 2|+Category:Cat|-Category:Dog', **irrelevant_params)
+    [command1, command2] = batch.commands
+    assert command1.actions is not command2.actions
+    assert all(action1 is action2 for action1, action2 in zip(command1.actions, command2.actions))
+
+def test_parse_actions_error() -> None:
+    with pytest.raises(parse_tpsv.ParseActionsError) as excinfo:
+        parse_tpsv.parse_actions('Cat|+Category:Cat|Dog')
+    assert len(excinfo.value.errors) == 2
@@ -31,3 +31,32 @@ def test_parse_summary_error() -> None:
     session = FakeSession(mwapi.errors.APIError('fake', 'XSS detected!', 'for more information see the mailing list blah blah'))
     session.host = 'https://en.wikipedia.org'
     assert parse_wikitext.parse_summary(session, summary) == Markup('&lt;script&gt;alert(&#34;xss&#34;)&lt;/script&gt;')
+
+
+def test_parse_summaries() -> None:
+    session1 = FakeSession(lambda summary, **kwargs: {
+        'parse': {
+            'parsedsummary': '<a href="/wiki/%s">%s</a>' % (summary[2:-2], summary[2:-2]),
+        },
+    })
+    session1.host = 'https://en.wikipedia.org'
+    session2 = FakeSession(mwapi.errors.APIError('fake', 'fake error', ''))
+    session2.host = 'https://de.wikipedia.org'
+    session3 = FakeSession(mwapi.errors.ConnectionError('fake connection error'))
+    session3.host = 'https://fr.wikipedia.org'
+    session4 = FakeSession(mwapi.errors.TimeoutError('fake timeout'))
+    session4.host = 'https://it.wikipedia.org'
+    assert parse_wikitext.parse_summaries([
+        (session1, '[[Category:A]]'),
+        (session2, '[[Kategorie:B]]'),
+        (session1, '[[Category:C]]'),
+        (session3, '[[Catégorie:D]]'),
+        (session4, '[[Categoria:E]]'),
+    ]) == [
+        Markup('<a href="https://en.wikipedia.org/wiki/Category:A">Category:A</a>'),
+        None,
+        Markup('<a href="https://en.wikipedia.org/wiki/Category:C">Category:C</a>'),
+        None,
+        None,
+    ]
+    assert parse_wikitext.parse_summaries([]) == []
@@ -1,4 +1,5 @@
 import datetime
+import math
 import mwapi  # type: ignore
 import os
 import pytest
@@ -6,10 +7,13 @@ from typing import Any, Optional
 
 from action import Action, AddCategoryAction, RemoveCategoryAction
 from command import Command, CommandPending, CommandEdit, CommandNoop, CommandCreation, CommandPageMissing, CommandTitleInvalid, CommandTitleInterwiki, CommandPageProtected, CommandPageBadContentFormat, CommandEditConflict, CommandMaxlagExceeded, CommandBlocked, CommandWikiReadOnly
-from page import Page
-from runner import Runner
+from backoff import AdaptiveBackoff
+from page import Page, PageResolution
+import runner as runner_module
+from runner import PreparedEdit, Runner
 from store import WatchlistParam
 
+from test_command import blockinfo
 from test_utils import FakeSession
 
 def test_resolve_pages_and_run_commands() -> None:
@@ -406,12 +410,10 @@ def test_with_missing_page() -> None:
 
     runner.resolve_pages([page])
 
-    assert page.resolution == {
-        'missing': True,
-        'curtimestamp': curtimestamp,
-        'contentmodel': 'wikibase-item',
-        'badcontentmodel': True,
-    }
+    assert page.resolution == PageResolution(curtimestamp,
+                                             missing=True,
+                                             contentmodel='wikibase-item',
+                                             badcontentmodel=True)
 
     command = Command(page, [AddCategoryAction('Added cat')])
     command_pending = CommandPending(0, command)
@@ -471,12 +473,10 @@ def test_with_missing_page_unnormalized() -> None:
 
     runner.resolve_pages([page])
 
-    assert page.resolution == {
-        'missing': True,
-        'curtimestamp': curtimestamp,
-        'contentmodel': 'wikibase-item',
-        'badcontentmodel': True,
-    }
+    assert page.resolution == PageResolution(curtimestamp,
+                                             missing=True,
+                                             contentmodel='wikibase-item',
+                                             badcontentmodel=True)
 
     command_pending = CommandPending(0, Command(page, [AddCategoryAction('Added cat')]))
     command_record = runner.run_command(command_pending)
@@ -540,12 +540,10 @@ def test_with_missing_page_redirect_resolve() -> None:
 
     runner.resolve_pages([page])
 
-    assert page.resolution == {
-        'missing': True,
-        'curtimestamp': curtimestamp,
-        'contentmodel': 'wikibase-item',
-        'badcontentmodel': True,
-    }
+    assert page.resolution == PageResolution(curtimestamp,
+                                             missing=True,
+                                             contentmodel='wikibase-item',
+                                             badcontentmodel=True)
 
     command_pending = CommandPending(0, Command(page, [AddCategoryAction('Added cat')]))
     command_record = runner.run_command(command_pending)
@@ -606,12 +604,10 @@ def test_with_missing_page_redirect_without_resolve(resolve_redirects: Optional[
 
     runner.resolve_pages([page])
 
-    assert page.resolution == {
-        'missing': True,
-        'curtimestamp': curtimestamp,
-        'contentmodel': 'wikibase-item',
-        'badcontentmodel': True,
-    }
+    assert page.resolution == PageResolution(curtimestamp,
+                                             missing=True,
+                                             contentmodel='wikibase-item',
+                                             badcontentmodel=True)
 
     command_pending = CommandPending(0, Command(page, [AddCategoryAction('Added cat')]))
     command_record = runner.run_command(command_pending)
@@ -676,12 +672,10 @@ def test_with_missing_page_unnormalized_redirect() -> None:
 
     runner.resolve_pages([page])
 
-    assert page.resolution == {
-        'missing': True,
-        'curtimestamp': curtimestamp,
-        'contentmodel': 'wikibase-item',
-        'badcontentmodel': True,
-    }
+    assert page.resolution == PageResolution(curtimestamp,
+                                             missing=True,
+                                             contentmodel='wikibase-item',
+                                             badcontentmodel=True)
 
     command_pending = CommandPending(0, Command(page, [AddCategoryAction('Added cat')]))
     command_record = runner.run_command(command_pending)
@@ -737,12 +731,10 @@ def test_with_missing_page_created_conflictingly() -> None:
 
     runner.resolve_pages([page])
 
-    assert page.resolution == {
-        'missing': True,
-        'curtimestamp': curtimestamp,
-        'contentmodel': 'wikitext',
-        'wikitext': '',
-    }
+    assert page.resolution == PageResolution(curtimestamp,
+                                             missing=True,
+                                             contentmodel='wikitext',
+                                             wikitext='')
 
     command_pending = CommandPending(0, Command(page, [AddCategoryAction('Added cat')]))
     command_record = runner.run_command(command_pending)
@@ -795,10 +787,8 @@ def test_with_invalid_title() -> None:
 
     runner.resolve_pages([page])
 
-    assert page.resolution == {
-        'invalid': True,
-        'curtimestamp': curtimestamp,
-    }
+    assert page.resolution == PageResolution(curtimestamp,
+                                             invalid=True)
 
     command_pending = CommandPending(0, Command(page, [AddCategoryAction('Added cat')]))
     command_record = runner.run_command(command_pending)
@@ -852,10 +842,8 @@ def test_with_empty_title() -> None:
 
     runner.resolve_pages([page])
 
-    assert page.resolution == {
-        'invalid': True,
-        'curtimestamp': curtimestamp,
-    }
+    assert page.resolution == PageResolution(curtimestamp,
+                                             invalid=True)
 
     command_pending = CommandPending(0, Command(page, [AddCategoryAction('Added cat')]))
     command_record = runner.run_command(command_pending)
@@ -907,10 +895,8 @@ def test_with_hash_title() -> None:
 
     runner.resolve_pages([page])
 
-    assert page.resolution == {
-        'invalid': True,
-        'curtimestamp': curtimestamp,
-    }
+    assert page.resolution == PageResolution(curtimestamp,
+                                             invalid=True)
 
     command_pending = CommandPending(0, Command(page, [AddCategoryAction('Added cat')]))
     command_record = runner.run_command(command_pending)
@@ -967,10 +953,8 @@ def test_with_unnormalized_interwiki_title() -> None:
 
     runner.resolve_pages([page])
 
-    assert page.resolution == {
-        'interwiki': True,
-        'curtimestamp': curtimestamp,
-    }
+    assert page.resolution == PageResolution(curtimestamp,
+                                             interwiki=True)
 
     command_pending = CommandPending(0, Command(page, [AddCategoryAction('Added cat')]))
     command_record = runner.run_command(command_pending)
@@ -1246,9 +1230,9 @@ def test_with_blocked() -> None:
                 ],
             },
         },
-        mwapi.errors.APIError('blocked', 'You have been blocked from editing.', None)
     )
     session.host = 'test.wikidata.org'
+    session.post_response = session.api_error({'code': 'blocked', 'info': 'You have been blocked from editing.', 'blockinfo': blockinfo})
     runner = Runner(session, WatchlistParam.preferences)
 
     page = Page('Main page', resolve_redirects=True, create_missing_page=False)
@@ -1262,7 +1246,7 @@ def test_with_blocked() -> None:
 
     assert isinstance(command_record, CommandBlocked)
     assert not command_record.auto
-    # would be nice to assert command_record.blockinfo once Runner can record it
+    assert command_record.blockinfo == blockinfo
 
 def test_with_autoblocked() -> None:
     curtimestamp = '2019-03-11T23:33:30Z'
@@ -1317,9 +1301,9 @@ def test_with_autoblocked() -> None:
                 ],
             },
         },
-        mwapi.errors.APIError('autoblocked', 'Your IP address has been blocked automatically, because it was used by a blocked user.', None)
     )
     session.host = 'test.wikidata.org'
+    session.post_response = session.api_error({'code': 'autoblocked', 'info': 'Your IP address has been blocked automatically, because it was used by a blocked user.', 'blockinfo': blockinfo})
     runner = Runner(session, WatchlistParam.preferences)
 
     page = Page('Main page', resolve_redirects=True, create_missing_page=False)
@@ -1333,7 +1317,7 @@ def test_with_autoblocked() -> None:
 
     assert isinstance(command_record, CommandBlocked)
     assert command_record.auto
-    # would be nice to assert command_record.blockinfo once Runner can record it
+    assert command_record.blockinfo == blockinfo
 
 def test_with_readonly() -> None:
     curtimestamp = '2019-03-11T23:33:30Z'
@@ -1388,9 +1372,9 @@ def test_with_readonly() -> None:
                 ],
             },
         },
-        mwapi.errors.APIError('readonly', 'The wiki is currently in read-only mode.', None)
     )
     session.host = 'test.wikidata.org'
+    session.post_response = session.api_error({'code': 'readonly', 'info': 'The wiki is currently in read-only mode.', 'readonlyreason': 'maintenance'})
     runner = Runner(session, WatchlistParam.preferences)
 
     page = Page('Main page', resolve_redirects=True, create_missing_page=False)
@@ -1403,4 +1387,275 @@ def test_with_readonly() -> None:
     command_record = runner.run_command(command_pending)
 
     assert isinstance(command_record, CommandWikiReadOnly)
-    # would be nice to assert command_record.reason once Runner can record it
+    assert command_record.reason == 'maintenance'
+
+def test_resolve_pages_in_chunks() -> None:
+    curtimestamp = '2019-03-11T23:33:30Z'
+    requested_titles: list[list[str]] = []
+
+    def get(**kwargs: Any) -> dict:
+        if kwargs.get('meta') == 'tokens':
+            return {'query': {'tokens': {'csrftoken': '+\\'}}}
+        titles = kwargs['titles']
+        requested_titles.append(titles)
+        pages = []
+        for index, title in enumerate(titles):
+            if title == 'Page 7':
+                # content did not fit into the response
+                pages.append({'pageid': index + 1, 'ns': 0, 'title': title})
+                continue
+            pages.append({
+                'pageid': index + 1,
+                'ns': 0,
+                'title': title,
+                'revisions': [
+                    {
+                        'revid': 1000 + index,
+                        'timestamp': '2014-02-23T15:14:40Z',
+                        'slots': {
+                            'main': {
+                                'contentmodel': 'wikitext',
+                                'contentformat': 'text/x-wiki',
+                                'content': 'Content of ' + title,
+                            },
+                        },
+                    },
+                ],
+            })
+        return {'curtimestamp': curtimestamp, 'query': {'pages': pages}}
+
+    session = FakeSession(get)
+    runner = Runner(session, WatchlistParam.preferences)
+    pages = [Page('Page %d' % i, resolve_redirects=i % 3 == 0, create_missing_page=False) for i in range(120)]
+
+    runner.resolve_pages(pages)
+
+    assert [len(titles) for titles in requested_titles] == [40, 50, 30]
+    for page in pages:
+        if page.title == 'Page 7':
+            assert page.resolution is None
+        else:
+            assert page.resolution is not None
+            assert page.resolution.wikitext == 'Content of ' + page.title
+
+@pytest.mark.parametrize('error, headers, expected_delays', [
+    ({'lag': 0.4}, {'Retry-After': '5'}, [1, 2, 4, 5]),  # Retry-After caps the backoff
+    ({'lag': 3.2}, {}, [1, 2, 3.2, 3.2]),  # otherwise, the reported lag does
+    ({}, {}, [1, 2, 4, 5]),  # or the default cap, if the error didn’t say anything
+])
+def test_with_maxlag_exceeded_backoff(error: dict, headers: dict[str, str], expected_delays: list[float], monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(runner_module, 'maxlag_backoff', AdaptiveBackoff(uniform=lambda a, b: b))
+    session = FakeSession({
+        'curtimestamp': '2019-03-11T23:33:30Z',
+        'query': {
+            'tokens': {'csrftoken': '+\\'},
+            'namespaces': {'14': {'id': 14, 'name': 'Category', 'canonical': 'Category', 'case': 'first-letter'}},
+            'namespacealiases': [],
+            'allmessages': [
+                {'name': 'comma-separator', 'content': ', '},
+                {'name': 'semicolon-separator', 'content': '; '},
+                {'name': 'parentheses', 'content': '($1)'},
+            ],
+        },
+    })
+    session.host = 'maxlag-backoff.test.wikidata.org'
+    session.post_response = session.api_error({'code': 'maxlag', 'info': 'Waiting for a database server.', **error}, headers)
+    runner = Runner(session, WatchlistParam.preferences)
+
+    for expected_delay in expected_delays:
+        page = Page('Main page', resolve_redirects=True, create_missing_page=False)
+        page.resolution = PageResolution('2019-03-11T23:33:30Z',
+                                         contentformat='text/x-wiki',
+                                         contentmodel='wikitext',
+                                         page_id=58692,
+                                         base_timestamp='2014-02-23T15:14:40Z',
+                                         base_revid=195259,
+                                         wikitext='Unit Testing 1, 2, 3...')
+        command_pending = CommandPending(0, Command(page, [AddCategoryAction('Added cat')]))
+        before = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        command_record = runner.run_command(command_pending)
+        assert isinstance(command_record, CommandMaxlagExceeded)
+        delay = (command_record.retry_after - before).total_seconds()
+        assert math.ceil(expected_delay) <= delay <= math.ceil(expected_delay) + 1
+
+def test_csrf_token_cached_and_refreshed() -> None:
+    tokens = iter(['token 1+\\', 'token 2+\\'])
+    token_requests = 0
+
+    def get(**kwargs: Any) -> dict:
+        nonlocal token_requests
+        if kwargs['meta'] == 'tokens':
+            token_requests += 1
+            return {'query': {'tokens': {'csrftoken': next(tokens)}}}
+        return {
+            'query': {
+                'namespaces': {'14': {'id': 14, 'name': 'Category', 'canonical': 'Category', 'case': 'first-letter'}},
+                'namespacealiases': [],
+                'allmessages': [
+                    {'name': 'comma-separator', 'content': ', '},
+                    {'name': 'semicolon-separator', 'content': '; '},
+                    {'name': 'parentheses', 'content': '($1)'},
+                ],
+            },
+        }
+
+    posted_tokens: list[str] = []
+
+    def post(**kwargs: Any) -> dict:
+        posted_tokens.append(kwargs['token'])
+        if kwargs['token'] == 'token 1+\\':
+            session.api_error({'code': 'badtoken', 'info': 'Invalid CSRF token.'})()
+        return {'edit': {'result': 'Success', 'pageid': 58692, 'title': 'Main page', 'contentmodel': 'wikitext', 'oldrevid': 195259, 'newrevid': 195260}}
+
+    session = FakeSession(get, post)
+    session.host = 'csrf-token-cache.test.wikidata.org'
+    Runner(session, WatchlistParam.preferences)
+    runner = Runner(session, WatchlistParam.preferences)
+    assert token_requests == 1  # second runner reused the token
+    assert runner.csrf_token == 'token 1+\\'
+
+    page = Page('Main page', resolve_redirects=True, create_missing_page=False)
+    page.resolution = PageResolution('2019-03-11T23:33:30Z',
+                                     contentformat='text/x-wiki',
+                                     contentmodel='wikitext',
+                                     page_id=58692,
+                                     base_timestamp='2014-02-23T15:14:40Z',
+                                     base_revid=195259,
+                                     wikitext='[[Category:Existing cat]]')
+    command_record = runner.run_command(CommandPending(0, Command(page, [AddCategoryAction('Added cat')])))
+    assert isinstance(command_record, CommandEdit)
+    assert posted_tokens == ['token 1+\\', 'token 2+\\']
+    assert token_requests == 2
+
+    assert Runner(session, WatchlistParam.preferences).csrf_token == 'token 2+\\'
+
+def test_run_commands_pipelined() -> None:
+    curtimestamp = '2019-03-11T23:33:30Z'
+    titles = ['Page %d' % i for i in range(100)]
+    titles[50] = titles[49]  # same page at the end of the first chunk and the start of the second one
+    titles[99] = titles[98]  # same page twice in the last chunk
+    revisions = {title: (1, '') for title in titles}  # current revid and wikitext of each page
+
+    def get(**kwargs: Any) -> dict:
+        if kwargs.get('meta') == 'tokens':
+            return {'query': {'tokens': {'csrftoken': '+\\'}}}
+        if 'titles' not in kwargs:
+            return {
+                'query': {
+                    'namespaces': {'14': {'id': 14, 'name': 'Category', 'canonical': 'Category', 'case': 'first-letter'}},
+                    'namespacealiases': [],
+                    'allmessages': [
+                        {'name': 'comma-separator', 'content': ', '},
+                        {'name': 'semicolon-separator', 'content': '; '},
+                        {'name': 'parentheses', 'content': '($1)'},
+                    ],
+                },
+            }
+        pages = []
+        for title in kwargs['titles']:
+            revid, wikitext = revisions[title]
+            pages.append({
+                'pageid': titles.index(title) + 1,
+                'ns': 0,
+                'title': title,
+                'revisions': [
+                    {
+                        'revid': revid,
+                        'timestamp': '2014-02-23T15:14:%02dZ' % revid,
+                        'slots': {
+                            'main': {
+                                'contentmodel': 'wikitext',
+                                'contentformat': 'text/x-wiki',
+                                'content': wikitext,
+                            },
+                        },
+                    },
+                ],
+            })
+        return {'curtimestamp': curtimestamp, 'query': {'pages': pages}}
+
+    edited_titles: list[str] = []
+    conflicted_titles: list[str] = []
+
+    def post(**kwargs: Any) -> dict:
+        title = titles[kwargs['pageid'] - 1]
+        revid, wikitext = revisions[title]
+        if kwargs['basetimestamp'] != '2014-02-23T15:14:%02dZ' % revid:
+            conflicted_titles.append(title)
+            raise mwapi.errors.APIError('editconflict', 'Edit conflict.', None)
+        revisions[title] = (revid + 1, kwargs['text'])
+        edited_titles.append(title)
+        return {'edit': {'result': 'Success', 'pageid': kwargs['pageid'], 'title': title, 'contentmodel': 'wikitext', 'oldrevid': revid, 'newrevid': revid + 1}}
+
+    session = FakeSession(get, post)
+    session.host = 'run-commands-pipelined.test.wikidata.org'
+    runner = Runner(session, WatchlistParam.preferences)
+    command_pendings = [CommandPending(index, Command(Page(title, resolve_redirects=False, create_missing_page=False), [AddCategoryAction('Cat %d' % index)]))
+                        for index, title in enumerate(titles)]
+
+    command_finishes = list(runner.run_commands(command_pendings))
+
+    assert [command_finish.id for command_finish in command_finishes] == list(range(100))
+    assert all(isinstance(command_finish, CommandEdit) for command_finish in command_finishes)
+    assert edited_titles == titles
+    assert conflicted_titles == []  # repeated pages were not resolved ahead of time
+    assert revisions['Page 49'] == (3, '[[Category:Cat 49]]\n[[Category:Cat 50]]')
+    assert revisions['Page 98'] == (3, '[[Category:Cat 98]]\n[[Category:Cat 99]]')
+
+def test_run_commands_stop_early() -> None:
+    session = FakeSession({
+        'query': {
+            'tokens': {'csrftoken': '+\\'},
+            'namespaces': {'14': {'id': 14, 'name': 'Category', 'canonical': 'Category', 'case': 'first-letter'}},
+            'namespacealiases': [],
+            'allmessages': [],
+        },
+    })
+    session.host = 'run-commands-stop-early.test.wikidata.org'
+    runner = Runner(session, WatchlistParam.preferences)
+    command_pendings = []
+    for index in range(3):
+        page = Page('Page %d' % index, resolve_redirects=False, create_missing_page=False)
+        page.resolution = PageResolution('2019-03-11T23:33:30Z', invalid=True)
+        command_pendings.append(CommandPending(index, Command(page, [AddCategoryAction('Cat')])))
+
+    command_finishes = runner.run_commands(command_pendings)
+    assert next(command_finishes) == CommandTitleInvalid(0, command_pendings[0].command, curtimestamp='2019-03-11T23:33:30Z')
+    command_finishes.close()  # no error
+
+def test_prepare_command_releases_wikitext() -> None:
+    session = FakeSession({
+        'query': {
+            'tokens': {'csrftoken': '+\\'},
+            'namespaces': {'14': {'id': 14, 'name': 'Category', 'canonical': 'Category', 'case': 'first-letter'}},
+            'namespacealiases': [],
+            'allmessages': [
+                {'name': 'comma-separator', 'content': ', '},
+                {'name': 'semicolon-separator', 'content': '; '},
+                {'name': 'parentheses', 'content': '($1)'},
+            ],
+        },
+    })
+    session.host = 'release-wikitext.test.wikidata.org'
+    runner = Runner(session, WatchlistParam.preferences)
+    resolution = PageResolution('2019-03-11T23:33:30Z',
+                                contentformat='text/x-wiki',
+                                contentmodel='wikitext',
+                                page_id=58692,
+                                base_timestamp='2014-02-23T15:14:40Z',
+                                base_revid=195259,
+                                wikitext='[[Category:Existing cat]]')
+
+    page = Page('Main page', resolve_redirects=True, create_missing_page=False)
+    page.resolution = resolution
+    prepared_edit = runner.prepare_command(CommandPending(0, Command(page, [AddCategoryAction('Added cat')])))
+    assert isinstance(prepared_edit, PreparedEdit)
+    assert prepared_edit.resolution.wikitext is None
+    assert prepared_edit.params['text'] == '[[Category:Existing cat]]\n[[Category:Added cat]]'
+    assert page.resolution is resolution  # preparing does not modify the page
+
+    page = Page('Main page', resolve_redirects=True, create_missing_page=False)
+    page.resolution = resolution
+    command_record = runner.run_command(CommandPending(0, Command(page, [RemoveCategoryAction('Missing cat')])))
+    assert isinstance(command_record, CommandNoop)
+    assert page.resolution is None
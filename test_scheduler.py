@@ -0,0 +1,65 @@
+from scheduler import EditScheduler, TokenBucket
+
+
+class FakeClock:
+
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_TokenBucket_refill() -> None:
+    bucket = TokenBucket(rate=0.5, capacity=5, tokens=0, updated=0)
+    bucket.refill(4)
+    assert bucket.tokens == 2
+    bucket.refill(100)
+    assert bucket.tokens == 5
+
+def test_TokenBucket_seconds_until_available() -> None:
+    assert TokenBucket(rate=0.5, capacity=5, tokens=1, updated=0).seconds_until_available() == 0
+    assert TokenBucket(rate=0.5, capacity=5, tokens=0, updated=0).seconds_until_available() == 2
+    assert TokenBucket(rate=0.5, capacity=5, tokens=-1, updated=0).seconds_until_available() == 4
+
+def test_EditScheduler_burst() -> None:
+    clock = FakeClock()
+    scheduler = EditScheduler(domain_rate=1, user_rate=10, burst=3, clock=clock)
+    for user in range(3):
+        assert not scheduler.exhausted_domains()
+        scheduler.take('test.wikipedia.org', user)
+    assert scheduler.exhausted_domains() == {'test.wikipedia.org'}
+    assert not scheduler.exhausted_global_user_ids()
+    assert scheduler.seconds_until_available() == 1
+
+    clock.now += 1
+    assert not scheduler.exhausted_domains()
+    assert scheduler.seconds_until_available() is None
+
+def test_EditScheduler_separate_buckets() -> None:
+    clock = FakeClock()
+    scheduler = EditScheduler(domain_rate=1, user_rate=1, burst=2, clock=clock)
+    scheduler.take('test.wikipedia.org', 1)
+    scheduler.take('test.wikipedia.org', 1)
+    scheduler.take('test.wikidata.org', 2)
+    assert scheduler.exhausted_domains() == {'test.wikipedia.org'}
+    assert scheduler.exhausted_global_user_ids() == {1}
+
+def test_EditScheduler_take_beyond_budget() -> None:
+    clock = FakeClock()
+    scheduler = EditScheduler(domain_rate=1, user_rate=10, burst=1, clock=clock)
+    scheduler.take('test.wikipedia.org', 1)
+    scheduler.take('test.wikipedia.org', 2)  # e.g. another worker picked a command concurrently
+    clock.now += 1
+    assert scheduler.exhausted_domains() == {'test.wikipedia.org'}
+    clock.now += 1
+    assert not scheduler.exhausted_domains()
+
+def test_EditScheduler_pause_domain() -> None:
+    clock = FakeClock()
+    scheduler = EditScheduler(domain_rate=2, user_rate=2, clock=clock)
+    scheduler.pause_domain('test.wikipedia.org', 5)
+    assert scheduler.exhausted_domains() == {'test.wikipedia.org'}
+    assert scheduler.seconds_until_available() == 5
+    clock.now += 5
+    assert not scheduler.exhausted_domains()
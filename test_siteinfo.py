@@ -1,3 +1,5 @@
+import pytest
+
 import siteinfo
 
 from test_utils import FakeSession
@@ -187,20 +189,49 @@ def test_category_info_enwiki() -> None:
     session = FakeSession(response_enwiki)
     session.host = 'https://en.wikipedia.org'
     category_info = siteinfo.category_info(session)
-    assert category_info == ('Category', ['Category'], 'first-letter')
+    assert category_info == siteinfo.CategoryInfo('Category', ['Category'], 'first-letter')
 
 def test_category_info_dewiktionary() -> None:
     session = FakeSession(response_dewiktionary)
     session.host = 'https://de.wiktionary.org'
     category_info = siteinfo.category_info(session)
-    assert category_info == ('Kategorie', ['Kategorie', 'Category'], 'case-sensitive')
+    assert category_info == siteinfo.CategoryInfo('Kategorie', ['Kategorie', 'Category'], 'case-sensitive')
 
 def test_category_info_ruwiki() -> None:
     session = FakeSession(response_ruwiki)
     session.host = 'https://ru.wikipedia.org'
     category_info = siteinfo.category_info(session)
-    assert category_info == ('Категория', ['Категория', 'Category', 'К'], 'first-letter')
+    assert category_info == siteinfo.CategoryInfo('Категория', ['Категория', 'Category', 'К'], 'first-letter')
+
+
+@pytest.mark.parametrize('wikilink, expected', [
+    ('[[Category:A]]', True),
+    ('[[K:A]]', True),
+    ('[[Kategorie:A|sort key]]', True),
+    ('[[:Category:A]]', False),
+    ('[[category:A]]', False),
+    ('[[Kategorie A]]', False),
+    ('[[A]]', False),
+])
+def test_CategoryInfo_is_category_link(wikilink: str, expected: bool) -> None:
+    category_info = siteinfo.CategoryInfo('Kategorie', ['Kategorie', 'Category', 'K'], 'first-letter')
+    assert category_info.is_category_link(wikilink) == expected
+
+@pytest.mark.parametrize('case, category1, category2, expected', [
+    ('first-letter', 'a', 'A', True),
+    ('first-letter', 'My_Test Category', ' My\u00a0Test__Category ', True),
+    ('first-letter', 'ab', 'aB', False),
+    ('case-sensitive', 'a', 'A', False),
+    ('case-sensitive', 'a b', 'a_b', True),
+])
+def test_CategoryInfo_category_key(case: str, category1: str, category2: str, expected: bool) -> None:
+    category_info = siteinfo.CategoryInfo('Category', ['Category'], case)
+    assert (category_info.category_key(category1) == category_info.category_key(category2)) == expected
 
+def test_CategoryInfo_category_key_unknown_case() -> None:
+    category_info = siteinfo.CategoryInfo('Category', ['Category'], 'case-insensitive')
+    with pytest.raises(ValueError):
+        category_info.category_key('A')
 
 def test_comma_separator() -> None:
     session = FakeSession(response_zhwiki)
@@ -7,11 +7,11 @@ from typing import Any, cast
 
 from batch import NewBatch, StoredBatch, OpenBatch, ClosedBatch
 from command import Command, CommandPlan, CommandPending, CommandEdit, CommandNoop, CommandCreation, CommandPageMissing, CommandPageProtected, CommandPageBadContentFormat, CommandPageBadContentModel, CommandEditConflict, CommandMaxlagExceeded, CommandBlocked, CommandWikiReadOnly
-from database import DatabaseBatchStore, DatabasePreferenceStore
-from in_memory import InMemoryBatchStore, InMemoryPreferenceStore
+from database import DatabaseBatchStore, DatabasePreferenceStore, DatabaseTitleHtmlStore
+from in_memory import InMemoryBatchStore, InMemoryPreferenceStore, InMemoryTitleHtmlStore
 from localuser import LocalUser
 from page import Page
-from store import BatchStore, PreferenceStore, WatchlistParam
+from store import BatchStore, PreferenceStore, TitleHtmlStore, WatchlistParam
 from timestamp import now
 
 from test_action import addCategory1
@@ -60,6 +60,16 @@ def preference_store(batch_store: BatchStore) -> Iterator[PreferenceStore]:
         raise ValueError('Unknown batch store!')
 
 
+@pytest.fixture
+def title_html_store(batch_store: BatchStore) -> Iterator[TitleHtmlStore]:
+    if isinstance(batch_store, InMemoryBatchStore):
+        yield InMemoryTitleHtmlStore()
+    elif isinstance(batch_store, DatabaseBatchStore):
+        yield DatabaseTitleHtmlStore(batch_store)
+    else:
+        raise ValueError('Unknown batch store!')
+
+
 def test_BatchStore_get_batch(batch_store: BatchStore) -> None:
     stored_batch = batch_store.store_batch(newBatch1, fake_session)
     loaded_batch = cast(StoredBatch, batch_store.get_batch(stored_batch.id))
@@ -175,6 +185,24 @@ def test_BatchStore_get_batches_slice_other(batch_store: BatchStore) -> None:
     open_batches.reverse()
     assert open_batches[5:20] == batch_store.get_batches_slice(offset=5, limit=15)
 
+def test_BatchStore_get_batches_slice_before_id(batch_store: BatchStore) -> None:
+    open_batches = []
+    for i in range(25):
+        open_batches.append(batch_store.store_batch(newBatch1, fake_session))
+    open_batches.reverse()
+    assert open_batches[5:20] == batch_store.get_batches_slice(offset=0, limit=15, before_id=open_batches[4].id)
+    assert open_batches[20:] == batch_store.get_batches_slice(offset=0, limit=15, before_id=open_batches[19].id)
+    assert open_batches[7:22] == batch_store.get_batches_slice(offset=2, limit=15, before_id=open_batches[4].id)
+
+def test_BatchStore_get_batches_slice_after_id(batch_store: BatchStore) -> None:
+    open_batches = []
+    for i in range(25):
+        open_batches.append(batch_store.store_batch(newBatch1, fake_session))
+    open_batches.reverse()
+    assert open_batches[5:20] == batch_store.get_batches_slice(offset=0, limit=15, after_id=open_batches[20].id)
+    assert open_batches[:5] == batch_store.get_batches_slice(offset=0, limit=15, after_id=open_batches[5].id)
+    assert open_batches[10:] == batch_store.get_batches_slice(offset=0, limit=15, after_id=0)
+
 def test_BatchStore_get_batches_count(batch_store: BatchStore) -> None:
     count = random.randrange(5, 35)
     for i in range(count):
@@ -201,6 +229,29 @@ def test_BatchStore_retry(batch_store: BatchStore) -> None:
     assert command_record_3.id != command_record_1.id
     assert command_record_3.id != command_record_4.id
 
+def test_BatchCommandRecords_store_finish_retries(batch_store: BatchStore) -> None:
+    command_1 = Command(Page('Page 1', resolve_redirects=True, create_missing_page=False), [addCategory1])
+    command_2 = Command(Page('Page 2', resolve_redirects=False, create_missing_page=True), [addCategory1])
+    command_3 = Command(Page('Page 3', resolve_redirects=None, create_missing_page=None), [addCategory1])
+    open_batch = batch_store.store_batch(NewBatch([command_1, command_2, command_3], title=None), fake_session)
+    [command_record_1, command_record_2, command_record_3] = open_batch.command_records.get_slice(0, 3)
+    command_finishes = [
+        CommandWikiReadOnly(command_record_1.id, command_record_1.command, reason=None, retry_after=None),
+        CommandEdit(command_record_2.id, command_record_2.command, base_revision=1, revision=2),
+        CommandEditConflict(command_record_3.id, command_record_3.command),
+    ]
+    for command_finish in command_finishes:
+        open_batch.command_records.store_finish(command_finish)
+    command_records = open_batch.command_records.get_slice(0, 5)
+    assert command_records[:3] == command_finishes
+    [command_record_4, command_record_5] = command_records[3:]
+    assert isinstance(command_record_4, CommandPlan)
+    assert isinstance(command_record_5, CommandPlan)
+    assert command_record_4.command == command_1
+    assert command_record_5.command == command_3
+    assert command_record_4.id < command_record_5.id
+    assert type(batch_store.get_batch(open_batch.id)) is OpenBatch
+
 def test_BatchStore_make_plans_pending_and_make_pendings_planned(batch_store: BatchStore) -> None:
     command_1 = Command(Page('Page 1', resolve_redirects=True, create_missing_page=False), [addCategory1])
     command_2 = Command(Page('Page 2', resolve_redirects=True, create_missing_page=False), [addCategory1])
@@ -220,6 +271,30 @@ def test_BatchStore_make_plans_pending_and_make_pendings_planned(batch_store: Ba
     command_records.make_pendings_planned([id_2, id_4])
     assert [CommandPlan, CommandPlan, CommandPlan, CommandPlan] == [type(command_record) for command_record in command_records.get_slice(0, 4)]
 
+def test_BatchCommandRecords_get_slice_after_id_and_before_id(batch_store: BatchStore) -> None:
+    commands = [Command(Page('Page %d' % i, resolve_redirects=True, create_missing_page=False), [addCategory1]) for i in range(10)]
+    open_batch = batch_store.store_batch(NewBatch(commands, 'test batch'), fake_session)
+    command_records = open_batch.command_records.get_slice(0, 10)
+
+    assert command_records[3:7] == open_batch.command_records.get_slice(0, 4, after_id=command_records[2].id)
+    assert command_records[8:] == open_batch.command_records.get_slice(0, 4, after_id=command_records[7].id)
+    assert command_records[5:9] == open_batch.command_records.get_slice(2, 4, after_id=command_records[2].id)
+    assert [] == open_batch.command_records.get_slice(0, 4, after_id=command_records[9].id)
+    assert command_records[3:7] == open_batch.command_records.get_slice(0, 4, before_id=command_records[7].id)
+    assert command_records[:2] == open_batch.command_records.get_slice(0, 4, before_id=command_records[2].id)
+    assert command_records[1:5] == open_batch.command_records.get_slice(2, 4, before_id=command_records[7].id)
+
+def test_BatchCommandRecords_make_plans_pending_after_id(batch_store: BatchStore) -> None:
+    commands = [Command(Page('Page %d' % i, resolve_redirects=True, create_missing_page=False), [addCategory1]) for i in range(6)]
+    open_batch = batch_store.store_batch(NewBatch(commands, 'test batch'), fake_session)
+    ids = [command_record.id for command_record in open_batch.command_records.get_slice(0, 6)]
+
+    command_pendings = open_batch.command_records.make_plans_pending(0, 2, after_id=ids[2])
+    assert [ids[3], ids[4]] == [command_pending.id for command_pending in command_pendings]
+    command_pendings = open_batch.command_records.make_plans_pending(0, 2, before_id=ids[2])
+    assert [ids[0], ids[1]] == [command_pending.id for command_pending in command_pendings]
+    assert [CommandPending, CommandPending, CommandPlan, CommandPending, CommandPending, CommandPlan] == [type(command_record) for command_record in open_batch.command_records.get_slice(0, 6)]
+
 def test_BatchStore_make_pendings_planned_empty(batch_store: BatchStore) -> None:
     batch = batch_store.store_batch(newBatch1, fake_session)
     batch.command_records.make_pendings_planned([])
@@ -292,8 +367,146 @@ def test_BatchStore_make_plan_pending_background(batch_store: BatchStore, frozen
     pending_4 = batch_store.make_plan_pending_background(mwoauth.ConsumerToken('fake', 'fake'), 'fake user agent')
     assert pending_4 is None
 
+def test_BatchStore_make_plan_pending_background_leases(batch_store: BatchStore, frozen_time: Any) -> None:
+    batch_1 = batch_store.store_batch(newBatch1, fake_session)
+    frozen_time.tick()
+    batch_2 = batch_store.store_batch(newBatch1, fake_session)
+    batch_store.start_background(batch_1, fake_session)
+    batch_store.start_background(batch_2, fake_session)
+    consumer_token = mwoauth.ConsumerToken('fake', 'fake')
+
+    # worker A leases batch 1, so worker B gets batch 2 even though batch 1 has more planned commands
+    pending_a_1 = batch_store.make_plan_pending_background(consumer_token, 'fake user agent', 'worker A')
+    assert pending_a_1 is not None
+    assert pending_a_1[0].id == batch_1.id
+    pending_b_1 = batch_store.make_plan_pending_background(consumer_token, 'fake user agent', 'worker B')
+    assert pending_b_1 is not None
+    assert pending_b_1[0].id == batch_2.id
+
+    # nobody else can get a command now, not even without a lease owner
+    assert batch_store.make_plan_pending_background(consumer_token, 'fake user agent', 'worker C') is None
+    assert batch_store.make_plan_pending_background(consumer_token, 'fake user agent') is None
+
+    # releasing someone else’s lease has no effect
+    batch_store.release_background_lease(batch_1, 'worker C')
+    assert batch_store.make_plan_pending_background(consumer_token, 'fake user agent', 'worker C') is None
+
+    # once worker A is done with its command and releases the lease, worker C can continue batch 1
+    batch_1.command_records.store_finish(CommandNoop(pending_a_1[1].id, pending_a_1[1].command, revision=1))
+    batch_store.release_background_lease(batch_1, 'worker A')
+    pending_c_1 = batch_store.make_plan_pending_background(consumer_token, 'fake user agent', 'worker C')
+    assert pending_c_1 is not None
+    assert pending_c_1[0].id == batch_1.id
+    assert pending_c_1[1].id == batch_1.command_records.get_slice(1, 1)[0].id
+
+    # worker B crashed without releasing its lease, which eventually expires
+    frozen_time.tick(delta=batch_store.background_lease_duration + datetime.timedelta(seconds=1))
+    pending_a_2 = batch_store.make_plan_pending_background(consumer_token, 'fake user agent', 'worker A')
+    assert pending_a_2 is not None
+    assert pending_a_2[0].id == batch_2.id
+
+def test_BatchStore_make_plan_pending_background_skip(batch_store: BatchStore) -> None:
+    batch = batch_store.store_batch(newBatch1, fake_session)
+    batch_store.start_background(batch, fake_session)
+    consumer_token = mwoauth.ConsumerToken('fake', 'fake')
+
+    assert batch_store.make_plan_pending_background(consumer_token, 'fake user agent', skip_domains={'commons.wikimedia.org'}) is None
+    assert batch_store.make_plan_pending_background(consumer_token, 'fake user agent', skip_global_user_ids={46054761}) is None
+    pending = batch_store.make_plan_pending_background(consumer_token, 'fake user agent', skip_domains={'test.wikidata.org'}, skip_global_user_ids={1})
+    assert pending is not None
+    assert pending[0].id == batch.id
+
+def test_BatchStore_make_plans_pending_background(batch_store: BatchStore) -> None:
+    commands = [Command(Page('Page %d' % i, resolve_redirects=True, create_missing_page=False), [addCategory1]) for i in range(5)]
+    batch = batch_store.store_batch(NewBatch(commands, 'test batch'), fake_session)
+    batch_store.start_background(batch, fake_session)
+    consumer_token = mwoauth.ConsumerToken('fake', 'fake')
+    ids = [command_record.id for command_record in batch.command_records.get_slice(0, 5)]
+
+    pending_1 = batch_store.make_plans_pending_background(consumer_token, 'fake user agent', 3, 'worker A')
+    assert pending_1 is not None
+    background_batch_1, command_pendings_1, session_1 = pending_1
+    assert background_batch_1.id == batch.id
+    assert [command_pending.id for command_pending in command_pendings_1] == ids[0:3]
+    assert [command_pending.command for command_pending in command_pendings_1] == commands[0:3]
+    assert [type(command_record) for command_record in batch.command_records.get_slice(0, 5)] == [CommandPending, CommandPending, CommandPending, CommandPlan, CommandPlan]
+
+    # worker A finishes one command and gives back the others
+    batch.command_records.store_finish(CommandNoop(ids[0], commands[0], revision=1))
+    batch.command_records.make_pendings_planned(ids[1:3])
+    batch_store.release_background_lease(batch, 'worker A')
+
+    pending_2 = batch_store.make_plans_pending_background(consumer_token, 'fake user agent', 10, 'worker B')
+    assert pending_2 is not None
+    assert [command_pending.id for command_pending in pending_2[1]] == ids[1:5]
+
+def test_BatchStore_renew_background_lease(batch_store: BatchStore) -> None:
+    batch = batch_store.store_batch(newBatch1, fake_session)
+    batch_store.start_background(batch, fake_session)
+    consumer_token = mwoauth.ConsumerToken('fake', 'fake')
+    assert not batch_store.renew_background_lease(batch, 'worker A')  # not leased yet
+
+    pending = batch_store.make_plans_pending_background(consumer_token, 'fake user agent', 1, 'worker A')
+    assert pending is not None
+    assert batch_store.renew_background_lease(batch, 'worker A')
+    assert not batch_store.renew_background_lease(batch, 'worker B')
+
+    batch_store.suspend_background(batch, now() + datetime.timedelta(minutes=5))
+    assert not batch_store.renew_background_lease(batch, 'worker A')
+    batch_store.suspend_background(batch, now() - datetime.timedelta(minutes=5))
+    assert batch_store.renew_background_lease(batch, 'worker A')
+
+    batch_store.stop_background(batch)
+    assert not batch_store.renew_background_lease(batch, 'worker A')
+
+def test_BatchStore_get_background_sequence(batch_store: BatchStore) -> None:
+    batch = batch_store.store_batch(newBatch1, fake_session)
+    sequence_1 = batch_store.get_background_sequence()
+    batch_store.start_background(batch, fake_session)
+    sequence_2 = batch_store.get_background_sequence()
+    assert sequence_2 > sequence_1
+    batch_store.start_background(batch, fake_session)  # already running, no-op
+    assert batch_store.get_background_sequence() == sequence_2
+    batch_store.stop_background(batch, fake_session)
+    batch_store.start_background(batch, fake_session)
+    assert batch_store.get_background_sequence() > sequence_2
+
+def test_BatchStore_get_next_background_wakeup(batch_store: BatchStore, frozen_time: Any) -> None:
+    batch_1 = batch_store.store_batch(newBatch1, fake_session)
+    batch_2 = batch_store.store_batch(newBatch1, fake_session)
+    batch_store.start_background(batch_1, fake_session)
+    batch_store.start_background(batch_2, fake_session)
+    assert batch_store.get_next_background_wakeup() is None
+
+    batch_store.suspend_background(batch_1, now() + datetime.timedelta(minutes=5))
+    batch_store.suspend_background(batch_2, now() + datetime.timedelta(minutes=1))
+    assert batch_store.get_next_background_wakeup() == now() + datetime.timedelta(minutes=1)
+
+    frozen_time.tick(delta=datetime.timedelta(minutes=2))
+    assert batch_store.get_next_background_wakeup() == now() + datetime.timedelta(minutes=3)
+
+    batch_store.stop_background(batch_1)
+    assert batch_store.get_next_background_wakeup() is None
+
 def test_PreferenceStore(preference_store: PreferenceStore) -> None:
     assert preference_store.get_watchlist_param(None) is None
     assert preference_store.get_watchlist_param(fake_session) is None
     preference_store.set_watchlist_param(fake_session, WatchlistParam.nochange)
     assert preference_store.get_watchlist_param(fake_session) is WatchlistParam.nochange
+
+def test_TitleHtmlStore(title_html_store: TitleHtmlStore) -> None:
+    title1 = ('commons.wikimedia.org', '[[Category:Test]]')
+    title2 = ('en.wikipedia.org', '[[Category:Test]]')
+    title3 = ('commons.wikimedia.org', 'another title')
+    max_age = datetime.timedelta(hours=1)
+    assert title_html_store.get_title_htmls([], max_age) == {}
+    assert title_html_store.get_title_htmls([title1, title2], max_age) == {}
+    title_html_store.set_title_htmls({title1: '<a>Category:Test</a> (Commons)', title2: '<a>Category:Test</a> (Wikipedia)'})
+    assert title_html_store.get_title_htmls([title1, title2, title3], max_age) == {
+        title1: '<a>Category:Test</a> (Commons)',
+        title2: '<a>Category:Test</a> (Wikipedia)',
+    }
+    title_html_store.set_title_htmls({title1: '<a class="new">Category:Test</a> (Commons)'})
+    assert title_html_store.get_title_htmls([title1], max_age) == {title1: '<a class="new">Category:Test</a> (Commons)'}
+    # too old (rendered before the future, so to speak)
+    assert title_html_store.get_title_htmls([title1, title2], -max_age) == {}
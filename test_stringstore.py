@@ -2,16 +2,16 @@ import pymysql
 import pytest
 from typing import cast
 
-from stringstore import StringTableStore
+from stringstore import HashCollisionError, StringTableStore
 
 
 @pytest.mark.parametrize('string, expected_hash', [
-    # all hashes obtained in MariaDB via SELECT CAST(CONV(SUBSTRING(SHA2(**string**, 256), 1, 8), 16, 10) AS unsigned int);
-    ('', 3820012610),
-    ('test.wikipedia.org', 3277830609),
-    ('äöü', 3157433791),
-    ('☺', 3752208785),
-    ('🤔', 1622577385),
+    # all hashes obtained in MariaDB via SELECT CAST(CONV(SUBSTRING(SHA2(**string**, 256), 1, 16), 16, 10) AS unsigned int);
+    ('', 16406829232824261652),
+    ('test.wikipedia.org', 14078175269556112178),
+    ('äöü', 13561074874317403748),
+    ('☺', 16115614020667241752),
+    ('🤔', 6968916805163123859),
 ])
 def test_StringTableStore_hash(string: str, expected_hash: int) -> None:
     store = StringTableStore('', '', '', '')
@@ -28,7 +28,7 @@ def test_StringTableStore_acquire_id_database(database_connection_params: dict)
         store.acquire_id(connection, 'test.wikipedia.org')
 
         with connection.cursor() as cursor:
-            cursor.execute('SELECT domain_name FROM domain WHERE domain_hash = 3277830609')
+            cursor.execute('SELECT domain_name FROM domain WHERE domain_hash = 14078175269556112178')
             result = cursor.fetchone()
             assert result == ('test.wikipedia.org',)
 
@@ -52,3 +52,180 @@ def test_StringTableStore_acquire_id_cached() -> None:
 
     connection = cast(pymysql.connections.Connection, None)
     assert store.acquire_id(connection, 'test.wikipedia.org') == 1
+
+def test_StringTableStore_acquire_ids_database(database_connection_params: dict) -> None:
+    connection = pymysql.connect(**database_connection_params)
+    try:
+        store = StringTableStore('domain', 'domain_id', 'domain_hash', 'domain_name')
+        existing_id = store.acquire_id(connection, 'test.wikipedia.org')
+
+        with store._cache_lock:
+            store._cache.clear()
+
+        ids = store.acquire_ids(connection, ['test.wikipedia.org', 'de.wikipedia.org', 'en.wikipedia.org', 'de.wikipedia.org'])
+
+        assert ids.keys() == {'test.wikipedia.org', 'de.wikipedia.org', 'en.wikipedia.org'}
+        assert ids['test.wikipedia.org'] == existing_id
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT domain_id, domain_name FROM domain')
+            assert dict((name, id) for id, name in cursor.fetchall()) == ids
+
+        with store._cache_lock:
+            assert store._cache['de.wikipedia.org'] == ids['de.wikipedia.org']
+        with store._cache_lock:
+            store._cache.clear()
+        assert store.acquire_ids(connection, ids.keys()) == ids
+    finally:
+        connection.close()
+
+def test_StringTableStore_acquire_ids_cached() -> None:
+    store = StringTableStore('', '', '', '')
+
+    with store._cache_lock:
+        store._cache['test.wikipedia.org'] = 1
+        store._cache['de.wikipedia.org'] = 2
+
+    connection = cast(pymysql.connections.Connection, None)
+    assert store.acquire_ids(connection, ['test.wikipedia.org', 'de.wikipedia.org', 'test.wikipedia.org']) == {'test.wikipedia.org': 1, 'de.wikipedia.org': 2}
+    assert store.acquire_ids(connection, []) == {}
+
+def test_StringTableStore_acquire_id_collision_database(database_connection_params: dict, monkeypatch: pytest.MonkeyPatch) -> None:
+    connection = pymysql.connect(**database_connection_params)
+    try:
+        store = StringTableStore('domain', 'domain_id', 'domain_hash', 'domain_name')
+        monkeypatch.setattr(store, '_hash', lambda string: 1)
+
+        store.acquire_id(connection, 'test.wikipedia.org')
+
+        with pytest.raises(HashCollisionError):
+            store.acquire_id(connection, 'de.wikipedia.org')
+        with pytest.raises(HashCollisionError):
+            store.acquire_ids(connection, ['de.wikipedia.org'])
+    finally:
+        connection.close()
+
+def _insert_after_snapshot(store: StringTableStore, other_connection: pymysql.connections.Connection, other_string: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Make another writer insert other_string into the store’s table
+    right after the store’s first (non-locking) SELECT, i.e. after its snapshot was established."""
+    other_store = StringTableStore(store.table_name, store.id_column_name, store.hash_column_name, store.string_column_name)
+    monkeypatch.setattr(other_store, '_hash', store._hash)
+    select_ids = store._select_ids
+
+    def select_ids_then_insert(cursor: pymysql.cursors.Cursor, strings_by_hash: dict[int, str], lock: bool = False) -> dict[int, int]:
+        ids_by_hash = select_ids(cursor, strings_by_hash, lock)
+        if not lock:
+            other_store.acquire_id(other_connection, other_string)
+        return ids_by_hash
+    monkeypatch.setattr(store, '_select_ids', select_ids_then_insert)
+
+@pytest.mark.parametrize('acquire_ids', [False, True])
+def test_StringTableStore_acquire_concurrent_insert_database(database_connection_params: dict, monkeypatch: pytest.MonkeyPatch, acquire_ids: bool) -> None:
+    connection = pymysql.connect(**database_connection_params)
+    other_connection = pymysql.connect(**database_connection_params)
+    try:
+        store = StringTableStore('domain', 'domain_id', 'domain_hash', 'domain_name')
+        _insert_after_snapshot(store, other_connection, 'test.wikipedia.org', monkeypatch)
+
+        if acquire_ids:
+            id = store.acquire_ids(connection, ['test.wikipedia.org'])['test.wikipedia.org']
+        else:
+            id = store.acquire_id(connection, 'test.wikipedia.org')
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT domain_id FROM domain WHERE domain_name = %s', ('test.wikipedia.org',))
+            assert cursor.fetchall() == ((id,),)
+    finally:
+        other_connection.close()
+        connection.close()
+
+@pytest.mark.parametrize('acquire_ids', [False, True])
+def test_StringTableStore_acquire_concurrent_collision_database(database_connection_params: dict, monkeypatch: pytest.MonkeyPatch, acquire_ids: bool) -> None:
+    connection = pymysql.connect(**database_connection_params)
+    other_connection = pymysql.connect(**database_connection_params)
+    try:
+        store = StringTableStore('domain', 'domain_id', 'domain_hash', 'domain_name')
+        monkeypatch.setattr(store, '_hash', lambda string: 1)
+        _insert_after_snapshot(store, other_connection, 'test.wikipedia.org', monkeypatch)
+
+        with pytest.raises(HashCollisionError):
+            if acquire_ids:
+                store.acquire_ids(connection, ['de.wikipedia.org'])
+            else:
+                store.acquire_id(connection, 'de.wikipedia.org')
+    finally:
+        other_connection.close()
+        connection.close()
+
+def test_StringTableStore_acquire_ids_collision(monkeypatch: pytest.MonkeyPatch) -> None:
+    store = StringTableStore('', '', '', '')
+    monkeypatch.setattr(store, '_hash', lambda string: 1)
+
+    connection = cast(pymysql.connections.Connection, None)
+    with pytest.raises(HashCollisionError):
+        store.acquire_ids(connection, ['test.wikipedia.org', 'de.wikipedia.org'])
+
+def test_StringTableStore_find_ids_database(database_connection_params: dict) -> None:
+    connection = pymysql.connect(**database_connection_params)
+    try:
+        store = StringTableStore('domain', 'domain_id', 'domain_hash', 'domain_name')
+        existing_id = store.acquire_id(connection, 'test.wikipedia.org')
+
+        with store._cache_lock:
+            store._cache.clear()
+
+        assert store.find_ids(connection, ['test.wikipedia.org', 'de.wikipedia.org', 'test.wikipedia.org']) == {'test.wikipedia.org': existing_id}
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM domain')
+            assert cursor.fetchone() == (1,)
+        with store._cache_lock:
+            assert store._cache['test.wikipedia.org'] == existing_id
+            assert 'de.wikipedia.org' not in store._cache
+    finally:
+        connection.close()
+
+def test_StringTableStore_find_ids_cached() -> None:
+    store = StringTableStore('', '', '', '')
+
+    with store._cache_lock:
+        store._cache['test.wikipedia.org'] = 1
+        store._cache['de.wikipedia.org'] = 2
+
+    connection = cast(pymysql.connections.Connection, None)
+    assert store.find_ids(connection, ['test.wikipedia.org', 'de.wikipedia.org', 'test.wikipedia.org']) == {'test.wikipedia.org': 1, 'de.wikipedia.org': 2}
+    assert store.find_ids(connection, []) == {}
+
+def test_StringTableStore_get_strings_database(database_connection_params: dict) -> None:
+    connection = pymysql.connect(**database_connection_params)
+    try:
+        store = StringTableStore('domain', 'domain_id', 'domain_hash', 'domain_name')
+        ids = store.acquire_ids(connection, ['test.wikipedia.org', 'de.wikipedia.org'])
+
+        with store._cache_lock:
+            store._strings_cache.clear()
+
+        strings = store.get_strings(connection, [ids['test.wikipedia.org'], ids['de.wikipedia.org'], ids['test.wikipedia.org']])
+        assert strings == {id: string for string, id in ids.items()}
+        with store._cache_lock:
+            assert dict(store._strings_cache) == strings
+
+        with pytest.raises(KeyError):
+            store.get_strings(connection, [max(ids.values()) + 1])
+
+        with store._cache_lock:
+            store._strings_cache.clear()
+        store.preload_strings(connection)
+        with store._cache_lock:
+            assert dict(store._strings_cache) == strings
+    finally:
+        connection.close()
+
+def test_StringTableStore_get_strings_cached() -> None:
+    store = StringTableStore('', '', '', '')
+
+    with store._cache_lock:
+        store._strings_cache[1] = 'test.wikipedia.org'
+        store._strings_cache[2] = 'de.wikipedia.org'
+
+    connection = cast(pymysql.connections.Connection, None)
+    assert store.get_strings(connection, [2, 1]) == {1: 'test.wikipedia.org', 2: 'de.wikipedia.org'}
+    assert store.get_strings(connection, []) == {}
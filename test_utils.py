@@ -1,4 +1,6 @@
 from collections.abc import Callable
+import json
+import mwapi  # type: ignore
 import requests
 import requests_oauthlib  # type: ignore
 from typing import Any, Optional
@@ -34,3 +36,18 @@ class FakeSession:
                 return self.post_response
         else:
             raise NotImplementedError
+
+    def api_error(self, error: dict, headers: dict[str, str] = {}) -> Callable[..., dict]:
+        """Make a response that fails with the given API error.
+
+        Like a real session, the full response (including the headers)
+        is passed to any response hooks before the error is raised."""
+        def response(*args: Any, **kwargs: Any) -> dict:
+            raw_response = requests.Response()
+            raw_response.status_code = 200
+            raw_response._content = json.dumps({'error': error}).encode('utf-8')
+            raw_response.headers.update(headers)
+            for hook in self.session.hooks['response']:
+                hook(raw_response)
+            raise mwapi.errors.APIError.from_doc(error)
+        return response